@@ -148,3 +148,10 @@ _C.OUTPUT_DIR = '@'
 # non-deterministic op implementations
 # -1 means use time seed.
 _C.RNG_SEED = -1
+
+# ---------------------------------------------------------------------------- #
+# Distributed training (launched by torchrun)
+# ---------------------------------------------------------------------------- #
+_C.DISTRIBUTED = CN()
+# 'gloo' runs on CPU and across nodes. 'nccl' requires one GPU per process.
+_C.DISTRIBUTED.BACKEND = 'gloo'
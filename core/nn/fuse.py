@@ -0,0 +1,108 @@
+"""Helpers for exporting modules for inference
+
+Batch normalization in Conv1d, Conv2d and FC (see core.nn.modules) is an affine transform
+with running statistics at inference, so it can be folded into the weights of the preceding layer.
+The remaining ReLU is in place. TorchScript can further fuse it with the layer when the model is traced.
+
+"""
+
+import copy
+
+import torch
+from torch import nn
+
+from .modules import Conv1d, Conv2d, FC
+
+
+def fold_bn(layer, bn):
+    """Fold batch normalization into the preceding layer
+
+    Args:
+        layer (nn.Module): nn.Conv1d, nn.Conv2d or nn.Linear
+        bn (nn.Module): batch normalization with running statistics
+
+    Returns:
+        nn.Module: a copy of the layer with bias, equivalent to bn(layer(x)) in eval mode
+
+    """
+    assert bn.track_running_stats and bn.running_mean is not None
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.affine:
+            scale = scale * bn.weight
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            shift = shift + bn.bias
+
+        fused_layer = copy.deepcopy(layer)
+        # (out_channels, in_channels, *kernel_size)
+        fused_layer.weight.mul_(scale.view([-1] + [1] * (layer.weight.dim() - 1)))
+        if layer.bias is not None:
+            shift = shift + layer.bias * scale
+        fused_layer.bias = nn.Parameter(shift)
+    return fused_layer
+
+
+def fuse_bn(module):
+    """Fold batch normalization of all Conv1d, Conv2d and FC in place
+
+    The module should be in eval mode, since batch statistics are no longer computed.
+
+    Returns:
+        nn.Module: the module itself
+
+    """
+    for m in module.modules():
+        if isinstance(m, (Conv1d, Conv2d)) and m.bn is not None:
+            m.conv = fold_bn(m.conv, m.bn)
+            m.bn = None
+        elif isinstance(m, FC) and m.bn is not None:
+            m.fc = fold_bn(m.fc, m.bn)
+            m.bn = None
+    return module
+
+
+def export_inference(model):
+    """Return a frozen copy of the model for inference, with batch normalization folded"""
+    model = copy.deepcopy(model)
+    model.eval()
+    fuse_bn(model)
+    for params in model.parameters():
+        params.requires_grad = False
+    return model
+
+
+class Branch(nn.Module):
+    """Bind constant arguments of a model, e.g. infer_type, so that the branch can be traced"""
+
+    def __init__(self, model, *args):
+        super(Branch, self).__init__()
+        self.model = model
+        self.args = args
+
+    def forward(self, *inputs):
+        return self.model(*(inputs + self.args))
+
+
+def trace_inference(model, example_inputs, *args):
+    """Trace a model (or a branch with constant args) exported by export_inference with TorchScript
+
+    The traced module is frozen and optimized, where ReLU might be fused.
+    It is only valid for inputs of the same shapes if the model has data-dependent control flows.
+
+    Args:
+        model (nn.Module): the model in eval mode
+        example_inputs (tuple of torch.Tensor): inputs to trace
+        *args: constant arguments after inputs
+
+    Returns:
+        torch.jit.ScriptModule
+
+    """
+    if args:
+        model = Branch(model, *args)
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_inputs, check_trace=False)
+    # the module is frozen by optimize_for_inference
+    return torch.jit.optimize_for_inference(traced)
@@ -14,6 +14,16 @@ def set_bn(module, momentum):
             m.momentum = momentum
 
 
+def randomize_bn(module):
+    """Randomize affine parameters and running statistics of batch normalization, e.g. to test fusion"""
+    for m in module.modules():
+        if isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)):
+            nn.init.uniform_(m.weight)
+            nn.init.uniform_(m.bias)
+            nn.init.normal_(m.running_mean)
+            nn.init.uniform_(m.running_var, 0.5, 1.5)
+
+
 def xavier_uniform(module):
     if module.weight is not None:
         nn.init.xavier_uniform_(module.weight)
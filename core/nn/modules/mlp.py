@@ -1,3 +1,6 @@
+import time
+
+import torch
 from torch import nn
 import torch.nn.functional as F
 
@@ -59,7 +62,8 @@ class SharedMLP(nn.ModuleList):
                  ndim=1,
                  dropout_prob=0.0,
                  bn=True,
-                 bn_momentum=0.1):
+                 bn_momentum=0.1,
+                 matmul=False):
         """Multilayer perceptron shared on resolution (1D or 2D)
 
         Args:
@@ -69,6 +73,8 @@ class SharedMLP(nn.ModuleList):
             dropout_prob (float or None): dropout ratio
             bn (bool): whether to use batch normalization
             bn_momentum (float)
+            matmul (bool, optional): whether to run as matmul over channels-last points at inference.
+                If None, it is chosen by a micro-benchmark at the first inference on CPU of each input shape.
 
         """
         super(SharedMLP, self).__init__()
@@ -92,7 +98,14 @@ class SharedMLP(nn.ModuleList):
         assert dropout_prob >= 0.0
         self.dropout_prob = dropout_prob
 
+        # not a buffer, so that checkpoints are unchanged
+        self.matmul = matmul
+        # input shape -> whether matmul is faster
+        self._matmul_choice = {}
+
     def forward(self, x):
+        if not self.training and self._use_matmul(x):
+            return self.forward_matmul(x)
         for module in self:
             assert isinstance(module, (Conv1d, Conv2d))
             x = module(x)
@@ -105,6 +118,76 @@ class SharedMLP(nn.ModuleList):
                     raise ValueError('SharedMLP only supports ndim=(1, 2).')
         return x
 
+    def forward_matmul(self, x):
+        """Inference as matmul over channels-last points
+
+        Each layer (1x1 conv, batch normalization with running statistics and relu)
+        is a single matmul with the folded bias, followed by in-place relu.
+
+        Args:
+            x (torch.Tensor): (batch_size, in_channels, *spatial_size)
+
+        Returns:
+            torch.Tensor: (batch_size, out_channels, *spatial_size)
+
+        """
+        batch_size, in_channels = x.shape[:2]
+        spatial_size = x.shape[2:]
+        # (batch_size * num_points, in_channels)
+        x = x.reshape(batch_size, in_channels, -1).transpose(1, 2).reshape(-1, in_channels)
+        for module in self:
+            weight, bias = self._fold_layer(module)
+            if bias is None:
+                x = torch.mm(x, weight.t())
+            else:
+                x = torch.addmm(bias, x, weight.t())
+            if module.relu is not None:
+                x = x.relu_()
+        out_channels = x.size(1)
+        x = x.view(batch_size, -1, out_channels).transpose(1, 2)
+        return x.reshape((batch_size, out_channels) + spatial_size)
+
+    @staticmethod
+    def _fold_layer(module):
+        """Return weight (out_channels, in_channels) and bias of conv followed by batch normalization"""
+        weight = module.conv.weight.view(module.conv.out_channels, -1)
+        bias = module.conv.bias
+        bn = module.bn
+        if bn is not None:
+            scale = torch.rsqrt(bn.running_var + bn.eps)
+            if bn.weight is not None:
+                scale = scale * bn.weight
+            weight = weight * scale.unsqueeze(1)
+            bias = -bn.running_mean * scale if bias is None else (bias - bn.running_mean) * scale
+            if bn.bias is not None:
+                bias = bias + bn.bias
+        return weight, bias
+
+    def _use_matmul(self, x):
+        if self.matmul is not None:
+            return self.matmul
+        if x.is_cuda:
+            return False
+        shape = tuple(x.shape)
+        if shape not in self._matmul_choice:
+            self._matmul_choice[shape] = self._benchmark_matmul(x)
+        return self._matmul_choice[shape]
+
+    def _benchmark_matmul(self, x, repeat=3):
+        """Return whether matmul is faster than conv on the input"""
+        timing = []
+        with torch.no_grad():
+            for matmul in (False, True):
+                self.matmul = matmul
+                # not self(x), which might be overridden by subclasses, e.g. EdgeConvBlock
+                SharedMLP.forward(self, x)  # warm up
+                start_time = time.perf_counter()
+                for _ in range(repeat):
+                    SharedMLP.forward(self, x)
+                timing.append(time.perf_counter() - start_time)
+        self.matmul = None
+        return timing[1] < timing[0]
+
     def reset_parameters(self, init_fn=None):
         for module in self:
             assert isinstance(module, (Conv1d, Conv2d))
@@ -0,0 +1,132 @@
+"""Dynamic int8 quantization for CPU inference
+
+Weights of linear layers are quantized to int8 ahead of time, and activations are quantized
+per batch on the fly, so no calibration data is needed.
+PyTorch only quantizes nn.Linear dynamically. Therefore, SharedMLP (1x1 conv) is converted
+into PointwiseMLP, which applies nn.Linear over channels-last points.
+
+"""
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from .modules import SharedMLP
+from .fuse import export_inference
+
+
+class PointwiseMLP(nn.Module):
+    """SharedMLP at inference as nn.Linear over channels-last points
+
+    Args:
+        shared_mlp (SharedMLP): the source, whose batch normalization is folded into linear layers
+
+    """
+
+    def __init__(self, shared_mlp):
+        super(PointwiseMLP, self).__init__()
+
+        self.in_channels = shared_mlp.in_channels
+        self.out_channels = shared_mlp.out_channels
+
+        self.linears = nn.ModuleList()
+        self.relu = []
+        for module in shared_mlp:
+            weight, bias = SharedMLP._fold_layer(module)
+            linear = nn.Linear(weight.size(1), weight.size(0), bias=True)
+            with torch.no_grad():
+                linear.weight.copy_(weight)
+                if bias is None:
+                    linear.bias.zero_()
+                else:
+                    linear.bias.copy_(bias)
+            self.linears.append(linear)
+            self.relu.append(module.relu is not None)
+
+    def forward(self, x):
+        batch_size, in_channels = x.shape[:2]
+        spatial_size = x.shape[2:]
+        # (batch_size * num_points, in_channels)
+        x = x.reshape(batch_size, in_channels, -1).transpose(1, 2).reshape(-1, in_channels)
+        for linear, relu in zip(self.linears, self.relu):
+            x = linear(x)
+            if relu:
+                x = F.relu(x, inplace=True)
+        x = x.view(batch_size, -1, self.out_channels).transpose(1, 2)
+        return x.reshape((batch_size, self.out_channels) + spatial_size)
+
+
+def replace_shared_mlp(model):
+    """Replace all SharedMLP with PointwiseMLP in place, for a model in eval mode"""
+    for m in list(model.modules()):
+        for child_name, child in list(m.named_children()):
+            if isinstance(child, SharedMLP):
+                setattr(m, child_name, PointwiseMLP(child))
+    return model
+
+
+def quantize_dynamic(model, dtype=torch.qint8):
+    """Return a copy of the model for CPU inference with dynamically quantized linear layers
+
+    Batch normalization is folded first (see export_inference),
+    and SharedMLP is converted into PointwiseMLP so that 1x1 convs are quantized as well.
+    The copy is on CPU, whatever the device of the model.
+
+    Args:
+        model (nn.Module): the model
+        dtype (torch.dtype): the dtype of quantized weights
+
+    Returns:
+        nn.Module
+
+    """
+    # quantized modules only run on CPU
+    model = export_inference(model).cpu()
+    replace_shared_mlp(model)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=dtype, inplace=True)
+
+
+def _to_device(x, device):
+    """Move tensors, possibly nested in tuples or lists, to the device"""
+    if isinstance(x, torch.Tensor):
+        return x.to(device)
+    if isinstance(x, (tuple, list)):
+        return type(x)(_to_device(e, device) for e in x)
+    return x
+
+
+class CPUModule(nn.Module):
+    """Run a CPU model, e.g. quantized, inside a pipeline on another device
+
+    Inputs are moved to CPU, and outputs are moved back to the device of the first input tensor.
+
+    Args:
+        model (nn.Module): the model on CPU
+
+    """
+
+    def __init__(self, model):
+        super(CPUModule, self).__init__()
+        self.model = model
+
+    def forward(self, *args):
+        device = next((x.device for x in args if isinstance(x, torch.Tensor)), torch.device('cpu'))
+        outputs = self.model(*_to_device(args, 'cpu'))
+        return _to_device(outputs, device)
+
+
+def quantize_dynamic_cpu(model, dtype=torch.qint8):
+    """Quantize a model on any device (see quantize_dynamic), which runs on CPU with inputs on its device
+
+    Args:
+        model (nn.Module): the model, optionally wrapped by nn.DataParallel
+        dtype (torch.dtype): the dtype of quantized weights
+
+    Returns:
+        CPUModule
+
+    """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    return CPUModule(quantize_dynamic(model, dtype=dtype))
+
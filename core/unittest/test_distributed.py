@@ -0,0 +1,79 @@
+"""Test distributed training with the gloo backend on CPU
+
+Ranks are spawned on a single machine, and initialized from environment variables as torchrun does.
+
+"""
+
+import os
+import socket
+
+import torch
+from torch import nn
+import torch.multiprocessing as mp
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from core.utils import comm
+
+WORLD_SIZE = 2
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _run(rank, port, batch):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                      RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(WORLD_SIZE))
+    assert comm.init_distributed('gloo')
+    try:
+        assert comm.get_rank() == rank and comm.get_world_size() == WORLD_SIZE
+        assert comm.is_main_process() == (rank == 0)
+
+        loss_dict = comm.reduce_dict({'a': torch.tensor(float(rank)), 'b': torch.tensor(1.0)})
+        assert torch.allclose(loss_dict['a'], torch.tensor(0.5)) and torch.allclose(loss_dict['b'], torch.tensor(1.0))
+        assert comm.all_reduce_min(10 + rank) == 10
+
+        # each rank takes a shard of the batch
+        x, y = batch
+        shard = slice(rank * x.size(0) // WORLD_SIZE, (rank + 1) * x.size(0) // WORLD_SIZE)
+
+        # reference gradients on the whole batch
+        torch.manual_seed(0)
+        model = nn.Linear(3, 2)
+        nn.functional.mse_loss(model(x), y).backward()
+        ref_grads = [p.grad.clone() for p in model.parameters()]
+
+        # DistributedDataParallel, with different initial weights. Weights of rank 0 are broadcast.
+        torch.manual_seed(rank)
+        ddp_model = DistributedDataParallel(nn.Linear(3, 2))
+        nn.functional.mse_loss(ddp_model(x[shard]), y[shard]).backward()
+        for p, g in zip(ddp_model.parameters(), ref_grads):
+            assert torch.allclose(p.grad, g, atol=1e-6)
+
+        # explicit broadcast of weights and all-reduce of gradients
+        torch.manual_seed(rank)
+        model = nn.Linear(3, 2)
+        comm.broadcast_parameters(model)
+        nn.functional.mse_loss(model(x[shard]), y[shard]).backward()
+        comm.all_reduce_gradients(model)
+        for p, g in zip(model.parameters(), ref_grads):
+            assert torch.allclose(p.grad, g, atol=1e-6)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_gloo():
+    batch = (torch.rand(8, 3), torch.rand(8, 2))
+    mp.spawn(_run, args=(get_free_port(), batch), nprocs=WORLD_SIZE, join=True)
+
+
+def test_single_process():
+    # fall back without initialization
+    assert not comm.is_distributed()
+    assert comm.get_world_size() == 1 and comm.get_rank() == 0
+    loss_dict = {'a': torch.tensor(1.0)}
+    assert comm.reduce_dict(loss_dict) is loss_dict
+    assert comm.all_reduce_min(3) == 3
@@ -0,0 +1,42 @@
+import torch
+from torch import nn
+
+from core.nn import Conv2d, FC, SharedMLP
+from core.nn.fuse import export_inference
+from core.nn.init import randomize_bn
+from core.nn.quantize import PointwiseMLP, quantize_dynamic, quantize_dynamic_cpu
+
+
+def test_export_inference():
+    torch.manual_seed(0)
+    models = [
+        (nn.Sequential(SharedMLP(3, (16, 32), ndim=1), SharedMLP(32, (8,), ndim=1)), torch.randn(4, 3, 64)),
+        (nn.Sequential(SharedMLP(3, (16, 32), ndim=2), Conv2d(32, 8, 1, relu=False)), torch.randn(4, 3, 8, 8)),
+        (nn.Sequential(FC(8, 16), FC(16, 4, relu=False)), torch.randn(4, 8)),
+    ]
+    for model, x in models:
+        randomize_bn(model)
+        model.eval()
+        fused_model = export_inference(model)
+        assert not any(isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d)) for m in fused_model.modules())
+        with torch.no_grad():
+            assert torch.allclose(model(x), fused_model(x), atol=1e-5)
+
+
+def test_quantize_dynamic():
+    torch.manual_seed(0)
+    model = nn.Sequential(SharedMLP(3, (16, 32), ndim=2), nn.Flatten(), FC(32 * 8 * 8, 4, relu=False))
+    x = torch.randn(4, 3, 8, 8)
+    randomize_bn(model)
+    model.eval()
+    with torch.no_grad():
+        y = model(x)
+        # exact before quantization
+        assert torch.allclose(PointwiseMLP(model[0])(x), model[0](x), atol=1e-5)
+        quantized_model = quantize_dynamic(model)
+        assert isinstance(quantized_model[0], PointwiseMLP)
+        assert torch.allclose(quantized_model(x), y, atol=0.1 * y.abs().max().item())
+        # the same copy, wrapped to run on CPU inside a pipeline on any device
+        cpu_model = quantize_dynamic_cpu(nn.DataParallel(model))
+        assert torch.equal(cpu_model(x), quantized_model(x))
+        assert isinstance(model[0], SharedMLP)
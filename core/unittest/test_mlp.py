@@ -0,0 +1,36 @@
+import torch
+from torch import nn
+
+from core.nn import SharedMLP
+
+
+def test_shared_mlp_matmul():
+    torch.manual_seed(0)
+    for ndim, x in ((1, torch.randn(4, 3, 64)), (2, torch.randn(4, 3, 16, 8))):
+        for bn in (True, False):
+            mlp = SharedMLP(3, (16, 32), ndim=ndim, bn=bn)
+            if bn:
+                for m in mlp.modules():
+                    if isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d)):
+                        nn.init.uniform_(m.weight)
+                        nn.init.uniform_(m.bias)
+                # update running statistics
+                with torch.no_grad():
+                    mlp(x)
+            mlp.eval()
+            with torch.no_grad():
+                # conv by default
+                y = mlp(x)
+                assert not mlp._matmul_choice
+                mlp.matmul = True
+                y_matmul = mlp(x)
+                # chosen by the micro-benchmark for each input shape
+                mlp.matmul = None
+                y_auto = mlp(x)
+                y_auto_half = mlp(x[:2])
+            assert y_matmul.shape == y.shape
+            assert torch.allclose(y, y_matmul, atol=1e-5)
+            assert torch.allclose(y, y_auto, atol=1e-5)
+            assert torch.allclose(y[:2], y_auto_half, atol=1e-5)
+            assert set(mlp._matmul_choice.keys()) == {tuple(x.shape), tuple(x[:2].shape)}
+            assert set(mlp.state_dict().keys()) == set(SharedMLP(3, (16, 32), ndim=ndim, bn=bn).state_dict().keys())
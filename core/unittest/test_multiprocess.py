@@ -3,6 +3,9 @@
 Notes:
     1. Numpy random generator in each worker is same, and even does not affect the generator of the main process.
     2. When num_workers > 1, h5py does not work properly.
+    3. Memory-mapped numpy arrays work with multiple workers if they are opened lazily in each worker.
+       All the workers share the OS page cache instead of holding private copies.
+       See partnet/unittest/test_partnet_compact.py for PartNetCompactInsSeg.
 
 References:
     1. https://pytorch.org/docs/stable/notes/faq.html#dataloader-workers-random-seed
@@ -15,18 +15,20 @@ class Checkpointer(object):
         optimizer=None,
         scheduler=None,
         save_dir='',
+        save_to_disk=True,
         logger=None,
     ):
         self.model = model
         self.optimizer = optimizer
         self.scheduler = scheduler
         self.save_dir = save_dir
+        self.save_to_disk = save_to_disk
         if logger is None:
             logger = logging.getLogger(__name__)
         self.logger = logger
 
     def save(self, name, **kwargs):
-        if not self.save_dir:
+        if not self.save_dir or not self.save_to_disk:
             return
 
         data = dict()
@@ -0,0 +1,139 @@
+"""Helpers of distributed training
+
+Processes are launched by torchrun (or torch.distributed.launch), which sets RANK, WORLD_SIZE and LOCAL_RANK.
+All the helpers fall back to single-process behaviors if torch.distributed is not initialized.
+
+References:
+    https://github.com/facebookresearch/maskrcnn-benchmark/blob/master/maskrcnn_benchmark/utils/comm.py
+
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    """Initialize the process group from environment variables
+
+    Returns:
+        bool: whether it runs with more than one process
+
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return False
+    if not dist.is_initialized():
+        if backend == 'nccl':
+            torch.cuda.set_device(get_local_rank())
+        dist.init_process_group(backend=backend, init_method='env://')
+    synchronize()
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_world_size():
+    if not is_distributed():
+        return 1
+    return dist.get_world_size()
+
+
+def get_rank():
+    if not is_distributed():
+        return 0
+    return dist.get_rank()
+
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def get_device():
+    """Return the device of this process, one GPU per process if CUDA is available"""
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    if is_distributed():
+        return torch.device('cuda', get_local_rank())
+    return torch.device('cuda')
+
+
+def synchronize():
+    """Barrier among all the processes"""
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def reduce_dict(input_dict, average=True):
+    """Reduce scalar tensors of a dict from all the processes, e.g. losses for logging
+
+    Args:
+        input_dict (dict): name -> scalar tensor
+        average (bool): whether to average or sum
+
+    Returns:
+        dict: the reduced dict with the same keys
+
+    """
+    world_size = get_world_size()
+    if world_size < 2:
+        return input_dict
+    with torch.no_grad():
+        names = sorted(input_dict.keys())
+        values = torch.stack([input_dict[k].detach().float().reshape(()) for k in names])
+        dist.all_reduce(values)
+        if average:
+            values /= world_size
+        return {k: v for k, v in zip(names, values)}
+
+
+def all_reduce_min(value):
+    """Return the minimum of an integer over all the processes"""
+    if get_world_size() < 2:
+        return value
+    # nccl only reduces CUDA tensors
+    device = get_device() if dist.get_backend() == 'nccl' else 'cpu'
+    tensor = torch.tensor([value], dtype=torch.int64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return int(tensor.item())
+
+
+def broadcast_parameters(model, src=0):
+    """Broadcast parameters and buffers from the source process"""
+    if get_world_size() < 2:
+        return
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def all_reduce_gradients(model):
+    """Average gradients over all the processes
+
+    It is an alternative to DistributedDataParallel for models which run several forwards
+    with different subsets of parameters before a backward.
+    All the processes should compute gradients of the same parameters.
+    Gradients are flattened into a single buffer to reduce the number of collectives.
+
+    """
+    world_size = get_world_size()
+    if world_size < 2:
+        return
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    offset = 0
+    for g in grads:
+        numel = g.numel()
+        g.copy_(flat[offset:offset + numel].view_as(g))
+        offset += numel
@@ -7,9 +7,12 @@ import time
 import socket
 
 
-def setup_logger(name, save_dir, prefix='', timestamp=True):
+def setup_logger(name, save_dir, prefix='', timestamp=True, distributed_rank=0):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
+    # don't log results for the non-master process
+    if distributed_rank > 0:
+        return logger
     ch = logging.StreamHandler(stream=sys.stdout)
     ch.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s')
@@ -14,6 +14,7 @@ parser.add_argument('--level_id', type=int, help='Level ID [default: 3]')
 parser.add_argument('--pred_dir', default='../results/',type=str, help='log prediction directory [default: log]')
 parser.add_argument('--iou_threshold', type=float, default=0.5, help='IoU Threshold [default: 0.5]')
 parser.add_argument('--plot_dir', type=str, default=None, help='PR Curve Plot Output Directory [default: None, meaning no output]')
+parser.add_argument('--source', type=str, default='levels', choices=['levels', 'fusion'], help='Evaluate the concatenated Level_* predictions or the Fusion predictions of partnet/test_multi_level.py [default: levels]')
 FLAGS = parser.parse_args()
 
 stat_in_fn = '../data/partnet/stats/after_merging2_label_ids/%s-level-%d.txt' % (FLAGS.category, FLAGS.level_id)
@@ -23,7 +24,7 @@ with open(stat_in_fn, 'r') as fin:
 gt_in_dir = '../data/partnet/ins_seg_h5_gt/%s-%d/' % (FLAGS.category, FLAGS.level_id)
 pred_dir = FLAGS.pred_dir
 
-recalls = eval_recall_iou_nosem_fusion(stat_in_fn, gt_in_dir, os.path.join(pred_dir,FLAGS.category), iou_threshold=FLAGS.iou_threshold, plot_dir=FLAGS.plot_dir)
+recalls = eval_recall_iou_nosem_fusion(stat_in_fn, gt_in_dir, os.path.join(pred_dir,FLAGS.category), iou_threshold=FLAGS.iou_threshold, plot_dir=FLAGS.plot_dir, source=FLAGS.source)
 print(recalls)
 print('mRecall %f'%np.mean(recalls))
 f = open('results.txt','a+')
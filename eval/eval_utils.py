@@ -96,16 +96,19 @@ def compute_ap(tp, fp, gt_npos, n_bins=100, plot_fn=None):
 
     return ap
 
-def eval_recall_iou_nosem_fusion(stat_fn, gt_dir, pred_dir, iou_threshold=0.5, plot_dir=None):
+def eval_recall_iou_nosem_fusion(stat_fn, gt_dir, pred_dir, iou_threshold=0.5, plot_dir=None, source='levels'):
     """ Input:  stat_fn contains all part ids and names 
                 gt_dir contains test-xx.h5
                 pred_dir contains test-xx.h5
+                source is 'levels' to concatenate pred_dir/Level_{1,2,3}, or 'fusion' to read pred_dir/Fusion
         Output: aps: Average Prediction Scores for each part category, evaluated on all test shapes
                 mAP: mean AP
     """
+    assert source in ('levels', 'fusion'), source
     print('Evaluation Start.')
     print('Ground-truth Directory: %s' % gt_dir)
     print('Prediction Directory: %s' % pred_dir)
+    print('Prediction Source: %s' % source)
 
     if plot_dir is not None and not os.path.exists(plot_dir):
         check_mkdir(plot_dir)
@@ -142,12 +145,16 @@ def eval_recall_iou_nosem_fusion(stat_fn, gt_dir, pred_dir, iou_threshold=0.5, p
         print('Testing %s' % item)
 
         gt_mask, gt_mask_label, gt_mask_valid, gt_mask_other = load_gt_h5(os.path.join(gt_dir, item))
-        pred_mask1, pred_valid1, pred_conf1 = load_pred_h5_nosem(os.path.join(pred_dir, 'Level_1',item))
-        pred_mask2, pred_valid2, pred_conf2 = load_pred_h5_nosem(os.path.join(pred_dir, 'Level_2',item))
-        pred_mask3, pred_valid3, pred_conf3 = load_pred_h5_nosem(os.path.join(pred_dir, 'Level_3',item))
-        pred_mask = np.concatenate([pred_mask1, pred_mask2, pred_mask3], axis=1)
-        pred_valid = np.concatenate([pred_valid1, pred_valid2, pred_valid3], axis=1)
-        pred_conf = np.concatenate([pred_conf1, pred_conf2, pred_conf3], axis=1)
+        if source == 'fusion':
+            # fused by partnet/test_multi_level.py
+            pred_mask, pred_valid, pred_conf = load_pred_h5_nosem(os.path.join(pred_dir, 'Fusion', item))
+        else:
+            pred_mask1, pred_valid1, pred_conf1 = load_pred_h5_nosem(os.path.join(pred_dir, 'Level_1',item))
+            pred_mask2, pred_valid2, pred_conf2 = load_pred_h5_nosem(os.path.join(pred_dir, 'Level_2',item))
+            pred_mask3, pred_valid3, pred_conf3 = load_pred_h5_nosem(os.path.join(pred_dir, 'Level_3',item))
+            pred_mask = np.concatenate([pred_mask1, pred_mask2, pred_mask3], axis=1)
+            pred_valid = np.concatenate([pred_valid1, pred_valid2, pred_valid3], axis=1)
+            pred_conf = np.concatenate([pred_conf1, pred_conf2, pred_conf3], axis=1)
 
 
         n_shape = gt_mask.shape[0]
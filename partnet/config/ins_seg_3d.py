@@ -25,19 +25,40 @@ _C.LABEL = CN()
 # ----------------------------------------------------------------------------- #
 # Dataset
 # ----------------------------------------------------------------------------- #
+# anno_ids: path to a file of anno_ids to load, one per line. Empty to load all the shapes.
 _C.DATASET.PartNetInsSeg = CN()
 _C.DATASET.PartNetInsSeg.TRAIN = CN(new_allowed=True)
 _C.DATASET.PartNetInsSeg.TRAIN.split = 'train'
 _C.DATASET.PartNetInsSeg.TRAIN.stage1 = 'fusion'
 _C.DATASET.PartNetInsSeg.TRAIN.level = -1
+_C.DATASET.PartNetInsSeg.TRAIN.anno_ids = ''
 _C.DATASET.PartNetInsSeg.VAL = CN()
 _C.DATASET.PartNetInsSeg.VAL.split = 'val'
 _C.DATASET.PartNetInsSeg.VAL.shape = ''
 _C.DATASET.PartNetInsSeg.VAL.level = -1
+_C.DATASET.PartNetInsSeg.VAL.anno_ids = ''
 _C.DATASET.PartNetInsSeg.TEST = CN()
 _C.DATASET.PartNetInsSeg.TEST.split = 'test'
 _C.DATASET.PartNetInsSeg.TEST.shape = ''
 _C.DATASET.PartNetInsSeg.TEST.level = -1
+_C.DATASET.PartNetInsSeg.TEST.anno_ids = ''
+
+_C.DATASET.PartNetCompactInsSeg = CN()
+_C.DATASET.PartNetCompactInsSeg.TRAIN = CN(new_allowed=True)
+_C.DATASET.PartNetCompactInsSeg.TRAIN.split = 'train'
+_C.DATASET.PartNetCompactInsSeg.TRAIN.stage1 = 'fusion'
+_C.DATASET.PartNetCompactInsSeg.TRAIN.level = -1
+_C.DATASET.PartNetCompactInsSeg.TRAIN.anno_ids = ''
+_C.DATASET.PartNetCompactInsSeg.VAL = CN()
+_C.DATASET.PartNetCompactInsSeg.VAL.split = 'val'
+_C.DATASET.PartNetCompactInsSeg.VAL.shape = ''
+_C.DATASET.PartNetCompactInsSeg.VAL.level = -1
+_C.DATASET.PartNetCompactInsSeg.VAL.anno_ids = ''
+_C.DATASET.PartNetCompactInsSeg.TEST = CN()
+_C.DATASET.PartNetCompactInsSeg.TEST.split = 'test'
+_C.DATASET.PartNetCompactInsSeg.TEST.shape = ''
+_C.DATASET.PartNetCompactInsSeg.TEST.level = -1
+_C.DATASET.PartNetCompactInsSeg.TEST.anno_ids = ''
 
 _C.DATASET.PartNetRegionInsSeg = CN()
 _C.DATASET.PartNetRegionInsSeg.TRAIN = CN(new_allowed=True)
@@ -45,19 +66,28 @@ _C.DATASET.PartNetRegionInsSeg.TRAIN.split = 'train'
 _C.DATASET.PartNetRegionInsSeg.TRAIN.shape = ''
 _C.DATASET.PartNetRegionInsSeg.TRAIN.stage1 = 'fusion'
 _C.DATASET.PartNetRegionInsSeg.TRAIN.level = -1
+_C.DATASET.PartNetRegionInsSeg.TRAIN.anno_ids = ''
 _C.DATASET.PartNetRegionInsSeg.VAL = CN(new_allowed=True)
 _C.DATASET.PartNetRegionInsSeg.VAL.split = 'val'
 _C.DATASET.PartNetRegionInsSeg.VAL.shape = ''
 _C.DATASET.PartNetRegionInsSeg.VAL.level = -1
+_C.DATASET.PartNetRegionInsSeg.VAL.anno_ids = ''
 _C.DATASET.PartNetRegionInsSeg.TEST = CN(new_allowed=True)
 _C.DATASET.PartNetRegionInsSeg.TEST.split = 'test'
 _C.DATASET.PartNetRegionInsSeg.TEST.shape = ''
 _C.DATASET.PartNetRegionInsSeg.TEST.level = -1
+_C.DATASET.PartNetRegionInsSeg.TEST.anno_ids = ''
 
+# The number of batches loaded in advance by each worker
+_C.DATALOADER.PREFETCH_FACTOR = 2
+# Whether to augment whole batches in collate (on the device generating regions), instead of each shape in datasets
+_C.DATALOADER.BATCH_AUGMENTATION = False
 _C.DATALOADER.KWARGS = CN(new_allowed=True)
 _C.DATALOADER.KWARGS.num_centroids = 256
 _C.DATALOADER.KWARGS.radius = 0.1
 _C.DATALOADER.KWARGS.num_neighbours = 128
+# If positive, FPS of centroids runs on voxel-grid downsampled points, with about fps_ratio candidates per centroid
+_C.DATALOADER.KWARGS.fps_ratio = 0.0
 # _C.MODEL.PointNetInsSeg.with_renorm = False
 # _C.MODEL.PointNetInsSeg.with_resample = False
 # _C.MODEL.PointNetInsSeg.with_shift = False
@@ -71,6 +101,30 @@ _C.MODEL.CUSTOM.loss = CN()
 _C.MODEL.CUSTOM.loss.ins_weight = 1.
 #_C.MODEL.CUSTOM.loss.sampler = CN(new_allowed=True)
 
+# ---------------------------------------------------------------------------- #
+# Producer (stage 2)
+# ---------------------------------------------------------------------------- #
+_C.PRODUCER = CN()
+# Whether to step grouping episodes of a batch in lock-step,
+# so that their forwards are concatenated into one batch. Otherwise, they run one after another.
+_C.PRODUCER.VECTORIZED_ROLLOUT = False
+# The maximum number of pairs in one forward of scoring networks
+_C.PRODUCER.ROLLOUT_BATCH_SIZE = 1024
+
+_C.PRODUCER.BUFFER = CN()
+# A new shard is written when the context pool has more samples than SHARD_SIZE
+_C.PRODUCER.BUFFER.SHARD_SIZE = 1000
+# Retention window of shards. Non-positive for no limit.
+_C.PRODUCER.BUFFER.MAX_SHARDS = 10
+_C.PRODUCER.BUFFER.MAX_BYTES = 0
+
+# ---------------------------------------------------------------------------- #
+# Consumer (stage 2)
+# ---------------------------------------------------------------------------- #
+_C.CONSUMER = CN()
+# The number of minibatches staged ahead by the background sampler of each branch
+_C.CONSUMER.NUM_PREFETCH = 2
+
 
 # ---------------------------------------------------------------------------- #
 # Test
@@ -80,3 +134,9 @@ _C.TEST.NUM_VOTES = 1
 
 # relative path will be appended to OUTPUT_DIR
 _C.TEST.SUBMIT_DIR = ''
+# Directory to cache stage-1 proposals across runs. Empty to disable.
+# Entries are keyed by the sampler configuration and checkpoints, so that stale proposals are never reused.
+_C.TEST.PROPOSAL_CACHE_DIR = ''
+# Whether to run the grouping model (model_merge) on CPU with dynamic int8 quantization (see core.nn.quantize).
+# Other parts of the test pipeline stay on GPU.
+_C.TEST.QUANTIZE = False
@@ -5,21 +5,40 @@ from functools import partial
 import numpy as np
 import torch
 from torch.utils.data.dataloader import DataLoader, default_collate
+from torch.utils.data.distributed import DistributedSampler
 
+from core.utils import comm
 from core.utils.torch_util import worker_init_fn
 import shaper.models.pointnet2.functions as _F
-from .partnet import PartNetInsSeg, PartNetRegionInsSeg
+from .partnet import PartNetInsSeg, PartNetCompactInsSeg, PartNetRegionInsSeg, transform_with_boundary
+from partnet.utils.torch_pc import voxel_grid_sample, knn_label_boundary, boundary_distance
 from shaper.data import transforms as T
 from IPython import embed
 
 
 def collate(batch, num_centroids, radius, num_neighbours,
-            with_renorm, with_resample, with_shift, sample_method):
+            with_renorm, with_resample, with_shift, sample_method, device='cuda', transform=None, fps_ratio=0.0):
+    """Collate a batch and generate regions
+
+    If device is 'cpu', it can run in DataLoader workers, so that regions are generated
+    in parallel with training. Otherwise, it runs on GPU in the main process.
+    If transform is given, points of the batch are (batch_size, length, 3) and augmented on the device.
+    If fps_ratio is positive, FPS runs approximately on about fps_ratio voxel-grid candidates per centroid.
+    """
     data_batch = default_collate(batch)
     with torch.no_grad():
-        xyz = data_batch.get('points').cuda(non_blocking=True)
+        xyz = data_batch.get('points').to(device, non_blocking=True)
         # ins_id, (batch_size, length)
-        ins_id = data_batch.get('ins_id').cuda(non_blocking=True)
+        ins_id = data_batch.get('ins_id').to(device, non_blocking=True)
+        if transform is not None:
+            # transpose inside
+            if 'boundary' in data_batch:
+                xyz, ins_id, data_batch['boundary'] = transform_with_boundary(transform, xyz, ins_id,
+                                                                              data_batch['boundary'])
+            else:
+                xyz, ins_id = transform(xyz, ins_id)
+            data_batch['points'] = xyz
+            data_batch['ins_id'] = ins_id
         batch_size, length = ins_id.size()
 
         # sample new points
@@ -28,40 +47,27 @@ def collate(batch, num_centroids, radius, num_neighbours,
         if sample_method == 'RND':
             centroid_index = torch.randint(low=0, high=length, size=(batch_size, num_centroids), device=ins_id.device)
         elif sample_method == 'LS':
-            linspace = torch.linspace(-1, 1, steps=int(1/radius), device=ins_id.device)
-            pseudo_centroids = torch.stack(torch.meshgrid(linspace, linspace, linspace), dim=0).view(1, 3, -1)
-            # pdist, [batch_size, num_centroids, length]
-            pdist = (xyz.unsqueeze(2) - pseudo_centroids.unsqueeze(3)).norm(dim=1)
+            # the point nearest to each occupied node of the grid in [-1, 1], int(1/radius) nodes per axis,
+            # but at least the two ends for large radii
+            num_nodes = max(int(1 / radius), 2)
+            voxel_size = 2.0 / (num_nodes - 1)
             # (batch_size, num_centroids)
-            _, centroid_index = pdist.min(dim=2)
+            centroid_index = voxel_grid_sample(xyz, voxel_size, num_centroids, low=-1.0)
         elif sample_method == 'WBS':
-            num_centroids *= 2
-            centroid_index = torch.randint(low=0, high=length, size=(batch_size, num_centroids), device=ins_id.device)
-            # (batch_size, 3, num_centroids)
-            centroid_xyz = _F.gather_points(xyz, centroid_index)
-            # (batch_size, num_centroids, num_neighbours)
-            neighbour_index, _ = _F.ball_query(xyz, centroid_xyz, radius, num_neighbours)
-            # (batch_size, 3, num_centroids, num_neighbours)
-            neighbour_xyz = _F.group_points(xyz, neighbour_index)
-
-            neighbour_centroid_index = (neighbour_xyz - centroid_xyz.unsqueeze(-1)).abs().sum(1).argmin(dim=-1)
-
-            resample_centroid_index = neighbour_index.gather(2, neighbour_centroid_index.unsqueeze(-1)).squeeze(-1)
-
-            # neighbour_label, (batch_size, num_centroids, num_neighbours)
-            neighbour_label = ins_id.gather(1, neighbour_index.view(batch_size, num_centroids*num_neighbours))
-            neighbour_label = neighbour_label.view(batch_size, num_centroids, num_neighbours)
-
-            # centroid_label, (batch_size, num_centroids, 1)
-            centroid_label = ins_id.gather(1, resample_centroid_index).view(batch_size, num_centroids, 1)
-            # (batch_size, num_centroids, num_neighbours)
-            neighbour_centroid_dist = (neighbour_xyz - centroid_xyz.unsqueeze(-1)).norm(1)
-            neighbour_centroid_dist = neighbour_centroid_dist * (neighbour_label != centroid_label.expand_as(neighbour_label)).float() + \
-                                      neighbour_centroid_dist.max() * (neighbour_label == centroid_label.expand_as(neighbour_label)).float()
-            # (batch_size, num_centroids)
-            neighbour_centroid_dist, _ = neighbour_centroid_dist.min(dim=-1)
-            _, select_centroid_index = neighbour_centroid_dist.topk(num_centroids//2, largest=False)
-            centroid_index = centroid_index.gather(1, select_centroid_index)
+            # keep the half of random candidates which are the nearest to boundaries of instances
+            candidate_index = torch.randint(low=0, high=length, size=(batch_size, num_centroids * 2), device=ins_id.device)
+            if 'boundary' in data_batch:
+                # cached by the dataset, which can be predicted without labels
+                boundary = data_batch['boundary'].to(device, non_blocking=True)
+            else:
+                # the dataset does not provide boundaries, e.g. built with boundary=''
+                boundary = knn_label_boundary(xyz, ins_id)
+            # (batch_size, num_centroids * 2)
+            candidate_dist = boundary_distance(xyz, candidate_index, boundary)
+            _, select_centroid_index = candidate_dist.topk(num_centroids, largest=False)
+            centroid_index = candidate_index.gather(1, select_centroid_index)
+        elif fps_ratio > 0.0:
+            centroid_index = _F.farthest_point_sample_voxel(xyz, num_centroids, fps_ratio)
         else:
             centroid_index = _F.farthest_point_sample(xyz, num_centroids)
         # (batch_size, 3, num_centroids)
@@ -144,7 +150,7 @@ def collate(batch, num_centroids, radius, num_neighbours,
         return data_batch
 
 
-def parse_augmentations(augmentations):
+def parse_augmentations(augmentations, batch=False):
     transform_list = []
     for aug in augmentations:
         if isinstance(aug, (list, tuple)):
@@ -153,22 +159,35 @@ def parse_augmentations(augmentations):
         else:
             method = aug
             args = []
+        if batch:
+            # e.g. Rotate -> BatchRotate
+            method = 'Batch' + method
         transform_list.append(getattr(T, method)(*args))
     return transform_list
 
 
-def build_dataloader(cfg, mode='train'):
-    assert mode in ['train', 'val', 'test']
-    is_train = (mode == 'train')
-    batch_size = cfg.TRAIN.BATCH_SIZE if is_train else cfg.TEST.BATCH_SIZE
+def build_batch_transform(cfg, mode='train'):
+    """Build the transform of batches, which takes (batch_size, length, 3) points and (batch_size, length) labels"""
+    augmentations = cfg.TRAIN.AUGMENTATION if mode == 'train' else cfg.TEST.AUGMENTATION
+    transform_list = parse_augmentations(augmentations, batch=True)
+    transform_list.append(T.BatchTranspose())
+    return T.BatchComposeSeg(transform_list)
 
-    if cfg.TASK == 'ins_seg_3d':
-        dataset = build_ins_seg_3d_dataset(cfg, mode)
-    else:
-        raise NotImplementedError('Unsupported task: {}'.format(cfg.TASK))
 
-    if cfg.DATASET.TYPE == 'PartNetInsSeg':
+def build_collate_fn(cfg, mode='train', device=None):
+    """Build the collate function of the dataset
+
+    Args:
+        device (str, optional): the device to generate regions.
+            By default, 'cpu' if there are DataLoader workers or no GPUs, otherwise the GPU of the process.
+
+    """
+    is_train = (mode == 'train')
+    if cfg.DATASET.TYPE in ['PartNetInsSeg', 'PartNetCompactInsSeg']:
         kwargs_dict = cfg.DATALOADER.KWARGS
+        if device is None:
+            # generate regions on cpu in workers if there are any
+            device = 'cpu' if cfg.DATALOADER.NUM_WORKERS > 0 else comm.get_device()
         collate_fn = partial(collate,
                              num_centroids=kwargs_dict.num_centroids,
                              radius=kwargs_dict.radius,
@@ -176,18 +195,53 @@ def build_dataloader(cfg, mode='train'):
                              with_renorm=kwargs_dict.with_renorm,
                              with_resample=kwargs_dict.with_resample if is_train else False,
                              with_shift=kwargs_dict.with_shift if is_train else False,
-                             sample_method=kwargs_dict.get('sample_method', 'FPS'))
+                             sample_method=kwargs_dict.get('sample_method', 'FPS'),
+                             device=device,
+                             transform=build_batch_transform(cfg, mode) if cfg.DATALOADER.BATCH_AUGMENTATION else None,
+                             fps_ratio=kwargs_dict.get('fps_ratio', 0.0))
     else:
         collate_fn = default_collate
+    return collate_fn
+
+
+def build_dataloader(cfg, mode='train'):
+    assert mode in ['train', 'val', 'test']
+    is_train = (mode == 'train')
+    batch_size = cfg.TRAIN.BATCH_SIZE if is_train else cfg.TEST.BATCH_SIZE
+
+    if cfg.TASK == 'ins_seg_3d':
+        dataset = build_ins_seg_3d_dataset(cfg, mode)
+    else:
+        raise NotImplementedError('Unsupported task: {}'.format(cfg.TASK))
+
+    collate_fn = build_collate_fn(cfg, mode)
+
+    # pinned batches are copied to GPU asynchronously
+    loader_kwargs = dict()
+    if cfg.DATALOADER.NUM_WORKERS > 0:
+        loader_kwargs['pin_memory'] = True
+        loader_kwargs['prefetch_factor'] = cfg.DATALOADER.PREFETCH_FACTOR
+        # keep per-worker caches of datasets across epochs
+        loader_kwargs['persistent_workers'] = True
     if is_train:
+        sampler = None
+        world_size = comm.get_world_size()
+        if world_size > 1:
+            # TRAIN.BATCH_SIZE is the total batch size of all the processes
+            assert batch_size % world_size == 0, '{} % {} != 0'.format(batch_size, world_size)
+            batch_size = batch_size // world_size
+            # call sampler.set_epoch before each epoch to shuffle differently
+            sampler = DistributedSampler(dataset, num_replicas=world_size, rank=comm.get_rank(), shuffle=True)
         dataloader = DataLoader(
             dataset,
             batch_size=batch_size,
-            shuffle=True,
+            shuffle=(sampler is None),
+            sampler=sampler,
             drop_last=cfg.DATALOADER.DROP_LAST,
             num_workers=cfg.DATALOADER.NUM_WORKERS,
             worker_init_fn=worker_init_fn,
             collate_fn=collate_fn,
+            **loader_kwargs
         )
     else:
         dataloader = DataLoader(
@@ -198,6 +252,7 @@ def build_dataloader(cfg, mode='train'):
             num_workers=cfg.DATALOADER.NUM_WORKERS,
             worker_init_fn=worker_init_fn,
             collate_fn=collate_fn,
+            **loader_kwargs
         )
 
     return dataloader
@@ -206,18 +261,32 @@ def build_dataloader(cfg, mode='train'):
 def build_ins_seg_3d_dataset(cfg, mode='train'):
     is_train = (mode == 'train')
 
-    augmentations = cfg.TRAIN.AUGMENTATION if is_train else cfg.TEST.AUGMENTATION
-    transform_list = parse_augmentations(augmentations)
-    transform_list.insert(0, T.ToTensor())
-    transform_list.append(T.Transpose())
-    transform = T.ComposeSeg(transform_list)
+    if cfg.DATASET.TYPE == 'PartNetRegionInsSeg':
+        # regions of a whole file are generated at once
+        transform = build_batch_transform(cfg, mode)
+    elif cfg.DATALOADER.BATCH_AUGMENTATION:
+        # augmented and transposed in collate
+        transform = T.ComposeSeg([T.ToTensor()])
+    else:
+        augmentations = cfg.TRAIN.AUGMENTATION if is_train else cfg.TEST.AUGMENTATION
+        transform_list = parse_augmentations(augmentations)
+        transform_list.insert(0, T.ToTensor())
+        transform_list.append(T.Transpose())
+        transform = T.ComposeSeg(transform_list)
 
     kwargs_dict = cfg.DATASET[cfg.DATASET.TYPE].get(mode.upper(), dict())
+    if cfg.DATALOADER.KWARGS.get('sample_method', 'FPS') == 'WBS' and cfg.DATASET.TYPE != 'PartNetRegionInsSeg':
+        # ground-truth boundaries are only used for training
+        kwargs_dict = dict(kwargs_dict, boundary='gt' if is_train else 'geometry')
 
     if cfg.DATASET.TYPE == 'PartNetInsSeg':
         dataset = PartNetInsSeg(root_dir=cfg.DATASET.ROOT_DIR,
                                 transform=transform,
                                 **kwargs_dict)
+    elif cfg.DATASET.TYPE == 'PartNetCompactInsSeg':
+        dataset = PartNetCompactInsSeg(root_dir=cfg.DATASET.ROOT_DIR,
+                                       transform=transform,
+                                       **kwargs_dict)
     elif cfg.DATASET.TYPE == 'PartNetRegionInsSeg':
         dataset = PartNetRegionInsSeg(root_dir=cfg.DATASET.ROOT_DIR,
                                       transform=transform,
@@ -0,0 +1,59 @@
+from collections import defaultdict
+
+
+class MetaCatalog(object):
+    """Hash indexes of meta data of a dataset
+
+    Each entry of meta data is a dict with at least 'shape' and 'level', and usually 'anno_id'.
+
+    Args:
+        meta_data (list of dict): meta data of shapes, in the order of the dataset
+
+    """
+
+    def __init__(self, meta_data):
+        self.meta_data = meta_data
+        # anno_id -> index
+        self.anno_id_index = dict()
+        # shape -> indices
+        self.shape_index = defaultdict(list)
+        # level -> indices
+        self.level_index = defaultdict(list)
+        for index, meta in enumerate(meta_data):
+            if 'anno_id' in meta:
+                self.anno_id_index[meta['anno_id']] = index
+            self.shape_index[meta.get('shape')].append(index)
+            self.level_index[meta.get('level')].append(index)
+
+    def index(self, anno_id):
+        """Return the index of a shape by anno_id"""
+        try:
+            return self.anno_id_index[anno_id]
+        except KeyError:
+            raise KeyError('{} not found'.format(anno_id))
+
+    def select(self, shape=None, level=None, anno_ids=None):
+        """Return sorted indices of shapes matching all the given conditions
+
+        Args:
+            shape (str or list of str, optional): categories
+            level (int or list of int, optional): levels
+            anno_ids (iterable of str, optional): anno_ids. Missing ones are ignored.
+
+        Returns:
+            list of int
+
+        """
+        indices = set(range(len(self.meta_data)))
+        if shape is not None:
+            shapes = [shape] if isinstance(shape, str) else shape
+            indices &= set(i for s in shapes for i in self.shape_index.get(s, []))
+        if level is not None:
+            levels = [level] if isinstance(level, int) else level
+            indices &= set(i for l in levels for i in self.level_index.get(l, []))
+        if anno_ids is not None:
+            indices &= set(self.anno_id_index[a] for a in anno_ids if a in self.anno_id_index)
+        return sorted(indices)
+
+    def __len__(self):
+        return len(self.meta_data)
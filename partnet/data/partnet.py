@@ -6,16 +6,117 @@ import json
 import h5py
 import numpy as np
 import torch
+from scipy.spatial import cKDTree
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
 
 from shaper.utils.pc_util import normalize_points as normalize_points_np
-from partnet.utils.torch_pc import group_points, select_points
+from partnet.data.catalog import MetaCatalog
+from partnet.utils.torch_pc import group_points, select_points, ball_query_kdtree
 from partnet.utils.torch_pc import normalize_points as normalize_points_torch
 from IPython import embed
 
 
+def get_boundary(points, ins_id=None, k=16, ratio=0.1):
+    """Find boundary points of a shape
+
+    With instance ids, a point is on the boundary if any of its k nearest neighbours belongs to another instance.
+    Otherwise, the boundary is predicted by geometry, as the points with the largest surface variation.
+
+    Args:
+        points (np.ndarray): (num_points, 3)
+        ins_id (np.ndarray, optional): (num_points,)
+        k (int): the number of neighbours
+        ratio (float): the ratio of boundary points predicted by geometry
+
+    Returns:
+        np.ndarray: (num_points,), bool
+
+    """
+    _, knn_index = cKDTree(points).query(points, k=k + 1)
+    if ins_id is not None:
+        return (ins_id[knn_index] != ins_id[:, None]).any(axis=1)
+    neighbours = points[knn_index] - points[knn_index].mean(axis=1, keepdims=True)
+    cov = np.einsum('nki,nkj->nij', neighbours, neighbours)
+    # ascending eigenvalues
+    eigval = np.linalg.eigvalsh(cov)
+    variation = eigval[:, 0] / (eigval.sum(axis=1) + 1e-12)
+    return variation >= np.quantile(variation, 1.0 - ratio)
+
+
+def transform_with_boundary(transform, points, ins_id, boundary):
+    """Apply a transform to points and instance ids, and reorder boundary points in the same way
+
+    Transforms which reorder points (Shuffle, Sample, RandomDropout and their batch versions) only take labels
+    besides points. Thus, the index of each point is encoded into its label, and decoded after the transform.
+    Points dropped by RandomDropout keep the ignored label, and are not on the boundary.
+
+    Args:
+        transform: a transform of (points, labels)
+        points: (num_points, 3) or (batch_size, num_points, 3)
+        ins_id (np.ndarray or torch.Tensor): (num_points,) or (batch_size, num_points), non-negative
+        boundary (np.ndarray or torch.Tensor): the same shape as ins_id, 1 for boundary points
+
+    Returns:
+        points, ins_id, boundary: transformed
+
+    """
+    num_points = ins_id.shape[-1]
+    base = int(ins_id.max()) + 1
+    if isinstance(ins_id, torch.Tensor):
+        point_index = torch.arange(num_points, device=ins_id.device).expand_as(ins_id)
+    else:
+        point_index = np.arange(num_points)
+    points, label = transform(points, point_index * base + ins_id)
+    valid = label >= 0
+    point_index = label // base
+    if isinstance(label, torch.Tensor):
+        ins_id = torch.where(valid, label % base, label)
+        boundary = boundary.to(label.device).gather(-1, point_index.clamp(min=0)) * valid.type_as(boundary)
+    else:
+        ins_id = np.where(valid, label % base, label)
+        boundary = boundary[np.maximum(point_index, 0)] * valid.astype(boundary.dtype)
+    return points, ins_id, boundary
+
+
+def get_gt_label(gt_mask, gt_valid, gt_mask_label):
+    """Reconstruct per-point semantic labels from instance masks of the test split
+
+    Each point takes the label of the last valid instance covering it, and 0 if none.
+
+    Args:
+        gt_mask (np.ndarray): (n, num_ins, num_points), bool
+        gt_valid (np.ndarray): (n, num_ins). Valid instances come first.
+        gt_mask_label (np.ndarray): (n, num_ins), semantic labels of instances
+
+    Returns:
+        np.ndarray: (n, num_points), uint8
+
+    """
+    num_valid = np.sum(gt_valid, axis=1)
+    # instances after the valid ones are never scanned
+    max_valid = int(num_valid.max()) if num_valid.size > 0 else 0
+    # 1-based indices of valid instances, and 0 for invalid ones
+    ins_index = np.arange(1, max_valid + 1)
+    ins_index = np.where(ins_index[None, :] <= num_valid[:, None], ins_index, 0).astype(np.uint8)
+    # (n, num_points), the index of the last valid instance covering each point
+    last_ins = (gt_mask[:, :max_valid] * ins_index[:, :, None]).max(axis=1, initial=0)
+    gt_mask_label = np.concatenate([np.zeros_like(gt_mask_label[:, :1]), gt_mask_label], axis=1)
+    return np.take_along_axis(gt_mask_label, last_ins.astype(np.int64), axis=1).astype(np.uint8)
+
+
 class PartNetInsSeg(Dataset):
+    """PartNet instance segmentation
+
+    Args:
+        boundary (str): if not empty, boundary points are provided for boundary-weighted sampling.
+            'gt': from ground-truth instances. 'geometry': predicted by geometry, without labels.
+            They are computed once for each shape and cached in each process.
+        anno_ids (list of str or str, optional): only load these shapes, e.g. to debug a few shapes
+            or shard a split. A str is the path to a file with one anno_id per line.
+            Files without any of them are skipped, and only the needed rows are read.
+
+    """
     cat_file = './shape_names.txt'
 
     def __init__(self,
@@ -26,8 +127,11 @@ class PartNetInsSeg(Dataset):
                  shape='',
                  stage1='',
                  level=-1,
-                 cache_mode=True
+                 cache_mode=True,
+                 boundary='',
+                 anno_ids=None,
                  ):
+        assert boundary in ['', 'gt', 'geometry']
         self.root_dir = root_dir
         self.split = split
         self.normalize = normalize
@@ -35,10 +139,19 @@ class PartNetInsSeg(Dataset):
         self.shape_levels = self._load_cat_file()
         self.cache_mode = cache_mode
         self.folder_list = self._prepare_file_list(shape, level)
+        self.anno_ids = self._load_anno_ids(anno_ids)
+
+        self.boundary = boundary
+        # index -> packed bits of boundary points
+        self._boundary_cache = {}
 
         self.cache = defaultdict(list)
         self.meta_data = []
         self._load_data()
+        self.catalog = MetaCatalog(self.meta_data)
+        if self.anno_ids is not None and len(self.catalog.anno_id_index) < len(self.anno_ids):
+            print('{:s}: {} anno_ids not found'.format(
+                self.__class__.__name__, len(self.anno_ids) - len(self.catalog.anno_id_index)))
         print('{:s}: with {} shapes'.format(
             self.__class__.__name__,  len(self.meta_data)))
 
@@ -53,6 +166,34 @@ class PartNetInsSeg(Dataset):
                 shape_levels[shape] = levels
         return shape_levels
 
+    @staticmethod
+    def _load_anno_ids(anno_ids):
+        if anno_ids is None or len(anno_ids) == 0:
+            return None
+        if isinstance(anno_ids, str):
+            with open(anno_ids, 'r') as fid:
+                anno_ids = [line.strip() for line in fid if line.strip()]
+        return set(str(anno_id) for anno_id in anno_ids)
+
+    def _select_rows(self, meta_data_list):
+        """Return rows of a file to load, or None for all the rows"""
+        if self.anno_ids is None:
+            return None
+        return [ind for ind, meta_data in enumerate(meta_data_list) if meta_data.get('anno_id') in self.anno_ids]
+
+    def _append_meta_data(self, folder, path, num_samples, meta_data_list, rows=None):
+        shape, level = folder.rsplit('-', 1)
+        for ind in (range(num_samples) if rows is None else rows):
+            meta_data = {
+                'offset': ind,
+                'size': num_samples,
+                'path': path,
+            }
+            if ind < len(meta_data_list):
+                meta_data.update(meta_data_list[ind])
+            meta_data.update(shape=shape, level=int(level))
+            self.meta_data.append(meta_data)
+
     def _prepare_file_list(self, shape, level):
         shape = shape if len(shape) > 0 else None
         level = level if level > 0 else None
@@ -97,59 +238,52 @@ class PartNetInsSeg(Dataset):
                 if fname.startswith(self.split) and fname.endswith('h5'):
                     if self.split=='test':
                         folder_path = folder_path.replace('for_detection', 'gt')
-                        data_path = osp.join(folder_path, fname)
+                    data_path = osp.join(folder_path, fname)
+                    with open(data_path.replace('.h5', '.json')) as f:
+                        meta_data_list = json.load(f)
+                    rows = self._select_rows(meta_data_list)
+                    if rows is not None and len(rows) == 0:
+                        continue
+                    # h5py reads selected rows by increasing indices
+                    sel = slice(None) if rows is None else rows
+                    if self.split=='test':
                         print('loading {}'.format(data_path))
                         with h5py.File(data_path, mode='r') as f:
                             num_samples = f['pts'].shape[0]
                             if self.cache_mode:
                                 # point cloud [N, 10000, 3]
-                                self.cache['points'].append(f['pts'][:])
+                                self.cache['points'].append(f['pts'][sel])
                                 # instance idx [N, 200, 10000]
-                                self.cache['gt_mask'].append(f['gt_mask'][:])
+                                gt_mask = f['gt_mask'][sel]
+                                self.cache['gt_mask'].append(gt_mask)
                                 # valid class indicator [N, 200]
-                                self.cache['gt_valid'].append(f['gt_mask_valid'][:])
+                                gt_valid = f['gt_mask_valid'][sel]
+                                self.cache['gt_valid'].append(gt_valid)
                                 # valid class indicator [N, 10000]
-                                self.cache['gt_other_mask'].append(f['gt_mask_other'][:])
-                                gt_valid = f['gt_mask_valid'][:]
-                                gt_mask = f['gt_mask'][:]
-                                gt_label = f['gt_mask_label'][:]
-                                real_gt_label = np.zeros([gt_label.shape[0], 10000]).astype(np.uint8)
-                                for i in range(real_gt_label.shape[0]):
-                                    for j in range(np.sum(gt_valid[i])):
-                                        real_gt_label[i][gt_mask[i,j]] = gt_label[i,j]
+                                self.cache['gt_other_mask'].append(f['gt_mask_other'][sel])
                                 # semantics class [N, 10000]
-                                self.cache['gt_label'].append(real_gt_label)
+                                if 'gt_label' in f:
+                                    # stored by tools/convert_partnet_compact.py --gt-label
+                                    self.cache['gt_label'].append(f['gt_label'][sel])
+                                else:
+                                    self.cache['gt_label'].append(get_gt_label(gt_mask, gt_valid,
+                                                                               f['gt_mask_label'][sel]))
                     else:
-                        data_path = osp.join(folder_path, fname)
                         print('loading {}'.format(data_path))
                         with h5py.File(data_path, mode='r') as f:
                             num_samples = f['pts'].shape[0]
                             if self.cache_mode:
                                 # point cloud [N, 10000, 3]
-                                self.cache['points'].append(f['pts'][:])
+                                self.cache['points'].append(f['pts'][sel])
                                 # semantics class [N, 10000]
-                                self.cache['gt_label'].append(f['gt_label'][:])
+                                self.cache['gt_label'].append(f['gt_label'][sel])
                                 # instance idx [N, 200, 10000]
-                                self.cache['gt_mask'].append(f['gt_mask'][:])
+                                self.cache['gt_mask'].append(f['gt_mask'][sel])
                                 # valid class indicator [N, 200]
-                                self.cache['gt_valid'].append(f['gt_valid'][:])
+                                self.cache['gt_valid'].append(f['gt_valid'][sel])
                                 # valid class indicator [N, 10000]
-                                self.cache['gt_other_mask'].append(f['gt_other_mask'][:])
-                    for ind in range(num_samples):
-                        self.meta_data.append({
-                            'offset': ind,
-                            'size': num_samples,
-                            'path': data_path,
-                        })
-                    data_path = data_path.replace('.h5', '.json')
-                    print('loading {}'.format(data_path))
-                    with open(data_path) as f:
-                        meta_data_list = json.load(f)
-                        #assert num_samples == len(meta_data_list)
-                        for ind in range(num_samples):
-                            self.meta_data[len(self.meta_data) - num_samples + ind].update(
-                                meta_data_list[ind]
-                            )
+                                self.cache['gt_other_mask'].append(f['gt_other_mask'][sel])
+                    self._append_meta_data(folder, data_path, num_samples, meta_data_list, rows)
 
         for k, v in self.cache.items():
             self.cache[k] = np.concatenate(v, axis=0)
@@ -177,11 +311,15 @@ class PartNetInsSeg(Dataset):
         # 0 for ignore
         gt_all_mask = np.concatenate([gt_other_mask[None, :], gt_mask], axis=0)
         ins_id = gt_all_mask.argmax(axis=0)
+        boundary = self._get_boundary(index, points, ins_id) if self.boundary else None
 
         if self.normalize:
             points = normalize_points_np(points)
         if self.transform is not None:
-            points, ins_id = self.transform(points, ins_id)
+            if boundary is not None:
+                points, ins_id, boundary = transform_with_boundary(self.transform, points, ins_id, boundary)
+            else:
+                points, ins_id = self.transform(points, ins_id)
 
         out_dict = dict(
             points=points,
@@ -192,23 +330,154 @@ class PartNetInsSeg(Dataset):
             # gt_label=gt_label,
             # gt_other_mask=gt_other_mask
         )
+        if boundary is not None:
+            out_dict['boundary'] = boundary
 
         return out_dict
 
+    def _get_boundary(self, index, points, ins_id):
+        packed = self._boundary_cache.get(index)
+        if packed is None:
+            boundary = get_boundary(points, ins_id if self.boundary == 'gt' else None)
+            packed = np.packbits(boundary)
+            self._boundary_cache[index] = packed
+        return np.unpackbits(packed)[:points.shape[0]]
+
     def get(self, anno_id):
         assert isinstance(anno_id, str)
-        index = -1
-        for idx, meta_data in enumerate(self.meta_data):
-            if anno_id == meta_data['anno_id']:
-                index = idx
-                break
-        assert index > 0, '{} not found'.format(anno_id)
-        return self[index]
+        return self[self.catalog.index(anno_id)]
+
+    def subset(self, shape=None, level=None, anno_ids=None):
+        """Select loaded shapes by the catalog
+
+        Returns:
+            torch.utils.data.Subset
+
+        """
+        return Subset(self, self.catalog.select(shape=shape, level=level, anno_ids=anno_ids))
 
     def __len__(self):
         return len(self.meta_data)
 
 
+class PartNetCompactInsSeg(PartNetInsSeg):
+    """PartNet instance segmentation from the compact store
+
+    The store is converted from h5 files by tools/convert_partnet_compact.py.
+    For each h5 file, there are
+        <name>.points.npy: float32 [N, 10000, 3]
+        <name>.ins_id.npy: uint8 [N, 10000], 0 for ignore, k + 1 for the k-th ground-truth mask
+        <name>.gt_valid.npy: uint8 [N, 200], copied from h5 files
+        <name>.json: meta data
+    gt_mask is not stored since it is equal to one-hot ins_id.
+    For stores converted without gt_valid.npy, gt_valid is derived from ins_id, which misses valid instances
+    without any point in ins_id, i.e. empty ones or ones covered by gt_other_mask.
+
+    Args:
+        cache_mode (bool): if True, load all the arrays into memory.
+            Otherwise, they are memory-mapped lazily in each process, which is safe for DataLoader workers.
+            All the workers and concurrent experiments reading the same store share the OS page cache.
+
+    """
+
+    def _load_data(self):
+        # path -> np.memmap, opened on first access in each process
+        self._mmap = {}
+        # data prefixes with gt_valid.npy
+        self._gt_valid_prefixes = set()
+        for folder in self.folder_list:
+            folder_path = osp.join(self.root_dir, folder)
+            if self.split == 'test':
+                folder_path = folder_path.replace('for_detection', 'gt')
+            files = [f for f in os.listdir(folder_path) if f.startswith(self.split) and f.endswith('.points.npy')]
+            files.sort(key=lambda f: int(f.split('-')[-1].split('.')[0]))
+            for fname in files:
+                data_prefix = osp.join(folder_path, fname[:-len('.points.npy')])
+                with open(data_prefix + '.json') as f:
+                    meta_data_list = json.load(f)
+                rows = self._select_rows(meta_data_list)
+                if rows is not None and len(rows) == 0:
+                    continue
+                print('loading {}'.format(data_prefix))
+                points = np.load(data_prefix + '.points.npy', mmap_mode='r')
+                num_samples = points.shape[0]
+                has_gt_valid = osp.exists(data_prefix + '.gt_valid.npy')
+                if has_gt_valid:
+                    self._gt_valid_prefixes.add(data_prefix)
+                if self.cache_mode:
+                    sel = slice(None) if rows is None else rows
+                    # only the selected rows are read from the memory maps
+                    self.cache['points'].append(np.asarray(points[sel]))
+                    ins_id = np.asarray(np.load(data_prefix + '.ins_id.npy', mmap_mode='r')[sel])
+                    self.cache['ins_id'].append(ins_id)
+                    if has_gt_valid:
+                        self.cache['gt_valid'].append(np.load(data_prefix + '.gt_valid.npy')[sel])
+                    else:
+                        self.cache['gt_valid'].append(np.stack([self._derive_gt_valid(x) for x in ins_id]))
+                self._append_meta_data(folder, data_prefix, num_samples, meta_data_list, rows)
+
+        for k, v in self.cache.items():
+            self.cache[k] = np.concatenate(v, axis=0)
+
+    def __getitem__(self, index):
+        if self.cache_mode:
+            points = self.cache['points'][index]
+            ins_id = self.cache['ins_id'][index]
+            gt_valid = self.cache['gt_valid'][index]
+        else:
+            data_prefix = self.meta_data[index]['path']
+            ind = self.meta_data[index]['offset']
+            # copy out of the read-only memory map
+            points = np.array(self._get_mmap(data_prefix + '.points.npy')[ind])
+            ins_id = np.array(self._get_mmap(data_prefix + '.ins_id.npy')[ind])
+            if data_prefix in self._gt_valid_prefixes:
+                gt_valid = np.array(self._get_mmap(data_prefix + '.gt_valid.npy')[ind])
+            else:
+                gt_valid = self._derive_gt_valid(ins_id)
+
+        ins_id = ins_id.astype(np.int64)
+        boundary = self._get_boundary(index, points, ins_id) if self.boundary else None
+
+        if self.normalize:
+            points = normalize_points_np(points)
+        if self.transform is not None:
+            if boundary is not None:
+                points, ins_id, boundary = transform_with_boundary(self.transform, points, ins_id, boundary)
+            else:
+                points, ins_id = self.transform(points, ins_id)
+
+        out_dict = dict(
+            points=points,
+            ins_id=ins_id,
+            gt_valid=gt_valid,
+        )
+        if boundary is not None:
+            out_dict['boundary'] = boundary
+
+        return out_dict
+
+    @staticmethod
+    def _derive_gt_valid(ins_id):
+        gt_valid = np.zeros(200, dtype=np.uint8)
+        valid_id = np.unique(ins_id)
+        valid_id = valid_id[valid_id > 0]
+        gt_valid[valid_id - 1] = 1
+        return gt_valid
+
+    def _get_mmap(self, path):
+        mmap = self._mmap.get(path)
+        if mmap is None:
+            mmap = np.load(path, mmap_mode='r')
+            self._mmap[path] = mmap
+        return mmap
+
+    def __getstate__(self):
+        # Do not pickle memory maps (e.g. to spawned workers), which would copy the data.
+        state = self.__dict__.copy()
+        state['_mmap'] = {}
+        return state
+
+
 class PartNetRegionInsSeg(PartNetInsSeg):
 
     def __init__(self,
@@ -228,16 +497,9 @@ class PartNetRegionInsSeg(PartNetInsSeg):
         super(PartNetRegionInsSeg, self).__init__(**kwargs)
 
     def _batch_transform(self, points, seg_labels):
-        batch_size = points.size(0)
-        assert batch_size == seg_labels.size(0)
-        points_list = []
-        seg_labels_list = []
-        for i in range(batch_size):
-            p, s = self.transform(points[i], seg_labels[i])
-            points_list.append(p)
-            seg_labels_list.append(s)
-
-        return torch.stack(points_list), torch.stack(seg_labels_list)
+        """Augment the whole batch at once with batch transforms, e.g. T.BatchComposeSeg"""
+        assert points.size(0) == seg_labels.size(0)
+        return self.transform(points, seg_labels)
 
     def _gen_region(self, points, gt_mask, gt_other_mask):
         data_dict = dict()
@@ -259,17 +521,9 @@ class PartNetRegionInsSeg(PartNetInsSeg):
         centroid_index = torch.randint(low=0, high=length, size=(batch_size, self.num_centroids))
         # centroid, [batch_size, 3, num_centroids]
         centroid = select_points(points, centroid_index)
-        # TODO ball query
-        neighbour_index_list = []
-        for i in range(batch_size):
-            # pdist, [batch_size, num_centroids, length]
-            pdist = (points[i:i+1].unsqueeze(2) - centroid[i:i+1].unsqueeze(3)).norm(dim=1)
-            # (batch_size, num_centroids, num_neighbours)
-            neighbour_dist, neighbour_index = pdist.topk(self.num_neighbours, largest=False)
-            neighbour_index_i = (neighbour_dist < self.radius).long() * neighbour_index + \
-                                (neighbour_dist > self.radius).long() * centroid_index[i:i+1].unsqueeze(2)
-            neighbour_index_list.append(neighbour_index_i)
-        neighbour_index = torch.cat(neighbour_index_list)
+        # (batch_size, num_centroids, num_neighbours), neighbours out of the radius are replaced by centroids
+        neighbour_index = ball_query_kdtree(points, centroid, self.radius, self.num_neighbours,
+                                            fill_index=centroid_index)
         #
         # # pdist, [batch_size, num_centroids, length]
         # pdist = (points.unsqueeze(2) - centroid.unsqueeze(3)).norm(dim=1)
@@ -334,37 +588,30 @@ class PartNetRegionInsSeg(PartNetInsSeg):
             for fname in os.listdir(folder_path):
                 if fname.startswith(self.split) and fname.endswith('h5'):
                     data_path = osp.join(folder_path, fname)
+                    with open(data_path.replace('.h5', '.json')) as f:
+                        meta_data_list = json.load(f)
+                    rows = self._select_rows(meta_data_list)
+                    if rows is not None and len(rows) == 0:
+                        continue
+                    sel = slice(None) if rows is None else rows
                     print('loading {}'.format(data_path))
                     with h5py.File(data_path, mode='r') as f:
                         num_samples = f['pts'].shape[0]
+                        assert num_samples == len(meta_data_list)
                         # point cloud [N, 10000, 3]
-                        points = torch.from_numpy(f['pts'][:])
+                        points = torch.from_numpy(f['pts'][sel])
                         if self.normalize:
                             points = normalize_points_torch(points)
                         # instance idx [N, 200, 10000]
-                        gt_mask = torch.from_numpy(f['gt_mask'][:].astype(np.uint8))
+                        gt_mask = torch.from_numpy(f['gt_mask'][sel].astype(np.uint8))
                         # valid class indicator [N, 10000]
-                        gt_other_mask = torch.from_numpy(f['gt_other_mask'][:].astype(np.uint8))
+                        gt_other_mask = torch.from_numpy(f['gt_other_mask'][sel].astype(np.uint8))
 
                     data_dict = self._gen_region(points, gt_mask, gt_other_mask)
                     for k, v in data_dict.items():
                         self.cache[k].append(v)
 
-                    for ind in range(num_samples):
-                        self.meta_data.append({
-                            'offset': ind,
-                            'size': num_samples,
-                            'path': data_path,
-                        })
-                    data_path = data_path.replace('.h5', '.json')
-                    print('loading {}'.format(data_path))
-                    with open(data_path) as f:
-                        meta_data_list = json.load(f)
-                        assert num_samples == len(meta_data_list)
-                        for ind in range(num_samples):
-                            self.meta_data[len(self.meta_data) - num_samples + ind].update(
-                                meta_data_list[ind]
-                            )
+                    self._append_meta_data(folder, data_path, num_samples, meta_data_list, rows)
 
         for k, v in self.cache.items():
             self.cache[k] = torch.cat(v, dim=0)
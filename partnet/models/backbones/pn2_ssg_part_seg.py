@@ -34,6 +34,7 @@ class PointNet2SSGPartSeg(nn.Module):
         seg_channels (tuple of int): the numbers of channels in segmentation mlp
         dropout_prob (float): the probability to dropout input features
         use_xyz (bool): whether or not to use the xyz position of a points as a feature
+        fps_ratio (float): if positive, sample centroids approximately on voxel-grid candidates, about fps_ratio per centroid
 
     References:
         https://github.com/charlesq34/pointnet2/blob/master/models/pointnet2_part_seg.py
@@ -50,7 +51,8 @@ class PointNet2SSGPartSeg(nn.Module):
                  num_fp_neighbours=(0, 3, 3),
                  seg_channels=(32,),
                  dropout_prob=0.5,
-                 use_xyz=True):
+                 use_xyz=True,
+                 fps_ratio=0.0):
         super(PointNet2SSGPartSeg, self).__init__()
 
         self.in_channels = in_channels
@@ -74,7 +76,8 @@ class PointNet2SSGPartSeg(nn.Module):
                                          num_centroids=num_centroids[ind],
                                          radius=radius[ind],
                                          num_neighbours=num_neighbours[ind],
-                                         use_xyz=use_xyz)
+                                         use_xyz=use_xyz,
+                                         fps_ratio=fps_ratio)
             self.sa_modules.append(sa_module)
             feature_channels = sa_channels[ind][-1]
 
@@ -96,7 +99,7 @@ class PointNet2SSGPartSeg(nn.Module):
 
         self.reset_parameters()
 
-    def extract_feats(self, points):
+    def extract_feats(self, points, cache=None):
 
         xyz = points.narrow(1, 0, 3)
         if points.size(1) > 3:
@@ -109,10 +112,15 @@ class PointNet2SSGPartSeg(nn.Module):
         inter_feature = [points if self.use_xyz else feature]
 
         # Set Abstraction Layers
+        # xyz of each level only depends on sampling of previous modules, which keys the cache
+        inter_key = [()]
         for sa_module in self.sa_modules:
-            xyz, feature = sa_module(xyz, feature)
+            key = inter_key[-1] + sa_module.group_config
+            sa_cache = None if cache is None else cache.setdefault(key, {})
+            xyz, feature = sa_module(xyz, feature, cache=sa_cache)
             inter_xyz.append(xyz)
             inter_feature.append(feature)
+            inter_key.append(key)
 
         # Feature Propagation Layers
         sparse_xyz = xyz
@@ -120,7 +128,9 @@ class PointNet2SSGPartSeg(nn.Module):
         for fp_ind, fp_module in enumerate(self.fp_modules):
             dense_xyz = inter_xyz[-2 - fp_ind]
             dense_feature = inter_feature[-2 - fp_ind]
-            fp_feature = fp_module(dense_xyz, sparse_xyz, dense_feature, sparse_feature)
+            # the interpolation plan from the sparse level to the dense level
+            fp_cache = None if cache is None else cache.setdefault((inter_key[-2 - fp_ind], inter_key[-1 - fp_ind]), {})
+            fp_feature = fp_module(dense_xyz, sparse_xyz, dense_feature, sparse_feature, cache=fp_cache)
             sparse_xyz = dense_xyz
             sparse_feature = fp_feature
 
@@ -129,9 +139,9 @@ class PointNet2SSGPartSeg(nn.Module):
 
         return x
 
-    def forward(self, points):
+    def forward(self, points, cache=None):
         preds = {
-            'feature': self.extract_feats(points),
+            'feature': self.extract_feats(points, cache=cache),
         }
 
         return preds
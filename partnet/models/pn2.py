@@ -191,32 +191,59 @@ class PointNetCls(nn.Module):
         self.reset_parameters()
 
     def forward(self, x, infer_type, y=None):
+        """Forward a branch, or several branches on the same input
 
+        Args:
+            x (torch.Tensor): the input
+            infer_type (str or tuple of str): the branch(es).
+                For a tuple, PointNet++ branches ('backbone', 'backbone2', 'policy', 'purity') share
+                farthest point sampling and ball query of x, and only their MLPs run separately.
+            y (tuple of tuple of torch.Tensor, optional): global features of the verification heads
+                ('head', 'head2'). If given, x is only xyz, and see stem_with_global_features.
+
+        Returns:
+            torch.Tensor, or tuple of torch.Tensor for a tuple of branches
+
+        """
+        if isinstance(infer_type, (tuple, list)):
+            cache = {}
+            return tuple(self._forward(x, t, cache) for t in infer_type)
+        return self._forward(x, infer_type, y=y)
+
+    def _forward(self, x, infer_type, cache=None, y=None):
         if infer_type == 'backbone':
-            x = self.p1(x)
+            x = self.p1(x, cache)
             x = self.classifier1(x)
         elif infer_type == 'backbone2':
-            x = self.p2(x)
+            x = self.p2(x, cache)
             x = self.classifier2(x)
         elif infer_type == 'policy':
-            x = self.p3(x)
+            x = self.p3(x, cache)
             x = self.classifier3(x)
         elif infer_type =='policy_head':
             x = self.mlp_global22(x)
             x = self.classifier22(x)
         elif infer_type == 'purity':
-            x = self.p4(x)
+            x = self.p4(x, cache)
             x = self.classifier4(x)
             x = self.sigmoid(x)
         elif infer_type == 'head':
-            x, end_points = self.stem8(x)
+            if y is None:
+                x, end_points = self.stem8(x)
+            else:
+                x = self.stem_with_global_features(self.stem8, x, y)
+                end_points = {}
             x = self.mlp_local8(x)
             x, max_indices = torch.max(x, 2)
             end_points['key_point_indices'] = max_indices
             x = self.mlp_global8(x)
             x = self.classifier8(x)
         elif infer_type == 'head2':
-            x, end_points = self.stem9(x)
+            if y is None:
+                x, end_points = self.stem9(x)
+            else:
+                x = self.stem_with_global_features(self.stem9, x, y)
+                end_points = {}
             x = self.mlp_local9(x)
             x, max_indices = torch.max(x, 2)
             end_points['key_point_indices'] = max_indices
@@ -227,6 +254,58 @@ class PointNetCls(nn.Module):
 
         return x
 
+    @staticmethod
+    def stem_with_global_features(stem, xyz, global_features):
+        """Stem on xyz concatenated with global features broadcast to points, without broadcasting
+
+        The first layer is linear, so the weights of xyz are applied to points,
+        and the weights of global features are applied once per segment of points as a bias.
+        It is equivalent to stem(torch.cat([xyz, broadcast global features], dim=1)).
+
+        Args:
+            stem (Stem): the stem without transform
+            xyz (torch.Tensor): (batch_size, 3, num_points)
+            global_features (tuple of tuple of torch.Tensor): groups of global features in the order of channels.
+                Each group is a tuple of (batch_size, channels) tensors, broadcast to consecutive segments
+                which evenly split points, e.g. ((logits1, logits2), (context_logits,)).
+
+        Returns:
+            torch.Tensor: (batch_size, stem_channels[-1], num_points)
+
+        """
+        assert not stem.with_transform
+        if not isinstance(stem.mlp, SharedMLP):
+            # e.g. quantized, whose weights can not be split
+            feature = [xyz]
+            for features in global_features:
+                segment_size = xyz.size(2) // len(features)
+                feature.append(torch.cat([f.unsqueeze(2).expand(-1, -1, segment_size) for f in features], dim=2))
+            return stem(torch.cat(feature, dim=1))[0]
+        first_layer = stem.mlp[0]
+        weight = first_layer.conv.weight.squeeze(2)  # (out_channels, in_channels)
+        in_channels = xyz.size(1)
+        x = F.conv1d(xyz, first_layer.conv.weight[:, :in_channels], first_layer.conv.bias)
+        batch_size, out_channels, num_points = x.size()
+        for features in global_features:
+            num_segments = len(features)
+            assert num_points % num_segments == 0
+            # (batch_size, num_segments, channels)
+            features = torch.stack(features, dim=1)
+            channels = features.size(2)
+            bias = torch.matmul(features, weight[:, in_channels:in_channels + channels].t())
+            # add to each segment of points in place, (batch_size, out_channels, num_segments, segment_size)
+            x.view(batch_size, out_channels, num_segments, -1).add_(bias.transpose(1, 2).unsqueeze(3))
+            in_channels += channels
+        assert in_channels == stem.in_channels
+
+        if first_layer.bn is not None:
+            x = first_layer.bn(x)
+        if first_layer.relu is not None:
+            x = first_layer.relu(x)
+        for ind in range(1, len(stem.mlp)):
+            x = stem.mlp[ind](x)
+        return x
+
     def reset_parameters(self):
         # default initialization in original implementation
         self.p1.reset_parameters()
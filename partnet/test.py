@@ -30,6 +30,7 @@ from shaper.data import transforms as T
 from IPython import embed
 import shaper.models.pointnet2.functions as _F
 from partnet.models.pn2 import PointNetCls
+from partnet.utils.proposal_cache import ProposalCache
 import torch.nn.functional as F
 
 from core.nn.functional import cross_entropy
@@ -131,6 +132,25 @@ def test(cfg, output_dir='', output_dir_merge='', output_dir_save=''):
     test_dataloader = build_dataloader(cfg, mode='test')
     test_dataset = test_dataloader.dataset
 
+    # build proposal cache
+    if cfg.TEST.PROPOSAL_CACHE_DIR and cfg.RNG_SEED < 0:
+        # proposals of unseeded runs differ from run to run, and can not be reused
+        logger.warning('Proposal cache is disabled since RNG_SEED < 0.')
+        proposal_cache = None
+    elif cfg.TEST.PROPOSAL_CACHE_DIR:
+        proposal_cache = ProposalCache(cfg.TEST.PROPOSAL_CACHE_DIR,
+                                       sampler_cfg=dict(dataset=cfg.DATASET.TYPE,
+                                                        dataset_kwargs=dict(cfg.DATASET[cfg.DATASET.TYPE].get('TEST', {})),
+                                                        kwargs=dict(cfg.DATALOADER.KWARGS),
+                                                        augmentation=cfg.TEST.AUGMENTATION,
+                                                        seed=cfg.RNG_SEED),
+                                       checkpoint_files=[weight_path if cfg.TEST.WEIGHT else checkpointer.get_checkpoint_file(),
+                                                         checkpointer_merge.get_checkpoint_file()])
+        logger.info('Proposal cache: {}'.format(proposal_cache.cache_dir))
+        logger.info('Stage-1 losses and metrics are not computed with the proposal cache.')
+    else:
+        proposal_cache = None
+
     assert cfg.TEST.BATCH_SIZE == 1, '{} != 1'.format(cfg.TEST.BATCH_SIZE)
     save_fig_dir = osp.join(output_dir_save, 'test_fig')
     os.makedirs(save_fig_dir, exist_ok=True)
@@ -170,6 +190,7 @@ def test(cfg, output_dir='', output_dir_merge='', output_dir_save=''):
     tot_mean_policy_label0_small = list()
     tot_mean_label_policy0_large = list()
     tot_mean_label_policy0_small = list()
+    num_cache_hits = 0
     with torch.no_grad():
         start_time = time.time()
         end = start_time
@@ -181,53 +202,69 @@ def test(cfg, output_dir='', output_dir_merge='', output_dir_save=''):
 
             data_batch = {k: v.cuda(non_blocking=True) for k, v in data_batch.items()}
 
-            preds = model(data_batch)
-            loss_dict = loss_fn(preds, data_batch)
-            meters.update(**loss_dict)
-            val_metric.update_dict(preds, data_batch)
-
-            #extraction box features
-            batch_size, _, num_centroids, num_neighbours = data_batch['neighbour_xyz'].shape
-            num_points = data_batch['points'].shape[-1]
-
-            #batch_size, num_centroid, num_neighbor
-            _, p = torch.max(preds['ins_logit'], 1)
-            box_index_expand = torch.zeros((batch_size*num_centroids, num_points)).cuda()
-            box_index_expand = box_index_expand.scatter_(dim=1, index=data_batch['neighbour_index'].reshape([-1, num_neighbours]), src=p.reshape([-1, num_neighbours]).float())
-            #centroid_label = data_batch['centroid_label'].reshape(-1)
-
-            minimum_box_pc_num = 16
+            #stage 1 is skipped if proposals of this shape are cached
+            shape_id = test_dataset.meta_data[iteration].get('anno_id', str(iteration))
+            proposal = proposal_cache.get(shape_id) if proposal_cache is not None else None
+            num_cache_hits += proposal is not None
             minimum_overlap_pc_num = 16 #1/16 * num_neighbour
-            gtmin_mask = (torch.sum(box_index_expand, dim=-1) > minimum_box_pc_num)
-
-            #remove purity < 0.8
-            box_label_expand = torch.zeros((batch_size*num_centroids, 200)).cuda()
-            purity_pred = torch.zeros([0]).type(torch.LongTensor).cuda()
-            purity_pred_float = torch.zeros([0]).type(torch.FloatTensor).cuda()
-
-            for i in range(batch_size):
-                cur_xyz_pool, xyz_mean = mask_to_xyz(data_batch['points'][i], box_index_expand.view(batch_size,num_centroids,num_points)[i], sample_num=512)
-                cur_xyz_pool -= xyz_mean
-                cur_xyz_pool /=(cur_xyz_pool+1e-6).norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+            if proposal is None:
+                preds = model(data_batch)
+                # skipped with the cache, since cached shapes would be missing from them
+                if proposal_cache is None:
+                    loss_dict = loss_fn(preds, data_batch)
+                    meters.update(**loss_dict)
+                    val_metric.update_dict(preds, data_batch)
+
+                #extraction box features
+                batch_size, _, num_centroids, num_neighbours = data_batch['neighbour_xyz'].shape
+                num_points = data_batch['points'].shape[-1]
+
+                #batch_size, num_centroid, num_neighbor
+                _, p = torch.max(preds['ins_logit'], 1)
+                box_index_expand = torch.zeros((batch_size*num_centroids, num_points)).cuda()
+                box_index_expand = box_index_expand.scatter_(dim=1, index=data_batch['neighbour_index'].reshape([-1, num_neighbours]), src=p.reshape([-1, num_neighbours]).float())
+                #centroid_label = data_batch['centroid_label'].reshape(-1)
+
+                minimum_box_pc_num = 16
+                gtmin_mask = (torch.sum(box_index_expand, dim=-1) > minimum_box_pc_num)
+
+                #remove purity < 0.8
+                box_label_expand = torch.zeros((batch_size*num_centroids, 200)).cuda()
+                purity_pred = torch.zeros([0]).type(torch.LongTensor).cuda()
+                purity_pred_float = torch.zeros([0]).type(torch.FloatTensor).cuda()
+
+                for i in range(batch_size):
+                    cur_xyz_pool, xyz_mean = mask_to_xyz(data_batch['points'][i], box_index_expand.view(batch_size,num_centroids,num_points)[i], sample_num=512)
+                    cur_xyz_pool -= xyz_mean
+                    cur_xyz_pool /=(cur_xyz_pool+1e-6).norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
                 
-                logits_purity = model_merge(cur_xyz_pool, 'purity')
-                p = (logits_purity > 0.8).long().squeeze()
-                purity_pred = torch.cat([purity_pred,p])
-                purity_pred_float = torch.cat([purity_pred_float,logits_purity.squeeze()])
-
-            p_thresh = 0.8
-            purity_pred = purity_pred_float > p_thresh
-            #in case remove too much
-            while(torch.sum(purity_pred) < 48):
-                p_thresh = p_thresh-0.01
-                purity_pred = purity_pred_float > p_thresh
-            valid_mask = gtmin_mask.long() *  purity_pred.long()
-            box_index_expand = torch.index_select(box_index_expand, dim=0, index=valid_mask.nonzero().squeeze())
-
-            box_num = torch.sum(valid_mask.reshape(batch_size, num_centroids),1)
-            cumsum_box_num = torch.cumsum(box_num, dim=0)
-            cumsum_box_num = torch.cat([torch.from_numpy(np.array(0)).cuda().unsqueeze(0),cumsum_box_num],dim=0)
+                    logits_purity = model_merge(cur_xyz_pool, 'purity')
+                    p = (logits_purity > 0.8).long().squeeze()
+                    purity_pred = torch.cat([purity_pred,p])
+                    purity_pred_float = torch.cat([purity_pred_float,logits_purity.squeeze()])
 
+                p_thresh = 0.8
+                purity_pred = purity_pred_float > p_thresh
+                #in case remove too much
+                while(torch.sum(purity_pred) < 48):
+                    p_thresh = p_thresh-0.01
+                    purity_pred = purity_pred_float > p_thresh
+                valid_mask = gtmin_mask.long() *  purity_pred.long()
+                box_index_expand = torch.index_select(box_index_expand, dim=0, index=valid_mask.nonzero().squeeze())
+
+                box_num = torch.sum(valid_mask.reshape(batch_size, num_centroids),1)
+                cumsum_box_num = torch.cumsum(box_num, dim=0)
+                cumsum_box_num = torch.cat([torch.from_numpy(np.array(0)).cuda().unsqueeze(0),cumsum_box_num],dim=0)
+                if proposal_cache is not None:
+                    proposal_cache.put(shape_id, box_index_expand.cpu().numpy(), p_thresh=p_thresh)
+            else:
+                num_points = data_batch['points'].shape[-1]
+                box_index_expand = torch.from_numpy(proposal['masks']).float().cuda()
+                cumsum_box_num = torch.tensor([0, box_index_expand.shape[0]]).cuda()
+                p_thresh = float(proposal['p_thresh'])
+
+            # reseed so that grouping draws the same random numbers whether stage 1 ran or was cached
+            set_random_seed(cfg.RNG_SEED + iteration if cfg.RNG_SEED >= 0 else cfg.RNG_SEED)
             with torch.no_grad():
                 pc_all = data_batch['points']
                 xyz_pool1 = torch.zeros([0,3,1024]).float().cuda()
@@ -340,12 +377,12 @@ def test(cfg, output_dir='', output_dir_merge='', output_dir_save=''):
                         if (cur_xyz_pool.shape[0] >= 32):
                             logits1 = model_merge(part_xyz1,'backbone')
                             logits2 = model_merge(part_xyz2,'backbone')
-                            merge_logits = model_merge(torch.cat([part_xyz, torch.cat([logits1.unsqueeze(-1).expand(-1,-1,part_xyz1.shape[-1]), logits2.unsqueeze(-1).expand(-1,-1,part_xyz2.shape[-1])], dim=-1)], dim=1), 'head')
+                            merge_logits = model_merge(part_xyz, 'head', ((logits1, logits2),))
                         else:
                             logits1 = model_merge(part_xyz1,'backbone')
                             logits2 = model_merge(part_xyz2,'backbone')
                             context_logits = model_merge(context_xyz,'backbone2')
-                            merge_logits = model_merge(torch.cat([part_xyz, torch.cat([logits1.unsqueeze(-1).expand(-1,-1,part_xyz1.shape[-1]), logits2.unsqueeze(-1).expand(-1,-1,part_xyz2.shape[-1])], dim=-1), torch.cat([context_logits.unsqueeze(-1).expand(-1,-1,part_xyz.shape[-1])], dim=-1)], dim=1), 'head2')
+                            merge_logits = model_merge(part_xyz, 'head2', ((logits1, logits2), (context_logits,)))
 
                         _, p = torch.max(merge_logits, 1)
                         siamese_label = p*((purity_score>p_thresh).long())
@@ -482,6 +519,8 @@ def test(cfg, output_dir='', output_dir_merge='', output_dir_save=''):
 
     test_time = time.time() - start_time
     logger.info('Test {}  test time: {:.2f}s'.format(meters.summary_str, test_time))
+    if num_cache_hits > 0:
+        logger.info('Proposals of {}/{} shapes are loaded from the cache.'.format(num_cache_hits, n_shape))
     for i in range(int(out_mask.shape[0]/1024) +1):
         save_h5(os.path.join(output_dir_save, 'test-%02d.h5'%(i)), out_mask[i*1024:(i+1)*1024], out_valid[i*1024:(i+1)*1024], out_conf[i*1024:(i+1)*1024])
 
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""Test a batch of category/level configs with a pool of resident workers
+
+Each worker process is pinned to a GPU and keeps its models alive across jobs.
+Weights are only reloaded when the checkpoint changes, so jobs of the same level share them.
+Jobs are sorted by level, and results of each category are saved as partnet/test_remote.py does.
+A timing summary of all the jobs is saved in json.
+"""
+
+from __future__ import division
+import os
+import os.path as osp
+import sys
+
+sys.path.insert(0, osp.dirname(__file__) + '/..')
+
+import argparse
+import glob
+import json
+import logging
+import multiprocessing as mp
+import time
+import traceback
+
+import torch
+
+from core.config import purge_cfg
+from core.utils.checkpoint import Checkpointer
+from core.utils.io import get_md5
+from core.utils.logger import setup_logger
+
+from partnet.test_remote import build_test_models, get_output_dirs, test
+
+# models of the worker process
+_models = dict()
+# md5 of the weights loaded into each model
+_loaded = dict()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PyTorch 3D Deep Learning Batch Test')
+    parser.add_argument(
+        '--cfg',
+        dest='config_files',
+        required=True,
+        metavar='FILE',
+        help='path or glob pattern of config files, repeated for more configs',
+        action='append',
+        type=str,
+    )
+    parser.add_argument(
+        '-j', '--num-workers',
+        default=0,
+        type=int,
+        help='the number of worker processes. 0 for one per GPU',
+    )
+    parser.add_argument(
+        '--local-levels',
+        default='3',
+        metavar='LEVELS',
+        help='comma-separated levels grouped without remote pairs, the same as partnet/test.py',
+        type=str,
+    )
+    parser.add_argument(
+        '--summary',
+        default='./results/batch_summary.json',
+        type=str,
+        help='path to save the timing summary',
+    )
+    parser.add_argument(
+        'opts',
+        help='Modify config options using the command-line',
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def load_cfg(config_file, opts):
+    from partnet.config.ins_seg_3d import cfg
+    cfg = cfg.clone()
+    cfg.merge_from_file(config_file)
+    cfg.merge_from_list(opts)
+    purge_cfg(cfg)
+    cfg.freeze()
+    return cfg
+
+
+def _init_worker(device_queue):
+    device_id = device_queue.get()
+    if device_id is not None:
+        # before CUDA is initialized in this process
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(device_id)
+    setup_logger('shaper', '', timestamp=False)
+
+
+def _load_weights(name, checkpointer, weight_path=None):
+    """Load weights unless the same checkpoint is loaded"""
+    checkpoint_file = weight_path if weight_path else checkpointer.get_checkpoint_file()
+    md5 = get_md5(checkpoint_file) if checkpoint_file and osp.exists(checkpoint_file) else None
+    if md5 is not None and _loaded.get(name) == md5:
+        return False
+    if weight_path:
+        checkpointer.load(weight_path, resume=False)
+    else:
+        checkpointer.load(None, resume=True)
+    _loaded[name] = md5
+    return True
+
+
+def run_job(job):
+    """Test a config in a worker process
+
+    Args:
+        job (tuple): config_file, opts, local_levels
+
+    Returns:
+        dict: the status and timing of the job
+
+    """
+    config_file, opts, local_levels = job
+    start_time = time.time()
+    result = {'config': config_file, 'pid': os.getpid(), 'device': os.environ.get('CUDA_VISIBLE_DEVICES', '')}
+    logger = logging.getLogger('shaper')
+    fh = None
+    try:
+        cfg = load_cfg(config_file, opts)
+        assert cfg.TASK == 'ins_seg_3d'
+        result.update(shape=cfg.DATASET.PartNetInsSeg.TEST.shape, level=cfg.TEST.LEVEL)
+        output_dir, output_dir_merge, output_dir_save = get_output_dirs(cfg, config_file)
+
+        # log each job into its own result directory
+        fh = logging.FileHandler(osp.join(output_dir_save, 'log.test_batch.{}.txt'.format(time.strftime('%m-%d_%H-%M-%S'))))
+        fh.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s'))
+        logger.addHandler(fh)
+        logger.info('Loaded configuration file {}'.format(config_file))
+        logger.info('Running with config:\n{}'.format(cfg))
+
+        # build models once for each model config
+        model_key = str(cfg.MODEL)
+        if model_key not in _models:
+            _models[model_key] = build_test_models(cfg)
+        models = _models[model_key]
+        model, _, _, model_merge = models
+        checkpointer = Checkpointer(model, save_dir=output_dir, logger=logger)
+        checkpointer_merge = Checkpointer(model_merge, save_dir=output_dir_merge, logger=logger)
+        if cfg.TEST.WEIGHT:
+            _load_weights((model_key, 'model'), checkpointer, cfg.TEST.WEIGHT.replace('@', output_dir))
+        else:
+            _load_weights((model_key, 'model'), checkpointer)
+            _load_weights((model_key, 'model_merge'), checkpointer_merge)
+        result['load_time'] = time.time() - start_time
+
+        test_start_time = time.time()
+        test(cfg, output_dir, output_dir_merge, output_dir_save, models=models,
+             remote=cfg.TEST.LEVEL not in local_levels)
+        result['test_time'] = time.time() - test_start_time
+        result['status'] = 'done'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+        logger.error('Failed to test {}\n{}'.format(config_file, result['error']))
+    finally:
+        if fh is not None:
+            logger.removeHandler(fh)
+            fh.close()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    result['total_time'] = time.time() - start_time
+    return result
+
+
+def main():
+    args = parse_args()
+    logger = setup_logger('shaper', '', timestamp=False)
+
+    config_files = []
+    for pattern in args.config_files:
+        config_files.extend(sorted(glob.glob(pattern)) or [pattern])
+    local_levels = tuple(int(x) for x in args.local_levels.split(',') if x)
+    # jobs of the same level run one after another, so that workers reuse weights
+    levels = {f: load_cfg(f, args.opts).TEST.LEVEL for f in config_files}
+    jobs = [(f, args.opts, local_levels) for f in sorted(config_files, key=lambda f: (levels[f], f))]
+
+    num_gpus = torch.cuda.device_count()
+    num_workers = args.num_workers if args.num_workers > 0 else max(num_gpus, 1)
+    num_workers = min(num_workers, len(jobs))
+    logger.info('Testing {} configs with {} workers on {} GPUs'.format(len(jobs), num_workers, num_gpus))
+
+    # spawn workers, because CUDA can not be used in forked processes
+    ctx = mp.get_context('spawn')
+    device_queue = ctx.Queue()
+    for i in range(num_workers):
+        device_queue.put(i % num_gpus if num_gpus > 0 else None)
+
+    results = []
+    start_time = time.time()
+    with ctx.Pool(num_workers, initializer=_init_worker, initargs=(device_queue,), maxtasksperchild=None) as pool:
+        for result in pool.imap_unordered(run_job, jobs, chunksize=1):
+            results.append(result)
+            logger.info('[{}/{}] {} {} in {:.2f}s'.format(len(results), len(jobs), result['config'],
+                                                          result['status'], result['total_time']))
+    wall_time = time.time() - start_time
+
+    results = sorted(results, key=lambda r: (r.get('level', -1), r['config']))
+    summary = {
+        'num_jobs': len(jobs),
+        'num_failed': sum(r['status'] != 'done' for r in results),
+        'num_workers': num_workers,
+        'wall_time': wall_time,
+        'total_test_time': sum(r.get('test_time', 0.0) for r in results),
+        'total_load_time': sum(r.get('load_time', 0.0) for r in results),
+        'jobs': results,
+    }
+    if osp.dirname(args.summary):
+        os.makedirs(osp.dirname(args.summary), exist_ok=True)
+    with open(args.summary, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    for r in results:
+        logger.info('{:<40s} {:>8s}  load {:8.2f}s  test {:8.2f}s'.format(
+            r['config'], r['status'], r.get('load_time', 0.0), r.get('test_time', 0.0)))
+    logger.info('{} jobs ({} failed) in {:.2f}s, summary saved to {}'.format(
+        summary['num_jobs'], summary['num_failed'], wall_time, args.summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Test all the levels of a shape category in a single pass
+
+Each shape is loaded once. Regions are generated and classified once for levels with the same sampling
+configuration, and the stage-1 proposals are shared by the grouping models of all the levels.
+Levels run from fine to coarse. By default, a coarser level continues grouping from the partition
+of the finer level, instead of regrouping the proposals from scratch. It only applies to levels grouping
+remote pairs, because parts of a partition do not overlap.
+
+Predictions of each level are saved in results/<shape>/Level_<level>, and the fused predictions
+(concatenated from level 1 to level 3) are saved in results/<shape>/Fusion.
+"""
+
+from __future__ import division
+import os
+import os.path as osp
+import sys
+
+sys.path.insert(0, osp.dirname(__file__) + '/..')
+
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data.dataloader import DataLoader
+
+from core.config import purge_cfg
+from core.utils.checkpoint import Checkpointer
+from core.utils.logger import setup_logger
+from core.utils.metric_logger import MetricLogger
+from core.utils.torch_util import set_random_seed, worker_init_fn
+from core.nn.quantize import quantize_dynamic_cpu
+
+from partnet.models.build import build_model
+from partnet.data.build import build_collate_fn, build_ins_seg_3d_dataset
+from partnet.models.pn2 import PointNetCls
+from partnet.test_remote import save_h5, predict_regions, filter_regions, group_parts, complete_partition
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PyTorch 3D Deep Learning Multi-level Test')
+    parser.add_argument(
+        '--cfg',
+        dest='config_files',
+        required=True,
+        metavar='FILE',
+        help='path to config file of a level, repeated for each level of the same shape category',
+        action='append',
+        type=str,
+    )
+    parser.add_argument(
+        '--no-cascade',
+        dest='cascade',
+        action='store_false',
+        help='regroup stage-1 proposals from scratch at each level',
+    )
+    parser.add_argument(
+        '--local-levels',
+        default='3',
+        metavar='LEVELS',
+        help='comma-separated levels grouped without remote pairs, the same as partnet/test.py',
+        type=str,
+    )
+    parser.add_argument(
+        'opts',
+        help='Modify config options using the command-line',
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def test(cfgs, output_dir, output_dirs_merge, output_dir_save, cascade=True, local_levels=(3,)):
+    """Test all the levels
+
+    Args:
+        cfgs (list of CfgNode): configs sorted from the finest level to the coarsest one
+        output_dir (str): the directory of the stage-1 model
+        output_dirs_merge (list of str): the directories of the grouping models of each level
+        output_dir_save (str): the directory to save predictions of the shape category
+        cascade (bool): whether to continue grouping from the partition of the finer level
+        local_levels (tuple of int): levels grouped without remote pairs
+
+    """
+    logger = logging.getLogger('shaper.test')
+    cfg = cfgs[0]
+    for level_cfg in cfgs[1:]:
+        if level_cfg.MODEL != cfg.MODEL:
+            raise ValueError('Levels should share the stage-1 model.')
+    levels = [level_cfg.TEST.LEVEL for level_cfg in cfgs]
+
+    # build models
+    model, _, _, _ = build_model(cfg)
+    model = nn.DataParallel(model).cuda()
+    checkpointer = Checkpointer(model, save_dir=output_dir, logger=logger)
+    if cfg.TEST.WEIGHT:
+        checkpointer.load(cfg.TEST.WEIGHT.replace('@', output_dir), resume=False)
+    else:
+        checkpointer.load(None, resume=True)
+    model.eval()
+
+    models_merge = []
+    for output_dir_merge in output_dirs_merge:
+        model_merge = nn.DataParallel(PointNetCls(in_channels=3, out_channels=128)).cuda()
+        checkpointer_merge = Checkpointer(model_merge, save_dir=output_dir_merge, logger=logger)
+        checkpointer_merge.load(None, resume=True)
+        model_merge.eval()
+        if cfg.TEST.QUANTIZE:
+            model_merge = quantize_dynamic_cpu(model_merge)
+        models_merge.append(model_merge)
+
+    # build data loader
+    # Points are the same at all the levels, and annotations are not used.
+    # Batches are collated for each level, because levels may sample regions differently.
+    assert cfg.TEST.BATCH_SIZE == 1, '{} != 1'.format(cfg.TEST.BATCH_SIZE)
+    test_dataset = build_ins_seg_3d_dataset(cfg, mode='test')
+    test_dataloader = DataLoader(test_dataset,
+                                 batch_size=cfg.TEST.BATCH_SIZE,
+                                 shuffle=False,
+                                 num_workers=cfg.DATALOADER.NUM_WORKERS,
+                                 worker_init_fn=worker_init_fn,
+                                 collate_fn=list)
+    collate_fns = [build_collate_fn(level_cfg, mode='test', device='cuda') for level_cfg in cfgs]
+    # levels with the same sampling configuration share regions
+    region_keys = [str(level_cfg.DATALOADER.KWARGS) for level_cfg in cfgs]
+
+    # ---------------------------------------------------------------------------- #
+    # Test
+    # ---------------------------------------------------------------------------- #
+    set_random_seed(cfg.RNG_SEED)
+
+    NUM_POINT = 10000
+    n_shape = len(test_dataloader)
+    NUM_INS = 200
+    # partitions are disjoint, so they are kept as per-point labels and expanded to masks when saving
+    out_label = np.zeros((len(cfgs), n_shape, NUM_POINT), dtype=np.uint8)
+    out_num_ins = np.zeros((len(cfgs), n_shape), dtype=np.int64)
+    out_valid = np.zeros((len(cfgs), n_shape), dtype=bool)
+
+    meters = [MetricLogger(delimiter='  ') for _ in cfgs]
+    with torch.no_grad():
+        start_time = time.time()
+        for iteration, batch in enumerate(test_dataloader):
+            regions = dict()
+            cur_mask_pool_new = None
+            for level_idx in range(len(cfgs)):
+                iter_start_time = time.time()
+                key = region_keys[level_idx]
+                if key not in regions:
+                    data_batch = collate_fns[level_idx](batch)
+                    data_batch = {k: v.cuda(non_blocking=True) for k, v in data_batch.items()}
+                    _, box_index_expand = predict_regions(model, data_batch)
+                    regions[key] = (data_batch['points'], box_index_expand)
+                points, box_index_expand = regions[key]
+
+                # the purity filter depends on the grouping model of each level
+                box_index_expand, cumsum_box_num, p_thresh = filter_regions(models_merge[level_idx], points,
+                                                                            box_index_expand)
+                pc = points[0].clone()
+                remote = levels[level_idx] not in local_levels
+                if cascade and remote and cur_mask_pool_new is not None:
+                    # Parts of a coarser level are unions of parts of a finer level.
+                    # The finer partition is disjoint, so only remote pairs can be grouped.
+                    cur_mask_pool = cur_mask_pool_new
+                else:
+                    cur_mask_pool = box_index_expand[cumsum_box_num[0]:cumsum_box_num[1]].clone()
+                cur_mask_pool = group_parts(models_merge[level_idx], pc, cur_mask_pool, p_thresh, meters[level_idx],
+                                            remote=remote)
+                cur_mask_pool_new = complete_partition(pc, cur_mask_pool)
+                meters[level_idx].update(iteration_time=time.time() - iter_start_time)
+
+                cur_mask = cur_mask_pool_new.cpu().numpy().astype(bool)
+                assert cur_mask.shape[0] <= NUM_INS
+                out_label[level_idx, iteration] = np.argmax(np.concatenate([np.zeros_like(cur_mask[:1]), cur_mask]), axis=0)
+                out_num_ins[level_idx, iteration] = cur_mask.shape[0]
+                out_valid[level_idx, iteration] = np.sum(cur_mask) > 10
+            logger.info('{}/{}'.format(iteration + 1, n_shape))
+
+    test_time = time.time() - start_time
+    for level, level_meters in zip(levels, meters):
+        logger.info('Level {}  {}'.format(level, level_meters.summary_str))
+    logger.info('Test time: {:.2f}s'.format(test_time))
+
+    # save predictions of each level, and the fused ones ordered from level 1 to level 3
+    order = np.argsort(levels)
+    fusion_dir = osp.join(output_dir_save, 'Fusion')
+    os.makedirs(fusion_dir, exist_ok=True)
+    for i in range(int(n_shape / 1024) + 1):
+        fusion_mask, fusion_valid, fusion_conf = [], [], []
+        for level_idx in order:
+            label = out_label[level_idx, i * 1024:(i + 1) * 1024]
+            num_ins = out_num_ins[level_idx, i * 1024:(i + 1) * 1024]
+            ins_idx = np.arange(NUM_INS)
+            mask = (label[:, None, :] == ins_idx[None, :, None] + 1)
+            valid = (ins_idx[None, :] < num_ins[:, None]) & out_valid[level_idx, i * 1024:(i + 1) * 1024, None]
+            conf = np.ones(valid.shape, dtype=np.float32)
+            level_dir = osp.join(output_dir_save, 'Level_%d' % levels[level_idx])
+            os.makedirs(level_dir, exist_ok=True)
+            save_h5(os.path.join(level_dir, 'test-%02d.h5' % (i)), mask, valid, conf)
+            fusion_mask.append(mask)
+            fusion_valid.append(valid)
+            fusion_conf.append(conf)
+        save_h5(os.path.join(fusion_dir, 'test-%02d.h5' % (i)),
+                np.concatenate(fusion_mask, axis=1),
+                np.concatenate(fusion_valid, axis=1),
+                np.concatenate(fusion_conf, axis=1))
+
+
+def main():
+    args = parse_args()
+
+    from partnet.config.ins_seg_3d import cfg as default_cfg
+    cfgs = []
+    for config_file in args.config_files:
+        cfg = default_cfg.clone()
+        cfg.merge_from_file(config_file)
+        cfg.merge_from_list(args.opts)
+        purge_cfg(cfg)
+        cfg.freeze()
+        cfgs.append(cfg)
+    # from fine to coarse
+    order = sorted(range(len(cfgs)), key=lambda i: -cfgs[i].TEST.LEVEL)
+    cfgs = [cfgs[i] for i in order]
+    config_files = [args.config_files[i] for i in order]
+    cfg = cfgs[0]
+    assert len(set(c.TEST.LEVEL for c in cfgs)) == len(cfgs), 'Levels should be different.'
+
+    # Replace '@' with config path, the same as test_remote.py
+    output_dirs_merge = []
+    for level_cfg, config_file in zip(cfgs, config_files):
+        config_path = osp.splitext(config_file)[0]
+        config_path = config_path.replace('configs', 'outputs')
+        output_dir_merge = level_cfg.OUTPUT_DIR.replace('@', config_path) + '_merge'
+        os.makedirs(output_dir_merge, exist_ok=True)
+        output_dirs_merge.append(output_dir_merge)
+    output_dir = osp.join('outputs/stage1/', cfg.DATASET.PartNetInsSeg.TRAIN.stage1)
+    os.makedirs(output_dir, exist_ok=True)
+    output_dir_save = './results/' + cfg.DATASET[cfg.DATASET.TYPE].TEST.shape
+    os.makedirs(output_dir_save, exist_ok=True)
+
+    logger = setup_logger('shaper', output_dir_save, prefix='test_multi_level')
+    logger.info('Using {} GPUs'.format(torch.cuda.device_count()))
+    logger.info(args)
+    logger.info('Loaded configuration files {}'.format(config_files))
+    logger.info('Running with config:\n{}'.format(cfg))
+
+    assert cfg.TASK == 'ins_seg_3d'
+    test(cfgs, output_dir, output_dirs_merge, output_dir_save,
+         cascade=args.cascade, local_levels=tuple(int(x) for x in args.local_levels.split(',') if x))
+
+
+if __name__ == '__main__':
+    main()
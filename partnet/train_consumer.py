@@ -1,5 +1,10 @@
 #!/usr/bin/env python
-"""Train point cloud instance segmentation models"""
+"""Train point cloud instance segmentation models
+
+Distributed training is launched by torchrun, e.g. 4 processes on a CPU machine with the gloo backend:
+    torchrun --nproc_per_node=4 partnet/train_consumer.py --cfg configs/pn_stage2_fusion_l3.yaml
+Each process samples its own minibatches from the buffer, and gradients are averaged over processes.
+"""
 
 import sys
 import os
@@ -16,6 +21,7 @@ from torch import nn
 from core.config import purge_cfg
 from core.solver.build import build_optimizer, build_scheduler
 from core.nn.freezer import Freezer
+from core.utils import comm
 from core.utils.checkpoint import Checkpointer
 from core.utils.logger import setup_logger
 from core.utils.metric_logger import MetricLogger
@@ -30,11 +36,13 @@ import numpy as np
 import shaper.models.pointnet2.functions as _F
 import torch.nn.functional as F
 from partnet.models.pn2 import PointNetCls
+from partnet.utils.prefetch import MinibatchPrefetcher
+from partnet.utils.torch_pc import renorm_pairs
+from partnet.utils.buffer import ShardReader
 from core.nn.functional import cross_entropy
 from core.nn.functional import focal_loss
 from core.nn.functional import l2_loss
 
-from subprocess import Popen
 
 
 def parse_args():
@@ -99,8 +107,6 @@ policy_purity_pool = torch.zeros([0,policy_update_bs]).float()
 policy_reward_pool = torch.zeros([0,policy_update_bs]).float()
 policy_xyz_pool1 = torch.zeros([0,policy_update_bs,3,1024]).float()
 policy_xyz_pool2 = torch.zeros([0,policy_update_bs,3,1024]).float()
-cur_buffer = 'start'
-rbuffer = {}
 count = 0
 
 def train_one_epoch(
@@ -108,9 +114,11 @@ def train_one_epoch(
                     cur_epoch,
                     optimizer_embed,
                     output_dir_merge,
+                    reader,
                     max_grad_norm=0.0,
                     freezer=None,
-                    log_period=-1):
+                    log_period=-1,
+                    num_prefetch=2):
     global xyz_pool1
     global xyz_pool2
     global context_xyz_pool1
@@ -125,8 +133,6 @@ def train_one_epoch(
     global policy_reward_pool
     global policy_xyz_pool1
     global policy_xyz_pool2
-    global cur_buffer
-    global rbuffer
     global count
 
     logger = logging.getLogger('shaper.train')
@@ -137,75 +143,95 @@ def train_one_epoch(
     model_merge.train()
     sys.stdout.flush()
     BS = policy_update_bs
-    print('epoch: %d'%cur_epoch)
+    if comm.is_main_process():
+        print('epoch: %d'%cur_epoch)
     
     #delete older models
-    if cur_epoch >2:
+    if cur_epoch >2 and comm.is_main_process():
         if (cur_epoch - 2) % 400 != 0:
-            p = Popen('rm %s'%(os.path.join(output_dir_merge, 'model_%03d.pth'%(cur_epoch-2))), shell=True)
+            old_model = os.path.join(output_dir_merge, 'model_%03d.pth'%(cur_epoch-2))
+            if os.path.exists(old_model):
+                os.remove(old_model)
 
     #keep reading newest data generated by producer
     while True:
-        buffer_txt = os.path.join(output_dir_merge, 'last_buffer')
-        buffer_file = open(buffer_txt, 'r')
-        new_buffer = buffer_file.read()
-        buffer_file.close()
-
-        if new_buffer != 'start':
-           if cur_buffer != new_buffer:
-                count = 0
-                cur_buffer = new_buffer
-                print('read data from %s'%cur_buffer)
-                rbuffer = torch.load(os.path.join(output_dir_merge,'buffer','%s.pt'%cur_buffer))
+        if reader.refresh():
+            count = 0
+            print('read data from %d buffer shards'%len(reader))
+            if len(reader) > 0:
+                break
+        elif len(reader) > 0:
+            count += 1
+            if count <= 2:
                 break
-           count += 1
-           if count <= 2:
-               break
         time.sleep(10)
 
     #read data
-    xyz_pool1 = rbuffer['xyz_pool1']
-    xyz_pool2 = rbuffer['xyz_pool2']
-    context_xyz_pool1 = rbuffer['context_xyz_pool1']
-    context_xyz_pool2 = rbuffer['context_xyz_pool2']
-    context_context_xyz_pool = rbuffer['context_context_xyz_pool']
-    context_label_pool = rbuffer['context_label_pool']
-    context_purity_pool = rbuffer['context_purity_pool']
-    label_pool = rbuffer['label_pool']
-    purity_purity_pool = rbuffer['purity_purity_pool']
-    purity_xyz_pool = rbuffer['purity_xyz_pool']
-    policy_purity_pool = rbuffer['policy_purity_pool']
-    policy_reward_pool = rbuffer['policy_reward_pool']
-    policy_xyz_pool1 = rbuffer['policy_xyz_pool1']
-    policy_xyz_pool2 = rbuffer['policy_xyz_pool2']
+    xyz_pool1 = reader['xyz_pool1']
+    xyz_pool2 = reader['xyz_pool2']
+    context_xyz_pool1 = reader['context_xyz_pool1']
+    context_xyz_pool2 = reader['context_xyz_pool2']
+    context_context_xyz_pool = reader['context_context_xyz_pool']
+    context_label_pool = reader['context_label_pool']
+    context_purity_pool = reader['context_purity_pool']
+    label_pool = reader['label_pool']
+    purity_purity_pool = reader['purity_purity_pool']
+    purity_xyz_pool = reader['purity_xyz_pool']
+    policy_purity_pool = reader['policy_purity_pool']
+    policy_reward_pool = reader['policy_reward_pool']
+    policy_xyz_pool1 = reader['policy_xyz_pool1']
+    policy_xyz_pool2 = reader['policy_xyz_pool2']
+    device = comm.get_device()
+    bs2 = 64
+    TRAIN_LEN = 1024
+    UP_policy = 2048
+    TRAIN_LEN_policy = 32
+    bs_policy = int(128/policy_update_bs)
+    #all the processes run the same number of steps, even if they have read different numbers of shards
+    train_len_binary = comm.all_reduce_min(min(TRAIN_LEN, xyz_pool1.shape[0]))
+    train_len_context = comm.all_reduce_min(min(TRAIN_LEN, context_xyz_pool1.shape[0]))
+    train_len_purity = comm.all_reduce_min(min(TRAIN_LEN, purity_xyz_pool.shape[0]))
+    train_len_policy = comm.all_reduce_min(min(TRAIN_LEN_policy, policy_xyz_pool1.shape[0]))
+
+    def renorm_transform(batch):
+        batch['part_xyz'], batch['part_xyz1'], batch['part_xyz2'] = renorm_pairs(batch['part_xyz1'], batch['part_xyz2'])
+        return batch
+
+    def build_prefetcher(name):
+        #minibatches of a branch are assembled in a background thread
+        if name == 'binary':
+            return MinibatchPrefetcher({'part_xyz1': xyz_pool1, 'part_xyz2': xyz_pool2, 'siamese_label': label_pool},
+                                       bs2, train_len_binary, transform=renorm_transform,
+                                       num_prefetch=num_prefetch, device=device)
+        if name == 'context':
+            return MinibatchPrefetcher({'part_xyz1': context_xyz_pool1, 'part_xyz2': context_xyz_pool2,
+                                        'siamese_label': context_label_pool, 'context_xyz': context_context_xyz_pool},
+                                       bs2, train_len_context, transform=renorm_transform,
+                                       num_prefetch=num_prefetch, device=device)
+        if name == 'purity':
+            return MinibatchPrefetcher({'part_xyz': purity_xyz_pool, 'siamese_label_l2': purity_purity_pool},
+                                       bs2, train_len_purity, num_prefetch=num_prefetch, device=device)
+        return MinibatchPrefetcher({'part_xyz1': policy_xyz_pool1, 'part_xyz2': policy_xyz_pool2,
+                                    'purity_arr': policy_purity_pool, 'reward_arr': policy_reward_pool},
+                                   bs_policy, train_len_policy, num_prefetch=num_prefetch, device=device)
+
+    def iter_prefetchers(num_loops):
+        #the next branch is staged while the current one is training, so at most two prefetchers are alive
+        names = ['binary', 'context', 'purity', 'policy'] * num_loops
+        next_prefetcher = build_prefetcher(names[0])
+        for k in range(len(names)):
+            prefetcher = next_prefetcher
+            next_prefetcher = build_prefetcher(names[k + 1]) if k + 1 < len(names) else None
+            yield prefetcher
+
+    prefetchers = iter_prefetchers(20)
     for i in range(20):
-        bs2 = 64
-        TRAIN_LEN = 1024
-        UP_policy = 2048
-        TRAIN_LEN_policy = 32
-        bs_policy = int(128/policy_update_bs)
-
         #train binary branch
-        cur_len = xyz_pool1.shape[0]
-        cur_train_len = TRAIN_LEN if cur_len > TRAIN_LEN else cur_len
-        perm_idx = torch.randperm(cur_len)
-        logits1_all = torch.zeros([0]).type(torch.LongTensor).cuda()
-        sub_xyz_pool1 = torch.index_select(xyz_pool1, dim=0, index=perm_idx[:cur_train_len])
-        sub_xyz_pool2 = torch.index_select(xyz_pool2, dim=0, index=perm_idx[:cur_train_len])
-        sub_label_pool = torch.index_select(label_pool, dim=0, index=perm_idx[:cur_train_len])
-        perm_idx = torch.arange(cur_train_len)
-        for i in range(int(cur_train_len/bs2)):
+        logits1_all = torch.zeros([0]).type(torch.LongTensor).to(device)
+        for batch in next(prefetchers):
             optimizer_embed.zero_grad()
-            part_xyz1 = torch.index_select(sub_xyz_pool1, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
-            part_xyz2 = torch.index_select(sub_xyz_pool2, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
-            siamese_label = torch.index_select(sub_label_pool, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
-            part_xyz = torch.cat([part_xyz1,part_xyz2],-1)
-            part_xyz -= torch.mean(part_xyz,-1).unsqueeze(-1)
-            part_xyz1 -= torch.mean(part_xyz1,-1).unsqueeze(-1)
-            part_xyz2 -= torch.mean(part_xyz2,-1).unsqueeze(-1)
-            part_xyz1 /=part_xyz1.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-            part_xyz2 /=part_xyz2.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-            part_xyz /=part_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+            part_xyz, part_xyz1, part_xyz2 = batch['part_xyz'], batch['part_xyz1'], batch['part_xyz2']
+            siamese_label = batch['siamese_label']
             logits1 = model_merge(part_xyz1,'backbone')
             logits2 = model_merge(part_xyz2,'backbone')
             merge_logits = model_merge(torch.cat([part_xyz, torch.cat([logits1.unsqueeze(-1).expand(-1,-1,part_xyz1.shape[-1]), logits2.unsqueeze(-1).expand(-1,-1,part_xyz2.shape[-1])], dim=-1)], dim=1), 'head')
@@ -228,33 +254,18 @@ def train_one_epoch(
             meters.update(**loss_dict_embed)
             total_loss_embed = sum(loss_dict_embed.values())
             total_loss_embed.backward()
+            comm.all_reduce_gradients(model_merge)
             optimizer_embed.step()
 
         #train context branch
-        cur_len = context_xyz_pool1.shape[0]
-        cur_train_len = TRAIN_LEN if cur_len > TRAIN_LEN else cur_len
-        perm_idx = torch.randperm(cur_len)
-        logits1_all = torch.zeros([0]).type(torch.LongTensor).cuda()
-        sub_xyz_pool1 = torch.index_select(context_xyz_pool1, dim=0, index=perm_idx[:cur_train_len])
-        sub_xyz_pool2 = torch.index_select(context_xyz_pool2, dim=0, index=perm_idx[:cur_train_len])
-        sub_label_pool = torch.index_select(context_label_pool, dim=0, index=perm_idx[:cur_train_len])
-        sub_context_context_xyz_pool = torch.index_select(context_context_xyz_pool, dim=0, index=perm_idx[:cur_train_len])
-        perm_idx = torch.arange(cur_train_len)
-        for i in range(int(cur_train_len/bs2)):
+        logits1_all = torch.zeros([0]).type(torch.LongTensor).to(device)
+        for batch in next(prefetchers):
             optimizer_embed.zero_grad()
-            part_xyz1 = torch.index_select(sub_xyz_pool1, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
-            part_xyz2 = torch.index_select(sub_xyz_pool2, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
-            siamese_label = torch.index_select(sub_label_pool, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
-            part_xyz = torch.cat([part_xyz1,part_xyz2],-1)
-            part_xyz -= torch.mean(part_xyz,-1).unsqueeze(-1)
-            part_xyz1 -= torch.mean(part_xyz1,-1).unsqueeze(-1)
-            part_xyz2 -= torch.mean(part_xyz2,-1).unsqueeze(-1)
-            part_xyz1 /=part_xyz1.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-            part_xyz2 /=part_xyz2.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-            part_xyz /=part_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+            part_xyz, part_xyz1, part_xyz2 = batch['part_xyz'], batch['part_xyz1'], batch['part_xyz2']
+            siamese_label = batch['siamese_label']
             logits1 = model_merge(part_xyz1,'backbone')
             logits2 = model_merge(part_xyz2,'backbone')
-            context_xyz = torch.index_select(sub_context_context_xyz_pool, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
+            context_xyz = batch['context_xyz']
             context_logits = model_merge(context_xyz,'backbone2')
             merge_logits = model_merge(torch.cat([part_xyz, torch.cat([logits1.detach().unsqueeze(-1).expand(-1,-1,part_xyz1.shape[-1]), logits2.detach().unsqueeze(-1).expand(-1,-1,part_xyz2.shape[-1])], dim=-1), torch.cat([context_logits.unsqueeze(-1).expand(-1,-1,part_xyz.shape[-1])], dim=-1)], dim=1), 'head2')
             _, p = torch.max(merge_logits, 1)
@@ -276,21 +287,16 @@ def train_one_epoch(
             meters.update(**loss_dict_embed)
             total_loss_embed = sum(loss_dict_embed.values())
             total_loss_embed.backward()
+            comm.all_reduce_gradients(model_merge)
             optimizer_embed.step()
 
 
         #train purity network
-        cur_len = purity_purity_pool.shape[0]
-        cur_train_len = TRAIN_LEN if cur_len > TRAIN_LEN else cur_len
-        perm_idx = torch.randperm(cur_len)
-        sub_purity_pool = torch.index_select(purity_purity_pool, dim=0, index=perm_idx[:cur_train_len])
-        sub_purity_xyz_pool = torch.index_select(purity_xyz_pool, dim=0, index=perm_idx[:cur_train_len])
-        perm_idx = torch.arange(cur_train_len)
-        for i in range(int(cur_train_len/bs2)):
+        for batch in next(prefetchers):
             optimizer_embed.zero_grad()
-            part_xyz = torch.index_select(sub_purity_xyz_pool, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
+            part_xyz = batch['part_xyz']
             logits_purity = model_merge(part_xyz, 'purity')
-            siamese_label_l2= torch.index_select(sub_purity_pool, dim=0, index=perm_idx[i*bs2:(i+1)*bs2]).cuda()
+            siamese_label_l2 = batch['siamese_label_l2']
             loss_purity = l2_loss(logits_purity.squeeze(), siamese_label_l2)
             loss_dict_embed = {
                 'loss_purity2': loss_purity,
@@ -298,24 +304,16 @@ def train_one_epoch(
             meters.update(**loss_dict_embed)
             total_loss_embed = sum(loss_dict_embed.values())
             total_loss_embed.backward()
+            comm.all_reduce_gradients(model_merge)
             optimizer_embed.step()
 
         #train policy network
-        cur_len = policy_xyz_pool1.shape[0]
-        cur_train_len = TRAIN_LEN_policy if cur_len > TRAIN_LEN_policy else cur_len
-        perm_idx = torch.randperm(cur_len)
-        logits1_all = torch.zeros([0]).type(torch.LongTensor).cuda()
-        sub_xyz_pool1 = torch.index_select(policy_xyz_pool1, dim=0, index=perm_idx[:cur_train_len])
-        sub_xyz_pool2 = torch.index_select(policy_xyz_pool2, dim=0, index=perm_idx[:cur_train_len])
-        sub_purity_pool = torch.index_select(policy_purity_pool, dim=0, index=perm_idx[:cur_train_len])
-        sub_reward_pool = torch.index_select(policy_reward_pool, dim=0, index=perm_idx[:cur_train_len])
-        perm_idx = torch.arange(cur_train_len)
-        for i in range(int(cur_train_len/bs_policy)):
+        for batch in next(prefetchers):
             optimizer_embed.zero_grad()
-            part_xyz1 = torch.index_select(sub_xyz_pool1, dim=0, index=perm_idx[i*bs_policy:(i+1)*bs_policy]).cuda()
-            part_xyz2 = torch.index_select(sub_xyz_pool2, dim=0, index=perm_idx[i*bs_policy:(i+1)*bs_policy]).cuda()
-            purity_arr = torch.index_select(sub_purity_pool, dim=0, index=perm_idx[i*bs_policy:(i+1)*bs_policy]).cuda()
-            reward_arr = torch.index_select(sub_reward_pool, dim=0, index=perm_idx[i*bs_policy:(i+1)*bs_policy]).cuda()
+            part_xyz1 = batch['part_xyz1']
+            part_xyz2 = batch['part_xyz2']
+            purity_arr = batch['purity_arr']
+            reward_arr = batch['reward_arr']
             logits11 = model_merge(part_xyz1.reshape([bs_policy*BS,3,1024]), 'policy')
             logits22 = model_merge(part_xyz2.reshape([bs_policy*BS,3,1024]), 'policy')
             policy_arr = model_merge(torch.cat([logits11, logits22],dim=-1), 'policy_head').squeeze()
@@ -324,6 +322,7 @@ def train_one_epoch(
             loss_policy = torch.mean(-torch.sum(score_arr*reward_arr, dim=1))
             meters.update(loss_policy=loss_policy)
             loss_policy.backward()
+            comm.all_reduce_gradients(model_merge)
             optimizer_embed.step()
 
         if max_grad_norm > 0:
@@ -352,7 +351,15 @@ def train(cfg, output_dir='', output_dir_merge='', output_dir_refine=''):
     # build model
     set_random_seed(cfg.RNG_SEED)
 
-    model_merge = nn.DataParallel(PointNetCls(in_channels=3, out_channels=128)).cuda()
+    model_merge = PointNetCls(in_channels=3, out_channels=128)
+    if comm.is_distributed():
+        # Not DistributedDataParallel, because branches run several forwards with different parameters
+        # before a backward. Gradients are all-reduced explicitly before each step instead.
+        device = comm.get_device()
+        model_merge = nn.DataParallel(model_merge, device_ids=[device.index] if device.type == 'cuda' else None)
+        model_merge = model_merge.to(device)
+    else:
+        model_merge = nn.DataParallel(model_merge).to(comm.get_device())
 
     # build optimizer
     cfg['SCHEDULER']['StepLR']['step_size']=150
@@ -365,17 +372,24 @@ def train(cfg, output_dir='', output_dir_merge='', output_dir_refine=''):
                                 optimizer=optimizer_embed,
                                 scheduler=scheduler_embed,
                                 save_dir=output_dir_merge,
+                                save_to_disk=comm.is_main_process(),
                                 logger=logger)
     checkpoint_data_embed = checkpointer_embed.load(cfg.MODEL.WEIGHT, resume=cfg.AUTO_RESUME, resume_states=cfg.RESUME_STATES)
+    # start from the same weights
+    comm.broadcast_parameters(model_merge)
 
     ckpt_period = cfg.TRAIN.CHECKPOINT_PERIOD
 
     # build data loader
     # Reset the random seed again in case the initialization of models changes the random state.
-    set_random_seed(cfg.RNG_SEED)
+    # Processes are seeded differently, so that they sample different minibatches.
+    set_random_seed(cfg.RNG_SEED + comm.get_rank() if cfg.RNG_SEED >= 0 else cfg.RNG_SEED)
+
+    # build buffer reader
+    reader = ShardReader(osp.join(output_dir_merge, 'buffer'))
 
     # build tensorboard logger (optionally by comment)
-    tensorboard_logger = TensorboardLogger(output_dir_merge)
+    tensorboard_logger = TensorboardLogger(output_dir_merge) if comm.is_main_process() else None
 
     # train
     max_epoch = cfg.SCHEDULER.MAX_EPOCH
@@ -392,15 +406,18 @@ def train(cfg, output_dir='', output_dir_merge='', output_dir_refine=''):
                                        cur_epoch,
                                        optimizer_embed=optimizer_embed,
                                        output_dir_merge = output_dir_merge,
+                                       reader=reader,
                                        max_grad_norm=cfg.OPTIMIZER.MAX_GRAD_NORM,
                                        freezer=None,
                                        log_period=cfg.TRAIN.LOG_PERIOD,
+                                       num_prefetch=cfg.CONSUMER.NUM_PREFETCH,
                                        )
         epoch_time = time.time() - start_time
         logger.info('Epoch[{}]-Train {}  total_time: {:.2f}s'.format(
             cur_epoch, train_meters.summary_str, epoch_time))
 
-        tensorboard_logger.add_scalars(train_meters.meters, cur_epoch, prefix='train')
+        if tensorboard_logger is not None:
+            tensorboard_logger.add_scalars(train_meters.meters, cur_epoch, prefix='train')
 
         # checkpoint
         if (ckpt_period > 0 and cur_epoch % ckpt_period == 0) or cur_epoch == max_epoch:
@@ -421,6 +438,8 @@ def main():
     purge_cfg(cfg)
     cfg.freeze()
 
+    comm.init_distributed(cfg.DISTRIBUTED.BACKEND)
+
     output_dir = cfg.OUTPUT_DIR
     # replace '@' with config path
     if output_dir:
@@ -431,8 +450,9 @@ def main():
         output_dir = osp.join('outputs/stage1/', cfg.DATASET.PartNetInsSeg.TRAIN.stage1)
         os.makedirs(output_dir, exist_ok=True)
 
-    logger = setup_logger('shaper', output_dir_merge, prefix='train')
+    logger = setup_logger('shaper', output_dir_merge, prefix='train', distributed_rank=comm.get_rank())
     logger.info('Using {} GPUs'.format(torch.cuda.device_count()))
+    logger.info('Using {} processes'.format(comm.get_world_size()))
     logger.info(args)
 
 
@@ -1,5 +1,9 @@
 #!/usr/bin/env python
-"""Train point cloud instance segmentation models"""
+"""Train point cloud instance segmentation models
+
+Distributed training is launched by torchrun, e.g. 4 processes on a CPU machine with the gloo backend:
+    torchrun --nproc_per_node=4 partnet/train_ins_seg.py --cfg configs/pn_stage1_fusion.yaml
+"""
 
 import sys
 import os
@@ -12,10 +16,13 @@ import time
 
 import torch
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 
 from core.config import purge_cfg
 from core.solver.build import build_optimizer, build_scheduler
 from core.nn.freezer import Freezer
+from core.utils import comm
 from core.utils.checkpoint import Checkpointer
 from core.utils.logger import setup_logger
 from core.utils.metric_logger import MetricLogger
@@ -64,11 +71,12 @@ def train_one_epoch(model,
         freezer.freeze()
     loss_fn.train()
 
+    device = comm.get_device()
     end = time.time()
     for iteration, data_batch in enumerate(dataloader):
         data_time = time.time() - end
 
-        data_batch = {k: v.cuda(non_blocking=True) for k, v in data_batch.items()}
+        data_batch = {k: v.to(device, non_blocking=True) for k, v in data_batch.items()}
 
         preds = model(data_batch)
 
@@ -76,7 +84,9 @@ def train_one_epoch(model,
         loss_dict = loss_fn(preds, data_batch)
         total_loss = sum(loss_dict.values())
 
-        meters.update(loss=total_loss, **loss_dict)
+        # losses averaged over all the processes, only for logging
+        loss_dict_reduced = comm.reduce_dict(loss_dict)
+        meters.update(loss=sum(loss_dict_reduced.values()), **loss_dict_reduced)
         meters.update(node_acc=preds['node_acc'], node_pos_acc=preds['node_pos_acc'], node_neg_acc=preds['node_neg_acc'], center_valid_ratio=preds['center_valid_ratio'])
         with torch.no_grad():
             # TODO add loss_dict hack
@@ -104,7 +114,7 @@ def train_one_epoch(model,
                     iter=iteration,
                     meters=str(meters),
                     lr=optimizer.param_groups[0]['lr'],
-                    memory=torch.cuda.max_memory_allocated() / (1024.0 ** 2),
+                    memory=torch.cuda.max_memory_allocated() / (1024.0 ** 2) if torch.cuda.is_available() else 0,
                 )
             )
     return meters
@@ -122,12 +132,13 @@ def validate(model,
     model.eval()
     loss_fn.eval()
 
+    device = comm.get_device()
     end = time.time()
     with torch.no_grad():
         for iteration, data_batch in enumerate(dataloader):
             data_time = time.time() - end
 
-            data_batch = {k: v.cuda(non_blocking=True) for k, v in data_batch.items()}
+            data_batch = {k: v.to(device, non_blocking=True) for k, v in data_batch.items()}
 
             preds = model(data_batch)
 
@@ -164,7 +175,15 @@ def train(cfg, output_dir=''):
     set_random_seed(cfg.RNG_SEED)
     model, loss_fn, train_metric, val_metric = build_model(cfg)
     logger.info('Build model:\n{}'.format(str(model)))
-    model = nn.DataParallel(model).cuda()
+    if comm.is_distributed():
+        # one device per process, and gradients are all-reduced in backward.
+        # Some parameters of the region classifier are not used by the loss.
+        device = comm.get_device()
+        model = DistributedDataParallel(model.to(device),
+                                        device_ids=[device.index] if device.type == 'cuda' else None,
+                                        find_unused_parameters=True)
+    else:
+        model = nn.DataParallel(model).to(comm.get_device())
     # model = model.cuda()
 
     # build optimizer
@@ -175,10 +194,12 @@ def train(cfg, output_dir=''):
 
     # build checkpointer
     # Note that checkpointer will load state_dict of model, optimizer and scheduler.
+    # only the main process saves checkpoints, and all the processes load the same one
     checkpointer = Checkpointer(model,
                                 optimizer=optimizer,
                                 scheduler=scheduler,
                                 save_dir=output_dir,
+                                save_to_disk=comm.is_main_process(),
                                 logger=logger)
     checkpoint_data = checkpointer.load(cfg.MODEL.WEIGHT, resume=cfg.AUTO_RESUME, resume_states=cfg.RESUME_STATES)
     ckpt_period = cfg.TRAIN.CHECKPOINT_PERIOD
@@ -192,13 +213,15 @@ def train(cfg, output_dir=''):
 
     # build data loader
     # Reset the random seed again in case the initialization of models changes the random state.
-    set_random_seed(cfg.RNG_SEED)
+    # Processes are seeded differently, so that they sample different regions.
+    set_random_seed(cfg.RNG_SEED + comm.get_rank() if cfg.RNG_SEED >= 0 else cfg.RNG_SEED)
     train_dataloader = build_dataloader(cfg, mode='train')
     val_period = cfg.TRAIN.VAL_PERIOD
-    val_dataloader = build_dataloader(cfg, mode='val') if val_period > 0 else None
+    # validate in the main process
+    val_dataloader = build_dataloader(cfg, mode='val') if val_period > 0 and comm.is_main_process() else None
 
     # build tensorboard logger (optionally by comment)
-    tensorboard_logger = TensorboardLogger(output_dir)
+    tensorboard_logger = TensorboardLogger(output_dir) if comm.is_main_process() else None
 
     # train
     max_epoch = cfg.SCHEDULER.MAX_EPOCH
@@ -209,6 +232,8 @@ def train(cfg, output_dir=''):
     for epoch in range(start_epoch, max_epoch):
         cur_epoch = epoch + 1
         scheduler.step()
+        if isinstance(train_dataloader.sampler, DistributedSampler):
+            train_dataloader.sampler.set_epoch(epoch)
         start_time = time.time()
         train_meters = train_one_epoch(model,
                                        loss_fn,
@@ -223,7 +248,8 @@ def train(cfg, output_dir=''):
         logger.info('Epoch[{}]-Train {}  total_time: {:.2f}s'.format(
             cur_epoch, train_meters.summary_str, epoch_time))
 
-        tensorboard_logger.add_scalars(train_meters.meters, cur_epoch, prefix='train')
+        if tensorboard_logger is not None:
+            tensorboard_logger.add_scalars(train_meters.meters, cur_epoch, prefix='train')
 
         # checkpoint
         if (ckpt_period > 0 and cur_epoch % ckpt_period == 0) or cur_epoch == max_epoch:
@@ -232,9 +258,10 @@ def train(cfg, output_dir=''):
             checkpointer.save('model_{:03d}'.format(cur_epoch), **checkpoint_data)
 
         # validate
-        if val_period > 0 and (cur_epoch % val_period == 0 or cur_epoch == max_epoch):
+        if val_period > 0 and (cur_epoch % val_period == 0 or cur_epoch == max_epoch) and comm.is_main_process():
             start_time = time.time()
-            val_meters = validate(model,
+            # the wrapped model, without collectives of other processes
+            val_meters = validate(model.module if comm.is_distributed() else model,
                                   loss_fn,
                                   val_metric,
                                   val_dataloader,
@@ -254,6 +281,7 @@ def train(cfg, output_dir=''):
                     checkpoint_data['epoch'] = cur_epoch
                     checkpoint_data[best_metric_name] = best_metric
                     checkpointer.save('model_best', **checkpoint_data)
+        comm.synchronize()
 
     logger.info('Best val-{} = {}'.format(cfg.TRAIN.VAL_METRIC, best_metric))
     return model
@@ -270,6 +298,8 @@ def main():
     purge_cfg(cfg)
     cfg.freeze()
 
+    comm.init_distributed(cfg.DISTRIBUTED.BACKEND)
+
     output_dir = cfg.OUTPUT_DIR
     # replace '@' with config path
     if output_dir:
@@ -279,8 +309,9 @@ def main():
         output_dir = osp.join('outputs/stage1/', cfg.DATASET.PartNetInsSeg.TRAIN.stage1)
         os.makedirs(output_dir, exist_ok=True)
 
-    logger = setup_logger('shaper', output_dir, prefix='train')
+    logger = setup_logger('shaper', output_dir, prefix='train', distributed_rank=comm.get_rank())
     logger.info('Using {} GPUs'.format(torch.cuda.device_count()))
+    logger.info('Using {} processes'.format(comm.get_world_size()))
     logger.info(args)
 
     #from core.utils.torch_util import collect_env_info
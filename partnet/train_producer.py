@@ -30,11 +30,13 @@ import numpy as np
 import shaper.models.pointnet2.functions as _F
 import torch.nn.functional as F
 from partnet.models.pn2 import PointNetCls
+from partnet.utils.buffer import ShardWriter
+from partnet.utils.torch_pc import renorm_pairs
 from core.nn.functional import cross_entropy
 from core.nn.functional import focal_loss
 from core.nn.functional import l2_loss
 
-from subprocess import Popen
+from collections import defaultdict
 
 
 def parse_args():
@@ -62,10 +64,10 @@ def mask_to_xyz(pc, index, sample_num=1024):
     #index:num x num_points
     pc = pc.squeeze(0)
     parts_num = index.shape[0]
-    parts_xyz = torch.zeros([parts_num, 3, sample_num]).cuda().type(torch.FloatTensor)
-    parts_mean = torch.zeros([parts_num, 3]).cuda().type(torch.FloatTensor)
+    parts_xyz = torch.zeros([parts_num, 3, sample_num], device=pc.device)
+    parts_mean = torch.zeros([parts_num, 3], device=pc.device)
     for i in range(parts_num):
-        part_pc = torch.masked_select(pc.squeeze(),mask=index[i].unsqueeze(0).byte()).reshape(3,-1)
+        part_pc = torch.masked_select(pc.squeeze(),mask=index[i].unsqueeze(0).bool()).reshape(3,-1)
         length = part_pc.shape[1]
         if length == 0:
             continue
@@ -74,7 +76,7 @@ def mask_to_xyz(pc, index, sample_num=1024):
         parts_xyz[i] = part_pc[:,initial_index].unsqueeze(1).expand_as(parts_xyz[i])
         cur_sample_num = length if length < sample_num else sample_num
         parts_xyz[i,:,:cur_sample_num] = part_pc[:,torch.randperm(length)[:cur_sample_num]]
-    return parts_xyz.cuda(), parts_mean.cuda().unsqueeze(-1)
+    return parts_xyz, parts_mean.unsqueeze(-1)
 
 def tile(tensor, dim, n):
     """Tile n times along the dim axis"""
@@ -123,7 +125,454 @@ policy_purity_pool = torch.zeros([0,policy_update_bs]).float()
 policy_reward_pool = torch.zeros([0,policy_update_bs]).float()
 policy_xyz_pool1 = torch.zeros([0,policy_update_bs,3,1024]).float()
 policy_xyz_pool2 = torch.zeros([0,policy_update_bs,3,1024]).float()
-old_iteration = 0
+
+
+def score_pairs(model_merge, part_xyz1, part_xyz2, max_batch_size=1024):
+    """Compute purity and policy scores of sub-part pairs
+
+    Args:
+        model_merge (nn.Module): grouping networks (PointNetCls)
+        part_xyz1 (torch.Tensor): (num_pairs, 3, num_samples), xyz of the first sub-parts
+        part_xyz2 (torch.Tensor): (num_pairs, 3, num_samples), xyz of the second sub-parts
+        max_batch_size (int): the maximum number of pairs in one forward
+
+    Returns:
+        purity (torch.Tensor): (num_pairs,)
+        policy (torch.Tensor): (num_pairs,)
+        part_xyz11 (torch.Tensor): (num_pairs, 3, num_samples), the first sub-parts normalized by the pair
+        part_xyz22 (torch.Tensor): (num_pairs, 3, num_samples), the second sub-parts normalized by the pair
+
+    """
+    purity_list, policy_list, xyz11_list, xyz22_list = [], [], [], []
+    for k in range(int(np.ceil(part_xyz1.shape[0] / max_batch_size))):
+        sub_xyz1 = part_xyz1[k*max_batch_size:(k+1)*max_batch_size]
+        sub_xyz2 = part_xyz2[k*max_batch_size:(k+1)*max_batch_size]
+        part_xyz = torch.cat([sub_xyz1, sub_xyz2], -1)
+        part_xyz = part_xyz - torch.mean(part_xyz, -1).unsqueeze(-1)
+        part_norm = part_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+        part_xyz = part_xyz / part_norm
+        purity_list.append(model_merge(part_xyz, 'purity').view(-1))
+
+        part_xyz11 = (sub_xyz1 - torch.mean(sub_xyz1, -1).unsqueeze(-1)) / part_norm
+        part_xyz22 = (sub_xyz2 - torch.mean(sub_xyz2, -1).unsqueeze(-1)) / part_norm
+        # one policy forward for both sides of the pairs
+        logits = model_merge(torch.cat([part_xyz11, part_xyz22], dim=0), 'policy')
+        logits11, logits22 = logits.split(part_xyz11.shape[0], dim=0)
+        policy_list.append(model_merge(torch.cat([logits11, logits22], dim=-1), 'policy_head').view(-1))
+        xyz11_list.append(part_xyz11)
+        xyz22_list.append(part_xyz22)
+    return torch.cat(purity_list), torch.cat(policy_list), torch.cat(xyz11_list), torch.cat(xyz22_list)
+
+
+def verify_pairs(model_merge, part_xyz, part_xyz11, part_xyz22, context_xyz=None):
+    """Predict whether to merge sub-part pairs by the verification network
+
+    Args:
+        part_xyz (torch.Tensor): (num_pairs, 3, 2 * num_samples), normalized union of the pairs
+        part_xyz11 (torch.Tensor): (num_pairs, 3, num_samples), normalized first sub-parts
+        part_xyz22 (torch.Tensor): (num_pairs, 3, num_samples), normalized second sub-parts
+        context_xyz (torch.Tensor, optional): (num_pairs, 3, 2 * num_samples), normalized context.
+            If given, the context branch ('head2') is used instead of the binary branch ('head').
+
+    Returns:
+        torch.Tensor: (num_pairs,), 1 for merge
+
+    """
+    num_pairs = part_xyz.shape[0]
+    logits = model_merge(torch.cat([part_xyz11, part_xyz22], dim=0), 'backbone')
+    logits1, logits2 = logits.split(num_pairs, dim=0)
+    # logits are added as biases of the first layer of heads, instead of being broadcast to points
+    if context_xyz is None:
+        merge_logits = model_merge(part_xyz, 'head', ((logits1, logits2),))
+    else:
+        context_logits = model_merge(context_xyz, 'backbone2')
+        merge_logits = model_merge(part_xyz, 'head2', ((logits1, logits2), (context_logits,)))
+    _, p = torch.max(merge_logits, 1)
+    return p
+
+
+class GroupingEpisode(object):
+    """The grouping trajectory of a single shape
+
+    The grouping loop is split into phases around network forwards.
+    Therefore, forwards of several episodes can be concatenated into one batch (see rollout_episodes).
+    Collected training data is appended to lists in a shared dict, keyed by the name of the pool.
+
+    Args:
+        pc (torch.Tensor): (3, num_points), the point cloud
+        mask_pool (torch.Tensor): (num_parts, num_points), masks of initial sub-parts
+        centroid_label (torch.Tensor): (num_parts,), instance labels of initial sub-parts
+        ins_id (torch.Tensor): (num_points,), ground-truth instance ids
+        explore (bool): whether to select pairs randomly
+        use_gt (bool): whether to merge pairs according to ground-truth
+        rnum (int): the number of random pairs among selected pairs
+        pools (dict): lists of collected data
+        meters (MetricLogger)
+        bs (int): the number of pairs to verify each step
+        minimum_overlap_pc_num (int): the minimum number of overlapped points of adjacent sub-parts
+
+    """
+
+    def __init__(self, pc, mask_pool, centroid_label, ins_id,
+                 explore, use_gt, rnum, pools, meters,
+                 bs=8, minimum_overlap_pc_num=8):
+        self.pc = pc
+        self.ins_id = ins_id
+        self.explore = explore
+        self.use_gt = use_gt
+        self.rnum = rnum
+        self.pools = pools
+        self.meters = meters
+        self.bs = bs
+        self.BS = policy_update_bs
+        self.minimum_overlap_pc_num = minimum_overlap_pc_num
+
+        num_points = pc.shape[-1]
+        self.cur_mask_pool = mask_pool
+        self.centroid_label = centroid_label
+        self.cur_xyz_pool, _ = mask_to_xyz(pc, mask_pool)
+        cover_ratio = torch.unique(mask_pool.nonzero()[:, 1]).shape[0] / num_points
+        meters.update(cover_ratio=cover_ratio, init_pool_size=self.cur_xyz_pool.shape[0])
+        self.negative_num = 0
+        self.positive_num = 0
+
+        self.small_flag = False
+        self.zero_pair = mask_pool.new_zeros([0, 2]).long()
+        self._update_adjacency()
+
+    @property
+    def done(self):
+        return self.pair_idx.shape[0] == 0
+
+    def finish(self):
+        final_pool_size = self.negative_num + self.positive_num
+        self.meters.update(final_pool_size=final_pool_size,
+                           negative_num=self.negative_num,
+                           positive_num=self.positive_num)
+
+    def _update_adjacency(self):
+        inter_matrix = torch.matmul(self.cur_mask_pool, self.cur_mask_pool.transpose(0, 1))
+        self.inter_matrix_full = inter_matrix > self.minimum_overlap_pc_num
+        inter_matrix[self.zero_pair[:, 0], self.zero_pair[:, 1]] = 0
+        inter_matrix = inter_matrix * (1 - torch.eye(inter_matrix.shape[0], device=inter_matrix.device))
+        self.pair_idx = (inter_matrix.triu() > self.minimum_overlap_pc_num).nonzero()
+
+    def _update_score_matrix(self):
+        pair_idx = self.pair_idx
+        self.score_matrix = torch.zeros_like(self.purity_matrix)
+        self.score_matrix[pair_idx[:, 0], pair_idx[:, 1]] = F.softmax(
+            self.purity_matrix[pair_idx[:, 0], pair_idx[:, 1]] * self.policy_matrix[pair_idx[:, 0], pair_idx[:, 1]],
+            dim=0)
+
+    def propose(self):
+        """Return pairs to score by the purity and policy networks, or None"""
+        num_pairs = self.pair_idx.shape[0]
+        # when there are too few pairs, we calculate the policy score matrix on all pairs
+        if num_pairs <= self.BS and not self.small_flag:
+            self.small_flag = True
+            self._score_mode = 'init'
+            sub_part_idx = self.pair_idx
+        # if there are many pairs, we randomly sample a small batch of pairs
+        elif num_pairs > self.BS and not self.small_flag:
+            self._score_mode = 'sample'
+            self._perm_idx = torch.randperm(num_pairs).to(self.pair_idx.device)
+            sub_part_idx = self.pair_idx[self._perm_idx[:self.BS]]
+        else:
+            self._score_mode = None
+            return None
+        self._score_idx = sub_part_idx
+        return self.cur_xyz_pool[sub_part_idx[:, 0]], self.cur_xyz_pool[sub_part_idx[:, 1]]
+
+    def select(self, scores=None):
+        """Select pairs to verify according to the scores of proposed pairs"""
+        pair_idx = self.pair_idx
+        num_pairs = pair_idx.shape[0]
+        if self._score_mode == 'init':
+            purity_pool, policy_pool = scores[:2]
+            self.purity_matrix = self.cur_mask_pool.new_zeros([self.cur_mask_pool.shape[0]] * 2)
+            self.policy_matrix = self.cur_mask_pool.new_zeros([self.cur_mask_pool.shape[0]] * 2)
+            self.purity_matrix[pair_idx[:, 0], pair_idx[:, 1]] = purity_pool
+            self.policy_matrix[pair_idx[:, 0], pair_idx[:, 1]] = policy_pool
+            self._update_score_matrix()
+
+        if self._score_mode == 'sample':
+            logits_purity, policy_scores, part_xyz11, part_xyz22 = scores
+            sub_part_idx = self._score_idx
+            perm_idx = self._perm_idx
+            perm_idx_rnd = perm_idx[:self.bs]
+            self.pools['policy_purity_pool'].append(logits_purity.unsqueeze(0))
+            self.pools['policy_xyz_pool1'].append(part_xyz11.unsqueeze(0))
+            self.pools['policy_xyz_pool2'].append(part_xyz22.unsqueeze(0))
+            score = F.softmax(logits_purity * policy_scores, dim=0)
+
+            part_label1 = self.centroid_label[sub_part_idx[:, 0]]
+            part_label2 = self.centroid_label[sub_part_idx[:, 1]]
+            siamese_label_gt = ((part_label1 == part_label2) * (part_label1 != -1) * (part_label2 != -1) *
+                                (logits_purity > 0.8)).float()
+            self.pools['policy_reward_pool'].append(siamese_label_gt.unsqueeze(0))
+            loss_policy = -torch.sum(score * siamese_label_gt)
+            self.meters.update(loss_policy=loss_policy)
+
+            # we also introduce certain random samples to encourage exploration
+            _, rank_idx = torch.topk(score, self.bs, largest=True, sorted=False)
+            perm_idx = perm_idx[rank_idx]
+            perm_idx = torch.cat([perm_idx[:self.bs - self.rnum], perm_idx_rnd[:self.rnum]], dim=0)
+            if self.explore:
+                perm_idx = torch.randperm(num_pairs).to(pair_idx.device)[:self.bs]
+        else:
+            # select a pair with highest policy score
+            score = self.score_matrix[pair_idx[:, 0], pair_idx[:, 1]]
+            _, perm_idx = torch.topk(score, 1, largest=True, sorted=False)
+            if self.explore:
+                perm_idx = torch.randperm(num_pairs).to(pair_idx.device)[:1]
+
+        self.sub_part_idx = pair_idx[perm_idx[:self.bs]]
+
+    def prepare_verification(self):
+        """Collect data of selected pairs and return inputs of the verification network
+
+        Returns:
+            dict or None: None if pairs are merged according to ground-truth.
+
+        """
+        pc = self.pc
+        sub_part_idx = self.sub_part_idx
+        cur_mask_pool = self.cur_mask_pool
+        part_xyz1 = self.cur_xyz_pool[sub_part_idx[:, 0]]
+        part_xyz2 = self.cur_xyz_pool[sub_part_idx[:, 1]]
+        part_mask11 = cur_mask_pool[sub_part_idx[:, 0]]
+        part_mask22 = cur_mask_pool[sub_part_idx[:, 1]]
+        part_label1 = self.centroid_label[sub_part_idx[:, 0]]
+        part_label2 = self.centroid_label[sub_part_idx[:, 1]]
+        self.part_label1 = part_label1
+
+        new_part_mask = 1 - (1 - part_mask11) * (1 - part_mask22)
+        box_label_expand = new_part_mask.new_zeros((new_part_mask.shape[0], 200))
+        box_idx_expand = self.ins_id.unsqueeze(0).repeat(new_part_mask.shape[0], 1)
+        box_label_expand = box_label_expand.scatter_add_(dim=1, index=box_idx_expand, src=new_part_mask)
+        maximum_label_num, _ = torch.max(box_label_expand, 1)
+        total_num = torch.sum(box_label_expand, 1)
+        box_purity = maximum_label_num / (total_num + 1e-6)
+        self.pools['purity_pool'].append(box_purity)
+        purity_xyz, xyz_mean = mask_to_xyz(pc, new_part_mask)
+        purity_xyz -= xyz_mean
+        purity_xyz /= (purity_xyz + 1e-6).norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+        self.pools['purity_xyz_pool'].append(purity_xyz)
+
+        siamese_label_gt = ((part_label1 == part_label2) * (part_label1 != -1) * (part_label2 != -1) *
+                            (box_purity > 0.8)).long()
+        self.siamese_label_gt = siamese_label_gt
+        self.negative_num += torch.sum(siamese_label_gt == 0)
+        self.positive_num += torch.sum(siamese_label_gt == 1)
+
+        self.pools['xyz_pool1'].append(part_xyz1)
+        self.pools['xyz_pool2'].append(part_xyz2)
+        self.pools['label_pool'].append(siamese_label_gt.float())
+
+        # renorm, the same as the consumer
+        part_xyz, part_xyz11, part_xyz22 = renorm_pairs(part_xyz1, part_xyz2)
+
+        context_xyz = None
+        if self.cur_xyz_pool.shape[0] <= 32:
+            context_idx1 = self.inter_matrix_full[sub_part_idx[:, 0]]
+            context_idx2 = self.inter_matrix_full[sub_part_idx[:, 1]]
+            context_mask1 = (torch.matmul(context_idx1.float(), cur_mask_pool) > 0).float()
+            context_mask2 = (torch.matmul(context_idx2.float(), cur_mask_pool) > 0).float()
+            context_mask = ((context_mask1 + context_mask2) > 0).float()
+            context_xyz, xyz_mean = mask_to_xyz(pc, context_mask, sample_num=2048)
+            context_xyz = context_xyz - xyz_mean
+            context_xyz /= context_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+            self.pools['context_context_xyz_pool'].append(context_xyz)
+            self.pools['context_xyz_pool1'].append(part_xyz1)
+            self.pools['context_xyz_pool2'].append(part_xyz2)
+            self.pools['context_label_pool'].append(siamese_label_gt.float())
+            self.pools['context_purity_pool'].append(box_purity)
+
+        # at the very beginning, we group pairs according to ground-truth
+        if self.use_gt:
+            self.siamese_label = (part_label1 == part_label2).long()
+            return None
+        # if we have many sub-parts in the pool, we use the binary branch to predict
+        # if there are too few sub-parts in the pool, we use the context branch to predict
+        return dict(part_xyz=part_xyz, part_xyz11=part_xyz11, part_xyz22=part_xyz22,
+                    context_xyz=None if self.cur_xyz_pool.shape[0] > 32 else context_xyz)
+
+    def merge(self, siamese_label=None):
+        """Group sub-parts according to the prediction
+
+        Returns:
+            tuple or None: pairs of the new sub-part and its adjacent sub-parts to score
+
+        """
+        if siamese_label is None:
+            siamese_label = self.siamese_label
+        sub_part_idx = self.sub_part_idx
+        merge_sel = siamese_label.nonzero().view(-1)
+        nonmerge_sel = (1 - siamese_label).nonzero().view(-1)
+        merge_idx1 = sub_part_idx[merge_sel, 0]
+        merge_idx2 = sub_part_idx[merge_sel, 1]
+        self.merge_idx = torch.unique(torch.cat([merge_idx1, merge_idx2], dim=0))
+        self.nonmerge_idx1 = sub_part_idx[nonmerge_sel, 0]
+        self.nonmerge_idx2 = sub_part_idx[nonmerge_sel, 1]
+        part_mask1 = self.cur_mask_pool[merge_idx1]
+        part_mask2 = self.cur_mask_pool[merge_idx2]
+        new_part_mask = 1 - (1 - part_mask1) * (1 - part_mask2)
+        new_part_label = self.part_label1[merge_sel].long()
+        new_part_label_invalid = self.siamese_label_gt[merge_sel].long()
+        new_part_label = new_part_label * new_part_label_invalid + -1 * (1 - new_part_label_invalid)
+
+        # sometimes, we may obtain several identical sub-parts
+        # for those, we only keep one
+        equal_matrix = torch.matmul(new_part_mask, 1 - new_part_mask.transpose(0, 1)) + \
+                       torch.matmul(1 - new_part_mask, new_part_mask.transpose(0, 1))
+        equal_matrix += torch.eye(equal_matrix.shape[0], device=equal_matrix.device)
+        fid = (equal_matrix == 0).nonzero()
+        if fid.shape[0] > 0:
+            flag = torch.ones(equal_matrix.shape[0])
+            for k in range(flag.shape[0]):
+                if flag[k] != 0:
+                    flag[fid[:, 1][fid[:, 0] == k].cpu()] = 0
+            keep_idx = flag.nonzero().view(-1).to(new_part_mask.device)
+            new_part_mask = new_part_mask[keep_idx]
+            new_part_label = new_part_label[keep_idx]
+
+        self.new_part_mask = new_part_mask
+        self.new_part_label = new_part_label
+        self.new_part_xyz, _ = mask_to_xyz(self.pc, new_part_mask)
+
+        # when there are too few pairs, update the policy score matrix
+        # so that we do not need to calculate the whole matrix everytime
+        self.overlap_idx = None
+        if self.small_flag and new_part_mask.shape[0] > 0:
+            overlap_idx = (torch.matmul(self.cur_mask_pool, new_part_mask.transpose(0, 1)) >
+                           self.minimum_overlap_pc_num).nonzero()
+            if overlap_idx.shape[0] > 0:
+                self.overlap_idx = overlap_idx
+                return self.cur_xyz_pool[overlap_idx[:, 0]], self.new_part_xyz[overlap_idx[:, 1]]
+        return None
+
+    def update(self, scores=None):
+        """Update the pool of sub-parts with merged sub-parts"""
+        if self.small_flag and self.new_part_mask.shape[0] > 0:
+            num_new_parts = self.new_part_mask.shape[0]
+            tmp_purity_arr = self.purity_matrix.new_zeros([self.purity_matrix.shape[0], num_new_parts])
+            tmp_policy_arr = self.policy_matrix.new_zeros([self.policy_matrix.shape[0], num_new_parts])
+            if self.overlap_idx is not None:
+                overlap_purity_scores, overlap_policy_scores = scores[:2]
+                tmp_purity_arr[self.overlap_idx[:, 0], self.overlap_idx[:, 1]] = overlap_purity_scores
+                tmp_policy_arr[self.overlap_idx[:, 0], self.overlap_idx[:, 1]] = overlap_policy_scores
+            self.purity_matrix = torch.cat([self.purity_matrix, tmp_purity_arr], dim=1)
+            self.policy_matrix = torch.cat([self.policy_matrix, tmp_policy_arr], dim=1)
+            self.purity_matrix = torch.cat(
+                [self.purity_matrix, self.purity_matrix.new_zeros([num_new_parts, self.purity_matrix.shape[1]])])
+            self.policy_matrix = torch.cat(
+                [self.policy_matrix, self.policy_matrix.new_zeros([num_new_parts, self.policy_matrix.shape[1]])])
+
+        # update cur_pool, add new parts, pick out merged input pairs
+        cur_mask_pool = torch.cat([self.cur_mask_pool, self.new_part_mask], dim=0)
+        cur_xyz_pool = torch.cat([self.cur_xyz_pool, self.new_part_xyz], dim=0)
+        centroid_label = torch.cat([self.centroid_label, self.new_part_label], dim=0)
+        cur_pool_size = cur_mask_pool.shape[0]
+        new_mask = torch.ones([cur_pool_size], device=cur_mask_pool.device)
+        new_mask[self.merge_idx] = 0
+        new_idx = new_mask.nonzero().view(-1)
+        self.cur_xyz_pool = cur_xyz_pool[new_idx]
+        self.cur_mask_pool = cur_mask_pool[new_idx]
+        self.centroid_label = centroid_label[new_idx]
+
+        # update zero_matrix
+        zero_matrix = torch.zeros([cur_pool_size, cur_pool_size], device=cur_mask_pool.device)
+        zero_matrix[self.zero_pair[:, 0], self.zero_pair[:, 1]] = 1
+        zero_matrix[self.nonmerge_idx1, self.nonmerge_idx2] = 1
+        zero_matrix[self.nonmerge_idx2, self.nonmerge_idx1] = 1
+        zero_matrix = zero_matrix[new_idx][:, new_idx]
+        self.zero_pair = zero_matrix.nonzero()
+        self._update_adjacency()
+
+        if self.small_flag:
+            self.purity_matrix = self.purity_matrix[new_idx][:, new_idx]
+            self.policy_matrix = self.policy_matrix[new_idx][:, new_idx]
+            self._update_score_matrix()
+
+
+def _score_requests(model_merge, requests, max_batch_size):
+    """Score pairs of several episodes by one batch of forwards"""
+    valid = [r for r in requests if r is not None]
+    if len(valid) == 0:
+        return [None] * len(requests)
+    sizes = [r[0].shape[0] for r in valid]
+    outputs = score_pairs(model_merge,
+                          torch.cat([r[0] for r in valid], dim=0),
+                          torch.cat([r[1] for r in valid], dim=0),
+                          max_batch_size=max_batch_size)
+    outputs = list(zip(*[o.split(sizes, dim=0) for o in outputs]))
+    results = []
+    for r in requests:
+        results.append(None if r is None else outputs.pop(0))
+    return results
+
+
+def _verify_requests(model_merge, requests):
+    """Verify pairs of several episodes by one batch of forwards for each verification branch"""
+    results = [None] * len(requests)
+    for use_context in (False, True):
+        index = [i for i, r in enumerate(requests)
+                 if r is not None and (r['context_xyz'] is not None) == use_context]
+        if len(index) == 0:
+            continue
+        inputs = {k: torch.cat([requests[i][k] for i in index], dim=0)
+                  for k in ('part_xyz', 'part_xyz11', 'part_xyz22')}
+        if use_context:
+            inputs['context_xyz'] = torch.cat([requests[i]['context_xyz'] for i in index], dim=0)
+        p = verify_pairs(model_merge, **inputs)
+        sizes = [requests[i]['part_xyz'].shape[0] for i in index]
+        for i, label in zip(index, p.split(sizes, dim=0)):
+            results[i] = label
+    return results
+
+
+def rollout_episodes(model_merge, episodes, max_batch_size=1024):
+    """Step grouping episodes in lock-step like a vectorized environment
+
+    At each step, pairs of all active episodes are concatenated into one batch for
+    'purity'/'policy' and verification forwards. Finished episodes are dropped from the active set.
+
+    Args:
+        model_merge (nn.Module): grouping networks (PointNetCls)
+        episodes (list of GroupingEpisode): episodes to run
+        max_batch_size (int): the maximum number of pairs in one scoring forward
+
+    """
+    active = []
+    for episode in episodes:
+        if episode.done:
+            episode.finish()
+        else:
+            active.append(episode)
+
+    while len(active) > 0:
+        scores = _score_requests(model_merge, [e.propose() for e in active], max_batch_size)
+        for episode, score in zip(active, scores):
+            episode.select(score)
+
+        labels = _verify_requests(model_merge, [e.prepare_verification() for e in active])
+        overlap_requests = [e.merge(label) for e, label in zip(active, labels)]
+
+        scores = _score_requests(model_merge, overlap_requests, max_batch_size)
+        next_active = []
+        for episode, score in zip(active, scores):
+            episode.update(score)
+            if episode.done:
+                episode.finish()
+            else:
+                next_active.append(episode)
+        active = next_active
+
+
+def cat_pool(pool, tensors):
+    """Append tensors collected by episodes to a pool on CPU, which keeps its shape if there are none"""
+    return torch.cat([pool] + [t.cpu().type_as(pool) for t in tensors], dim=0)
+
 
 def train_one_epoch(model,
                     model_merge,
@@ -137,7 +586,11 @@ def train_one_epoch(model,
                     output_dir_merge,
                     max_grad_norm=0.0,
                     freezer=None,
-                    log_period=-1):
+                    log_period=-1,
+                    vectorized_rollout=False,
+                    rollout_batch_size=1024,
+                    shard_writer=None,
+                    shard_size=1000):
     global xyz_pool1
     global xyz_pool2
     global context_xyz_pool1
@@ -152,7 +605,6 @@ def train_one_epoch(model,
     global policy_reward_pool
     global policy_xyz_pool1
     global policy_xyz_pool2
-    global old_iteration
 
     logger = logging.getLogger('shaper.train')
     meters = MetricLogger(delimiter='  ')
@@ -162,13 +614,11 @@ def train_one_epoch(model,
     model.eval()
     loss_fn.eval()
     model_merge.eval()
-    softmax = nn.Softmax()
 
     policy_total_bs = 8
     rnum = 1 if policy_total_bs-cur_epoch < 1 else policy_total_bs-cur_epoch
     end = time.time()
 
-    buffer_txt = os.path.join(output_dir_merge, 'last_buffer')
     checkpoint_txt = os.path.join(output_dir_merge, 'last_checkpoint')
     if os.path.exists(checkpoint_txt):
         checkpoint_f = open(checkpoint_txt,'r')
@@ -239,7 +689,6 @@ def train_one_epoch(model,
         meters.update(purity_pos_num = torch.sum(box_purity_mask), purity_neg_num = torch.sum(1-box_purity_mask), purity_neg_valid_num=torch.sum(box_purity<0.6))
         centroid_valid_mask = data_batch['centroid_valid_mask'].reshape(-1).long()
         meters.update(centroid_valid_purity_ratio = torch.sum(torch.index_select(box_purity_mask, dim=0, index=centroid_valid_mask.nonzero().squeeze())).float()/torch.sum(centroid_valid_mask),centroid_nonvalid_purity_ratio = torch.sum(torch.index_select(box_purity_mask, dim=0, index=(1-centroid_valid_mask).nonzero().squeeze())).float()/torch.sum(1-centroid_valid_mask))
-        purity_pred = torch.zeros([0]).type(torch.FloatTensor).cuda()
 
         #update pool by valid_mask
         valid_mask = gtmin_mask.long() *  box_purity_mask.long() * (centroid_label!=0).long()
@@ -252,331 +701,46 @@ def train_one_epoch(model,
         #initialization
         pc_all = data_batch['points']
         centroid_label_all = centroid_label.clone()
-        sub_xyz_pool1 = torch.zeros([0,3,1024]).float().cuda()
-        sub_xyz_pool2 = torch.zeros([0,3,1024]).float().cuda()
-        sub_context_xyz_pool1 = torch.zeros([0,3,1024]).float().cuda()
-        sub_context_xyz_pool2 = torch.zeros([0,3,1024]).float().cuda()
-        sub_context_context_xyz_pool = torch.zeros([0,3,2048]).float().cuda()
-        sub_context_label_pool = torch.zeros([0]).float().cuda()
-        sub_context_purity_pool = torch.zeros([0]).float().cuda()
-        sub_label_pool = torch.zeros([0]).float().cuda()
-        sub_purity_pool = torch.zeros([0]).float().cuda()
-        sub_purity_xyz_pool = torch.zeros([0,3,1024]).float().cuda()
-        sub_policy_purity_pool = torch.zeros([0,policy_update_bs]).float().cuda()
-        sub_policy_reward_pool = torch.zeros([0,policy_update_bs]).float().cuda()
-        sub_policy_xyz_pool1 = torch.zeros([0,policy_update_bs,3,1024]).float().cuda()
-        sub_policy_xyz_pool2 = torch.zeros([0,policy_update_bs,3,1024]).float().cuda()
-        for i in range(pc_all.shape[0]):
-            bs = policy_total_bs
-            BS = policy_update_bs
-
-            pc = pc_all[i].clone()
-            cur_mask_pool = box_index_expand[cumsum_box_num[i]:cumsum_box_num[i+1]].clone()
-            centroid_label = centroid_label_all[cumsum_box_num[i]:cumsum_box_num[i+1]].clone()
-            cover_ratio = torch.unique(cur_mask_pool.nonzero()[:,1]).shape[0]/num_points
-            cur_xyz_pool, xyz_mean = mask_to_xyz(pc, cur_mask_pool)
-            init_pool_size = cur_xyz_pool.shape[0]
-            meters.update(cover_ratio=cover_ratio, init_pool_size=init_pool_size)
-            negative_num = 0
-            positive_num = 0
-
-            #intial adjacent matrix
-            inter_matrix = torch.matmul(cur_mask_pool, cur_mask_pool.transpose(0, 1))
-            inter_matrix_full = inter_matrix.clone()>minimum_overlap_pc_num
-            inter_matrix[torch.eye(inter_matrix.shape[0]).byte()] = 0
-            pair_idx = (inter_matrix.triu()>minimum_overlap_pc_num).nonzero()
-            zero_pair = torch.ones([0,2]).long()
-
-            small_flag = False
-
-            model_merge.eval()
-            with torch.no_grad():
-                while pair_idx.shape[0] > 0:
-                    #when there are too few pairs, we calculate the policy score matrix on all pairs
-                    if pair_idx.shape[0] <= BS and small_flag == False:
-                        small_flag = True
-                        purity_matrix = torch.zeros(inter_matrix.shape).cuda()
-                        policy_matrix = torch.zeros(inter_matrix.shape).cuda()
-                        bsp = 64
-                        idx = torch.arange(pair_idx.shape[0]).cuda()
-                        purity_pool = torch.zeros([0]).float().cuda()
-                        policy_pool = torch.zeros([0]).float().cuda()
-                        for k in range(int(np.ceil(idx.shape[0]/bsp))):
-                            sub_part_idx = torch.index_select(pair_idx, dim=0, index=idx[k*bsp:(k+1)*bsp])
-                            part_xyz1 = torch.index_select(cur_xyz_pool, dim=0, index=sub_part_idx[:,0])
-                            part_xyz2 = torch.index_select(cur_xyz_pool, dim=0, index=sub_part_idx[:,1])
-                            part_xyz = torch.cat([part_xyz1,part_xyz2],-1)
-                            part_xyz -= torch.mean(part_xyz,-1).unsqueeze(-1)
-                            part_norm = part_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-                            part_xyz /= part_norm
-                            logits_purity = model_merge(part_xyz, 'purity').squeeze()
-                            if len(logits_purity.shape) == 0:
-                                logits_purity = logits_purity.unsqueeze(0)
-                            purity_pool = torch.cat([purity_pool, logits_purity], dim=0)
-
-                            part_xyz11 = part_xyz1 - torch.mean(part_xyz1,-1).unsqueeze(-1)
-                            part_xyz22 = part_xyz2 - torch.mean(part_xyz2,-1).unsqueeze(-1)
-                            part_xyz11 /= part_norm
-                            part_xyz22 /= part_norm
-                            logits11 = model_merge(part_xyz11, 'policy')
-                            logits22 = model_merge(part_xyz22, 'policy')
-                            policy_scores = model_merge(torch.cat([logits11, logits22],dim=-1), 'policy_head').squeeze()
-                            if len(policy_scores.shape) == 0:
-                                policy_scores = policy_scores.unsqueeze(0)
-                            policy_pool = torch.cat([policy_pool, policy_scores], dim=0)
-
-                        purity_matrix[pair_idx[:,0],pair_idx[:,1]] = purity_pool
-                        policy_matrix[pair_idx[:,0],pair_idx[:,1]] = policy_pool
-                        score_matrix = torch.zeros(purity_matrix.shape).cuda()
-                        score_matrix[pair_idx[:,0],pair_idx[:,1]] = softmax(purity_pool*policy_pool)
-
-                    #if there are many pairs, we randomly sample a small batch of pairs and then compute the policy score matrix thereon to select pairs into the next stage
-                    #else, we select a pair with highest policy score 
-                    if pair_idx.shape[0] > BS and small_flag != True:
-                        perm_idx = torch.randperm(pair_idx.shape[0]).cuda()
-                        perm_idx_rnd = perm_idx[:bs]
-                        sub_part_idx = torch.index_select(pair_idx, dim=0, index=perm_idx[:int(BS)])
-                        part_xyz1 = torch.index_select(cur_xyz_pool, dim=0, index=sub_part_idx[:,0])
-                        part_xyz2 = torch.index_select(cur_xyz_pool, dim=0, index=sub_part_idx[:,1])
-                        part_xyz = torch.cat([part_xyz1,part_xyz2],-1)
-                        part_xyz -= torch.mean(part_xyz,-1).unsqueeze(-1)
-                        part_norm = part_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-                        part_xyz /= part_norm
-                        logits_purity = model_merge(part_xyz, 'purity').squeeze()
-                        sub_policy_purity_pool = torch.cat([sub_policy_purity_pool, logits_purity.detach().unsqueeze(0).clone()],dim=0)
-
-                        part_xyz11 = part_xyz1 - torch.mean(part_xyz1,-1).unsqueeze(-1)
-                        part_xyz22 = part_xyz2 - torch.mean(part_xyz2,-1).unsqueeze(-1)
-                        part_xyz11 /= part_norm
-                        part_xyz22 /= part_norm
-                        logits11 = model_merge(part_xyz11, 'policy')
-                        logits22 = model_merge(part_xyz22, 'policy')
-                        policy_scores = model_merge(torch.cat([logits11, logits22],dim=-1), 'policy_head').squeeze()
-                        sub_policy_xyz_pool1 = torch.cat([sub_policy_xyz_pool1, part_xyz11.unsqueeze(0).clone()], dim=0)
-                        sub_policy_xyz_pool2 = torch.cat([sub_policy_xyz_pool2, part_xyz22.unsqueeze(0).clone()], dim=0)
-                        if sub_policy_xyz_pool1.shape[0] > 64:
-                            policy_xyz_pool1 = torch.cat([policy_xyz_pool1, sub_policy_xyz_pool1.cpu().clone()], dim=0)
-                            policy_xyz_pool2 = torch.cat([policy_xyz_pool2, sub_policy_xyz_pool2.cpu().clone()], dim=0)
-                            sub_policy_xyz_pool1 = torch.zeros([0,policy_update_bs,3,1024]).float().cuda()
-                            sub_policy_xyz_pool2 = torch.zeros([0,policy_update_bs,3,1024]).float().cuda()
-                        score = softmax(logits_purity*policy_scores)
-
-                        part_label1 = torch.index_select(centroid_label, dim=0, index=sub_part_idx[:,0])
-                        part_label2 = torch.index_select(centroid_label, dim=0, index=sub_part_idx[:,1])
-                        siamese_label_gt = (part_label1 == part_label2)*(1 - (part_label1 == -1))*(1 - (part_label2 == -1))*(logits_purity>0.8)
-                        sub_policy_reward_pool = torch.cat([sub_policy_reward_pool, siamese_label_gt.unsqueeze(0).float().clone()], dim=0)
-                        loss_policy = -torch.sum(score*(siamese_label_gt.float()))
-                        meters.update(loss_policy =loss_policy)
-
-                        #we also introduce certain random samples to encourage exploration
-                        _, rank_idx = torch.topk(score,bs,largest=True,sorted=False)
-                        perm_idx = perm_idx[rank_idx]
-                        perm_idx = torch.cat([perm_idx[:policy_total_bs-rnum], perm_idx_rnd[:rnum]], dim=0)
-                        if cur_epoch == 1 and iteration < 128:
-                            perm_idx = torch.randperm(pair_idx.shape[0]).cuda()
-                            perm_idx = perm_idx[:policy_total_bs]
-                    else:
-                        score = score_matrix[pair_idx[:,0],pair_idx[:,1]]
-                        _, rank_idx = torch.topk(score,1,largest=True,sorted=False)
-                        perm_idx = rank_idx
-                        if len(perm_idx.shape) == 0:
-                            perm_idx = perm_idx.unsqueeze(0)
-
-                        if cur_epoch == 1 and iteration < 128:
-                            perm_idx = torch.randperm(pair_idx.shape[0]).cuda()
-                            perm_idx = perm_idx[:1]
-
-                    #send the selected pairs into verification network
-                    sub_part_idx = torch.index_select(pair_idx, dim=0, index=perm_idx[:bs])
-                    part_xyz1 = torch.index_select(cur_xyz_pool, dim=0, index=sub_part_idx[:,0])
-                    part_xyz2 = torch.index_select(cur_xyz_pool, dim=0, index=sub_part_idx[:,1])
-                    part_mask11 = torch.index_select(cur_mask_pool, dim=0, index=sub_part_idx[:,0])
-                    part_mask22 = torch.index_select(cur_mask_pool, dim=0, index=sub_part_idx[:,1])
-                    part_label1 = torch.index_select(centroid_label, dim=0, index=sub_part_idx[:,0])
-                    part_label2 = torch.index_select(centroid_label, dim=0, index=sub_part_idx[:,1])
-                    new_part_mask = 1-(1-part_mask11)*(1-part_mask22)
-                    box_label_expand = torch.zeros((new_part_mask.shape[0], 200)).cuda()
-                    box_idx_expand = tile(data_batch['ins_id'][i].unsqueeze(0),0,new_part_mask.shape[0]).cuda()
-                    box_label_expand = box_label_expand.scatter_add_(dim=1, index=box_idx_expand, src=new_part_mask).float()
-                    maximum_label_num, maximum_label = torch.max(box_label_expand, 1)
-                    total_num = torch.sum(box_label_expand, 1)
-                    box_purity = maximum_label_num / (total_num+1e-6)
-                    sub_purity_pool = torch.cat([sub_purity_pool, box_purity.clone()], dim=0)
-                    purity_xyz, xyz_mean = mask_to_xyz(pc, new_part_mask)
-                    purity_xyz -= xyz_mean
-                    purity_xyz /=(purity_xyz+1e-6).norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-                    sub_purity_xyz_pool = torch.cat([sub_purity_xyz_pool, purity_xyz.clone()],dim=0)
-
-                    siamese_label_gt = (part_label1 == part_label2)*(1 - (part_label1 == -1))*(1 - (part_label2 == -1))*(box_purity > 0.8)
-                    negative_num += torch.sum(siamese_label_gt == 0)
-                    positive_num += torch.sum(siamese_label_gt == 1)
-
-                    #save data
-                    sub_xyz_pool1 = torch.cat([sub_xyz_pool1, part_xyz1.clone()], dim=0)
-                    sub_xyz_pool2 = torch.cat([sub_xyz_pool2, part_xyz2.clone()], dim=0)
-                    sub_label_pool = torch.cat([sub_label_pool, siamese_label_gt.clone().float()], dim=0)
-
-                    #renorm
-                    part_xyz = torch.cat([part_xyz1,part_xyz2],-1)
-                    part_xyz -= torch.mean(part_xyz,-1).unsqueeze(-1)
-                    part_xyz11 = part_xyz1 - torch.mean(part_xyz1,-1).unsqueeze(-1)
-                    part_xyz22 = part_xyz2 - torch.mean(part_xyz2,-1).unsqueeze(-1)
-                    part_xyz11 /=part_xyz11.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-                    part_xyz22 /=part_xyz22.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-                    part_xyz /=part_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-
-                    #save data
-                    if cur_xyz_pool.shape[0] <= 32:
-                        context_idx1 = torch.index_select(inter_matrix_full,dim=0,index=sub_part_idx[:,0])
-                        context_idx2 = torch.index_select(inter_matrix_full,dim=0,index=sub_part_idx[:,1])
-                        context_mask1 = (torch.matmul(context_idx1.float(), cur_mask_pool)>0).float()
-                        context_mask2 = (torch.matmul(context_idx2.float(), cur_mask_pool)>0).float()
-                        context_mask = ((context_mask1+context_mask2)>0).float()
-                        context_xyz, xyz_mean = mask_to_xyz(pc, context_mask, sample_num=2048)
-                        context_xyz = context_xyz - xyz_mean
-                        context_xyz /= context_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-                        sub_context_context_xyz_pool = torch.cat([sub_context_context_xyz_pool, context_xyz.clone()], dim=0)
-                        sub_context_xyz_pool1 = torch.cat([sub_context_xyz_pool1, part_xyz1.clone()], dim=0)
-                        sub_context_xyz_pool2 = torch.cat([sub_context_xyz_pool2, part_xyz2.clone()], dim=0)
-                        sub_context_label_pool = torch.cat([sub_context_label_pool, siamese_label_gt.clone().float()], dim=0)
-                        sub_context_purity_pool =  torch.cat([sub_context_purity_pool, box_purity.clone()], dim=0)
-
-                    #at the very beginning, we group pairs according to ground-truth
-                    if (cur_epoch == 1 and iteration < 128) or (cur_checkpoint == 'no_checkpoint'):
-                        siamese_label = (part_label1 == part_label2)
-                    #if we have many sub-parts in the pool, we use the binary branch to predict
-                    elif cur_xyz_pool.shape[0] > 32:
-                        logits1 = model_merge(part_xyz11,'backbone')
-                        logits2 = model_merge(part_xyz22,'backbone')
-                        merge_logits = model_merge(torch.cat([part_xyz, torch.cat([logits1.unsqueeze(-1).expand(-1,-1,part_xyz1.shape[-1]), logits2.unsqueeze(-1).expand(-1,-1,part_xyz2.shape[-1])], dim=-1)], dim=1), 'head')
-                        _, p = torch.max(merge_logits, 1)
-                        siamese_label = p
-                    #if there are too few sub-parts in the pool, we use the context branch to predict
-                    else:
-                        logits1 = model_merge(part_xyz11,'backbone')
-                        logits2 = model_merge(part_xyz22,'backbone')
-                        context_logits = model_merge(context_xyz,'backbone2')
-                        merge_logits = model_merge(torch.cat([part_xyz, torch.cat([logits1.unsqueeze(-1).expand(-1,-1,part_xyz1.shape[-1]), logits2.unsqueeze(-1).expand(-1,-1,part_xyz2.shape[-1])], dim=-1), torch.cat([context_logits.unsqueeze(-1).expand(-1,-1,part_xyz.shape[-1])], dim=-1)], dim=1), 'head2')
-                        _, p = torch.max(merge_logits, 1)
-                        siamese_label = p
-
-
-                    #group sub-parts according to the prediction
-                    merge_idx1 = torch.index_select(sub_part_idx[:,0], dim=0, index=siamese_label.nonzero().squeeze())
-                    merge_idx2 = torch.index_select(sub_part_idx[:,1], dim=0, index=siamese_label.nonzero().squeeze())
-                    merge_idx = torch.unique(torch.cat([merge_idx1, merge_idx2], dim=0))
-                    nonmerge_idx1 = torch.index_select(sub_part_idx[:,0], dim=0, index=(1-siamese_label).nonzero().squeeze())
-                    nonmerge_idx2 = torch.index_select(sub_part_idx[:,1], dim=0, index=(1-siamese_label).nonzero().squeeze())
-                    part_mask1 = torch.index_select(cur_mask_pool, dim=0, index=merge_idx1)
-                    part_mask2 = torch.index_select(cur_mask_pool, dim=0, index=merge_idx2)
-                    new_part_mask = 1-(1-part_mask1)*(1-part_mask2)
-                    new_part_label = torch.index_select(part_label1, dim=0, index=siamese_label.nonzero().squeeze()).long()
-                    new_part_label_invalid = torch.index_select(siamese_label_gt, dim=0, index=siamese_label.nonzero().squeeze()).long()
-                    new_part_label = new_part_label*new_part_label_invalid + -1*(1-new_part_label_invalid)
-
-                    #sometimes, we may obtain several identical sub-parts
-                    #for those, we only keep one
-                    equal_matrix = torch.matmul(new_part_mask,1-new_part_mask.transpose(0,1))+torch.matmul(1-new_part_mask,new_part_mask.transpose(0,1))
-                    equal_matrix[torch.eye(equal_matrix.shape[0]).byte()]=1
-                    fid = (equal_matrix==0).nonzero()
-                    if fid.shape[0] > 0:
-                        flag = torch.ones(equal_matrix.shape[0])
-                        for k in range(flag.shape[0]):
-                            if flag[k] != 0:
-                                flag[fid[:,1][fid[:,0]==k]] = 0
-                        new_part_mask = torch.index_select(new_part_mask, dim=0, index=flag.nonzero().squeeze().cuda())
-                        new_part_label = torch.index_select(new_part_label, dim=0, index=flag.nonzero().squeeze().cuda())
-
-                    new_part_xyz, xyz_mean = mask_to_xyz(pc, new_part_mask)
-
-                    #when there are too few pairs, update the policy score matrix so that we do not need to calculate the whole matrix everytime
-                    if small_flag and (new_part_mask.shape[0] > 0):
-                        overlap_idx = (torch.matmul(cur_mask_pool, new_part_mask.transpose(0,1))>minimum_overlap_pc_num).nonzero().squeeze()
-                        if overlap_idx.shape[0] > 0:
-                            if len(overlap_idx.shape) == 1:
-                                overlap_idx = overlap_idx.unsqueeze(0)
-                            part_xyz1 = torch.index_select(cur_xyz_pool, dim=0, index=overlap_idx[:,0])
-                            part_xyz2 = tile(new_part_xyz, 0, overlap_idx.shape[0])
-                            part_xyz = torch.cat([part_xyz1,part_xyz2],-1)
-                            part_xyz -= torch.mean(part_xyz,-1).unsqueeze(-1)
-                            part_norm = part_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
-                            part_xyz /= part_norm
-                            overlap_purity_scores = model_merge(part_xyz, 'purity').squeeze()
-
-                            part_xyz11 = part_xyz1 - torch.mean(part_xyz1,-1).unsqueeze(-1)
-                            part_xyz22 = part_xyz2 - torch.mean(part_xyz2,-1).unsqueeze(-1)
-                            part_xyz11 /= part_norm
-                            part_xyz22 /= part_norm
-                            logits11 = model_merge(part_xyz11, 'policy')
-                            logits22 = model_merge(part_xyz22, 'policy')
-                            overlap_policy_scores = model_merge(torch.cat([logits11, logits22],dim=-1), 'policy_head').squeeze()
-
-                            tmp_purity_arr = torch.zeros([purity_matrix.shape[0]]).cuda()
-                            tmp_policy_arr = torch.zeros([policy_matrix.shape[0]]).cuda()
-                            tmp_purity_arr[overlap_idx[:,0]] = overlap_purity_scores
-                            tmp_policy_arr[overlap_idx[:,0]] = overlap_policy_scores
-                            purity_matrix = torch.cat([purity_matrix,tmp_purity_arr.unsqueeze(1)],dim=1)
-                            policy_matrix = torch.cat([policy_matrix,tmp_policy_arr.unsqueeze(1)],dim=1)
-                            purity_matrix = torch.cat([purity_matrix,torch.zeros(purity_matrix.shape[1]).cuda().unsqueeze(0)])
-                            policy_matrix = torch.cat([policy_matrix,torch.zeros(policy_matrix.shape[1]).cuda().unsqueeze(0)])
-                        else:
-                            purity_matrix = torch.cat([purity_matrix,torch.zeros(purity_matrix.shape[0]).cuda().unsqueeze(1)],dim=1)
-                            policy_matrix = torch.cat([policy_matrix,torch.zeros(policy_matrix.shape[0]).cuda().unsqueeze(1)],dim=1)
-                            purity_matrix = torch.cat([purity_matrix,torch.zeros(purity_matrix.shape[1]).cuda().unsqueeze(0)])
-                            policy_matrix = torch.cat([policy_matrix,torch.zeros(policy_matrix.shape[1]).cuda().unsqueeze(0)])
-
-                    #update cur_pool, add new parts, pick out merged input pairs
-                    cur_mask_pool = torch.cat([cur_mask_pool, new_part_mask], dim=0)
-                    cur_xyz_pool = torch.cat([cur_xyz_pool, new_part_xyz], dim=0)
-                    centroid_label = torch.cat([centroid_label, new_part_label], dim=0)
-                    cur_pool_size = cur_mask_pool.shape[0]
-                    new_mask = torch.ones([cur_pool_size])
-                    new_mask[merge_idx] = 0
-                    new_idx = new_mask.nonzero().squeeze().cuda()
-                    cur_xyz_pool = torch.index_select(cur_xyz_pool, dim=0, index=new_idx)
-                    cur_mask_pool = torch.index_select(cur_mask_pool, dim=0, index=new_idx)
-                    centroid_label = torch.index_select(centroid_label, dim=0, index=new_idx)
-                    inter_matrix = torch.matmul(cur_mask_pool, cur_mask_pool.transpose(0, 1))
-                    inter_matrix_full = inter_matrix.clone()>minimum_overlap_pc_num
-                    #update zero_matrix
-                    zero_matrix = torch.zeros([cur_pool_size, cur_pool_size])
-                    zero_matrix[zero_pair[:,0], zero_pair[:,1]] = 1
-                    zero_matrix[nonmerge_idx1, nonmerge_idx2] = 1
-                    zero_matrix[nonmerge_idx2, nonmerge_idx1] = 1
-                    zero_matrix = torch.index_select(zero_matrix, dim=0, index=new_idx.cpu())
-                    zero_matrix = torch.index_select(zero_matrix, dim=1, index=new_idx.cpu())
-                    zero_pair = zero_matrix.nonzero()
-                    inter_matrix[zero_pair[:,0], zero_pair[:,1]] = 0
-                    inter_matrix[torch.eye(inter_matrix.shape[0]).byte()] = 0
-                    pair_idx = (inter_matrix.triu()>minimum_overlap_pc_num).nonzero()
-                    if small_flag == True:
-                        purity_matrix = torch.index_select(purity_matrix, dim=0, index=new_idx)
-                        purity_matrix = torch.index_select(purity_matrix, dim=1, index=new_idx)
-                        policy_matrix = torch.index_select(policy_matrix, dim=0, index=new_idx)
-                        policy_matrix = torch.index_select(policy_matrix, dim=1, index=new_idx)
-                        score_matrix = torch.zeros(purity_matrix.shape).cuda()
-                        score_idx = pair_idx
-                        score_matrix[score_idx[:,0], score_idx[:,1]] = softmax(purity_matrix[score_idx[:,0], score_idx[:,1]] * policy_matrix[score_idx[:,0], score_idx[:,1]])
-                final_pool_size = negative_num + positive_num
-                meters.update(final_pool_size=final_pool_size,negative_num=negative_num, positive_num=positive_num)
-        xyz_pool1 = torch.cat([xyz_pool1, sub_xyz_pool1.cpu().clone()],dim=0)
-        xyz_pool2 = torch.cat([xyz_pool2, sub_xyz_pool2.cpu().clone()],dim=0)
-        label_pool = torch.cat([label_pool, sub_label_pool.cpu().clone()], dim=0)
-        context_context_xyz_pool = torch.cat([context_context_xyz_pool, sub_context_context_xyz_pool.cpu().clone()],dim=0)
-        context_xyz_pool1 = torch.cat([context_xyz_pool1, sub_context_xyz_pool1.cpu().clone()],dim=0)
-        context_xyz_pool2 = torch.cat([context_xyz_pool2, sub_context_xyz_pool2.cpu().clone()],dim=0)
-        context_label_pool = torch.cat([context_label_pool, sub_context_label_pool.cpu().clone()], dim=0)
-        context_purity_pool = torch.cat([context_purity_pool, sub_context_purity_pool.cpu().clone()], dim=0)
-        purity_purity_pool = torch.cat([purity_purity_pool, sub_purity_pool.cpu().clone()], dim=0)
-        purity_xyz_pool = torch.cat([purity_xyz_pool, sub_purity_xyz_pool.cpu().clone()], dim=0)
-        policy_purity_pool = torch.cat([policy_purity_pool, sub_policy_purity_pool.cpu().clone()], dim=0)
-        policy_reward_pool = torch.cat([policy_reward_pool, sub_policy_reward_pool.cpu().clone()], dim=0)
-        policy_xyz_pool1 = torch.cat([policy_xyz_pool1, sub_policy_xyz_pool1.cpu().clone()], dim=0)
-        policy_xyz_pool2 = torch.cat([policy_xyz_pool2, sub_policy_xyz_pool2.cpu().clone()], dim=0)
+        pools = defaultdict(list)
+        explore = cur_epoch == 1 and iteration < 128
+        episodes = [GroupingEpisode(pc_all[i].clone(),
+                                    box_index_expand[cumsum_box_num[i]:cumsum_box_num[i+1]].clone(),
+                                    centroid_label_all[cumsum_box_num[i]:cumsum_box_num[i+1]].clone(),
+                                    data_batch['ins_id'][i].long(),
+                                    explore=explore,
+                                    use_gt=explore or (cur_checkpoint == 'no_checkpoint'),
+                                    rnum=rnum,
+                                    pools=pools,
+                                    meters=meters,
+                                    bs=policy_total_bs,
+                                    minimum_overlap_pc_num=minimum_overlap_pc_num)
+                    for i in range(pc_all.shape[0])]
+        model_merge.eval()
+        with torch.no_grad():
+            if vectorized_rollout:
+                rollout_episodes(model_merge, episodes, max_batch_size=rollout_batch_size)
+            else:
+                # one shape after another
+                for episode in episodes:
+                    rollout_episodes(model_merge, [episode], max_batch_size=rollout_batch_size)
+        xyz_pool1 = cat_pool(xyz_pool1, pools['xyz_pool1'])
+        xyz_pool2 = cat_pool(xyz_pool2, pools['xyz_pool2'])
+        label_pool = cat_pool(label_pool, pools['label_pool'])
+        context_context_xyz_pool = cat_pool(context_context_xyz_pool, pools['context_context_xyz_pool'])
+        context_xyz_pool1 = cat_pool(context_xyz_pool1, pools['context_xyz_pool1'])
+        context_xyz_pool2 = cat_pool(context_xyz_pool2, pools['context_xyz_pool2'])
+        context_label_pool = cat_pool(context_label_pool, pools['context_label_pool'])
+        context_purity_pool = cat_pool(context_purity_pool, pools['context_purity_pool'])
+        purity_purity_pool = cat_pool(purity_purity_pool, pools['purity_pool'])
+        purity_xyz_pool = cat_pool(purity_xyz_pool, pools['purity_xyz_pool'])
+        policy_purity_pool = cat_pool(policy_purity_pool, pools['policy_purity_pool'])
+        policy_reward_pool = cat_pool(policy_reward_pool, pools['policy_reward_pool'])
+        policy_xyz_pool1 = cat_pool(policy_xyz_pool1, pools['policy_xyz_pool1'])
+        policy_xyz_pool2 = cat_pool(policy_xyz_pool2, pools['policy_xyz_pool2'])
         produce_time = time.time() - end
 
-        #condition
-        if context_xyz_pool1.shape[0] > 10000:
+        #write a new shard as soon as enough samples are collected
+        if context_xyz_pool1.shape[0] > shard_size:
             rbuffer = dict()
             rbuffer['xyz_pool1'] = xyz_pool1
             rbuffer['xyz_pool2'] = xyz_pool2
@@ -592,13 +756,8 @@ def train_one_epoch(model,
             rbuffer['policy_reward_pool'] = policy_reward_pool
             rbuffer['policy_xyz_pool1'] = policy_xyz_pool1
             rbuffer['policy_xyz_pool2'] = policy_xyz_pool2
-            torch.save(rbuffer, os.path.join(output_dir_merge, 'buffer', '%d_%d.pt'%(cur_epoch, iteration)))
-            buffer_f = open(buffer_txt, 'w')
-            buffer_f.write('%d_%d'%(cur_epoch, iteration))
-            buffer_f.close()
-            p = Popen('rm -rf %s'%(os.path.join(output_dir_merge, 'buffer', '%d_%d.pt'%(cur_epoch, old_iteration))), shell=True)
-            old_iteration = iteration
-            p = Popen('rm -rf %s_*'%(os.path.join(output_dir_merge, 'buffer', '%d'%(cur_epoch-1))), shell=True)
+            shard_name = shard_writer.append(rbuffer)
+            logger.info('write buffer shard %s'%shard_name)
 
             xyz_pool1 = torch.zeros([0,3,1024]).float()
             xyz_pool2 = torch.zeros([0,3,1024]).float()
@@ -639,12 +798,9 @@ def train_one_epoch(model,
 
 def train(cfg, output_dir='', output_dir_merge='', output_dir_refine=''):
     output_dir_buffer = os.path.join(output_dir_merge, 'buffer')
-    if not os.path.exists(output_dir_buffer):
-        os.mkdir(output_dir_buffer)
-    buffer_txt = os.path.join(output_dir_merge, 'last_buffer')
-    buffer_file = open(buffer_txt, 'w')
-    buffer_file.write('start')
-    buffer_file.close()
+    shard_writer = ShardWriter(output_dir_buffer,
+                               max_shards=cfg.PRODUCER.BUFFER.MAX_SHARDS,
+                               max_bytes=cfg.PRODUCER.BUFFER.MAX_BYTES)
 
     logger = logging.getLogger('shaper.train')
 
@@ -721,6 +877,10 @@ def train(cfg, output_dir='', output_dir_merge='', output_dir_refine=''):
                                        max_grad_norm=cfg.OPTIMIZER.MAX_GRAD_NORM,
                                        freezer=freezer,
                                        log_period=cfg.TRAIN.LOG_PERIOD,
+                                       vectorized_rollout=cfg.PRODUCER.VECTORIZED_ROLLOUT,
+                                       rollout_batch_size=cfg.PRODUCER.ROLLOUT_BATCH_SIZE,
+                                       shard_writer=shard_writer,
+                                       shard_size=cfg.PRODUCER.BUFFER.SHARD_SIZE,
                                        )
 
     logger.info('Best val-{} = {}'.format(cfg.TRAIN.VAL_METRIC, best_metric))
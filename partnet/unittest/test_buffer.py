@@ -0,0 +1,74 @@
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+from partnet.utils.buffer import ShardWriter, ShardReader
+
+
+def make_shard(start, num_rows):
+    return {
+        'xyz': torch.arange(start, start + num_rows).float().view(-1, 1, 1).expand(-1, 3, 4).contiguous(),
+        'label': np.arange(start, start + num_rows, dtype=np.int64),
+    }
+
+
+def test_shard_writer_reader(tmpdir):
+    buffer_dir = str(tmpdir.join('buffer'))
+    writer = ShardWriter(buffer_dir, max_shards=3)
+    reader = ShardReader(buffer_dir)
+    assert reader.refresh()
+    assert len(reader) == 0
+    assert not reader.refresh()
+
+    # rows 0-9, 10-14, 15-21, 22-25
+    sizes = [10, 5, 7, 4]
+    starts = np.cumsum([0] + sizes)
+    names = [writer.append(make_shard(start, size)) for start, size in zip(starts, sizes)]
+    # no temporary files are left
+    assert sorted(os.listdir(buffer_dir)) == sorted(names[1:] + ['manifest.json'])
+
+    assert reader.refresh()
+    version = reader.version
+    assert not reader.refresh()
+    # the oldest shard is evicted
+    assert [s['name'] for s in reader.shards] == names[1:]
+    assert reader.num_samples('label') == 16
+    label = reader['label']
+    xyz = reader['xyz']
+    assert label.shape == (16,) and xyz.shape == (16, 3, 4)
+    # gather rows across shards in any order
+    index = np.array([15, 0, 4, 5, 11, 12, 3])
+    np.testing.assert_equal(label[index], index + 10)
+    np.testing.assert_equal(xyz[torch.from_numpy(index)][:, 0, 0], index + 10)
+
+    # evicted by bytes, but the newest shard is always kept
+    writer.max_bytes = 1
+    name = writer.append(make_shard(26, 2))
+    assert reader.refresh() and reader.version > version
+    assert [s['name'] for s in reader.shards] == [name]
+    np.testing.assert_equal(reader['label'][np.arange(2)], [26, 27])
+    # memory maps of evicted shards are still readable
+    np.testing.assert_equal(label[index], index + 10)
+
+
+def test_shard_writer_restart(tmpdir):
+    buffer_dir = str(tmpdir.join('buffer'))
+    writer = ShardWriter(buffer_dir, max_shards=2)
+    names = [writer.append(make_shard(0, 3)) for _ in range(2)]
+    reader = ShardReader(buffer_dir)
+    assert reader.refresh() and len(reader) == 2
+    version = reader.version
+
+    # a restarted writer drops shards of the previous run, and continues versions and names
+    writer = ShardWriter(buffer_dir, max_shards=2)
+    assert reader.refresh()
+    assert reader.version > version
+    assert len(reader) == 0
+    for name in names:
+        assert not osp.exists(osp.join(buffer_dir, name))
+    name = writer.append(make_shard(100, 3))
+    assert name not in names
+    assert reader.refresh()
+    np.testing.assert_equal(reader['label'][np.arange(3)], [100, 101, 102])
@@ -0,0 +1,116 @@
+from collections import defaultdict
+
+import torch
+from torch import nn
+
+from core.utils.metric_logger import MetricLogger
+from partnet.train_producer import GroupingEpisode, rollout_episodes, cat_pool
+
+
+class StubMerge(nn.Module):
+    """Deterministic outputs with the shapes of PointNetCls branches"""
+
+    def forward(self, x, infer_type, y=None):
+        batch_size = x.size(0)
+        if infer_type in ('purity', 'policy_head'):
+            return torch.full((batch_size, 1), 0.9)
+        if infer_type in ('policy', 'backbone', 'backbone2'):
+            return x.mean(-1).repeat(1, 4)
+        # always merge
+        return x.new_tensor([[0.0, 1.0]]).expand(batch_size, 2)
+
+
+def make_shape(num_instances=4, num_points_per_instance=256, num_parts_per_instance=3, bridge=False):
+    """Instances along the x axis, each covered by a chain of overlapping sub-parts
+
+    If bridge is True, an impure sub-part overlaps the first two instances.
+    """
+    num_points = num_instances * num_points_per_instance
+    ins_id = torch.arange(num_instances).repeat_interleave(num_points_per_instance) + 1
+    pc = torch.rand(3, num_points)
+    pc[0] += ins_id.float()
+    part_size = num_points_per_instance // num_parts_per_instance + 32
+    starts = torch.linspace(0, num_points_per_instance - part_size, num_parts_per_instance).long().tolist()
+    mask_pool, centroid_label = [], []
+    for k in range(num_instances):
+        for j in range(num_parts_per_instance):
+            mask = torch.zeros(num_points)
+            start = k * num_points_per_instance + starts[j]
+            mask[start:start + part_size] = 1
+            mask_pool.append(mask)
+            centroid_label.append(k + 1)
+    if bridge:
+        mask = torch.zeros(num_points)
+        mask[num_points_per_instance - 32:num_points_per_instance + 32] = 1
+        mask_pool.append(mask)
+        centroid_label.append(-1)
+    return pc, torch.stack(mask_pool), torch.tensor(centroid_label), ins_id
+
+
+def run_episodes(use_gt, vectorized, num_shapes=2):
+    torch.manual_seed(0)
+    pools = defaultdict(list)
+    episodes = []
+    for _ in range(num_shapes):
+        # the stub always merges, so only ground-truth grouping can keep the bridge apart
+        pc, mask_pool, centroid_label, ins_id = make_shape(bridge=use_gt)
+        episodes.append(GroupingEpisode(pc, mask_pool, centroid_label, ins_id,
+                                        explore=False, use_gt=use_gt, rnum=1, pools=pools, meters=MetricLogger()))
+    model_merge = StubMerge()
+    with torch.no_grad():
+        if vectorized:
+            rollout_episodes(model_merge, episodes)
+        else:
+            for episode in episodes:
+                rollout_episodes(model_merge, [episode])
+    return episodes, pools
+
+
+def test_grouping_episode_steps():
+    pc, mask_pool, centroid_label, ins_id = make_shape()
+    pools = defaultdict(list)
+    episode = GroupingEpisode(pc, mask_pool, centroid_label, ins_id,
+                              explore=False, use_gt=True, rnum=1, pools=pools, meters=MetricLogger())
+    assert not episode.done
+    num_parts = episode.cur_mask_pool.shape[0]
+    # few pairs, so all of them are scored
+    part_xyz1, part_xyz2 = episode.propose()
+    assert part_xyz1.shape == (episode.pair_idx.shape[0], 3, 1024)
+    num_pairs = part_xyz1.shape[0]
+    episode.select((torch.rand(num_pairs), torch.rand(num_pairs)))
+    assert episode.sub_part_idx.shape == (1, 2)
+    # merged by ground-truth labels
+    assert episode.prepare_verification() is None
+    overlap_request = episode.merge()
+    scores = None
+    if overlap_request is not None:
+        scores = (torch.rand(overlap_request[0].shape[0]), torch.rand(overlap_request[0].shape[0]))
+    episode.update(scores)
+    # two sub-parts of the same instance are replaced by their union
+    assert episode.cur_mask_pool.shape[0] == num_parts - 1
+    assert episode.purity_matrix.shape == (num_parts - 1, num_parts - 1)
+    assert len(pools['xyz_pool1']) == 1 and len(pools['label_pool']) == 1
+
+
+def test_rollout_episodes():
+    for use_gt in (True, False):
+        for vectorized in (True, False):
+            episodes, pools = run_episodes(use_gt, vectorized)
+            for episode in episodes:
+                assert episode.done
+                # sub-parts of each instance are merged into one, and different instances are kept apart
+                labels = episode.centroid_label.tolist()
+                assert sorted(labels) == ([-1] if use_gt else []) + [1, 2, 3, 4]
+                for mask, label in zip(episode.cur_mask_pool, labels):
+                    if label == -1:
+                        continue
+                    assert torch.equal(mask.nonzero().view(-1), (episode.ins_id == label).nonzero().view(-1))
+            assert sum(x.shape[0] for x in pools['label_pool']) == sum(x.shape[0] for x in pools['xyz_pool1'])
+
+
+def test_cat_pool():
+    pool = torch.zeros([0, 3, 8])
+    # nothing collected, the empty pool keeps its shape
+    assert cat_pool(pool, []).shape == (0, 3, 8)
+    pool = cat_pool(pool, [torch.ones(2, 3, 8), torch.ones(1, 3, 8, dtype=torch.float64)])
+    assert pool.shape == (3, 3, 8) and pool.dtype == torch.float32
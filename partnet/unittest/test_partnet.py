@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+
+from shaper.data import transforms as T
+from partnet.data.partnet import transform_with_boundary
+from partnet.data.build import collate
+
+
+def test_transform_with_boundary():
+    np.random.seed(0)
+    torch.manual_seed(0)
+    num_points = 1000
+    transform = T.ComposeSeg([T.ToTensor(), T.Shuffle(), T.Sample(800), T.RandomDropout(), T.Transpose()])
+    for _ in range(5):
+        points = np.random.rand(num_points, 3).astype(np.float32) * 2 - 1
+        ins_id = np.random.randint(0, 5, num_points)
+        # a property of each point, which must move with the point
+        boundary = (points[:, 0] > 0).astype(np.uint8)
+        ins_id_ref = ins_id.copy()
+        new_points, new_ins_id, new_boundary = transform_with_boundary(transform, points.copy(), ins_id, boundary)
+        assert new_points.shape == (3, 800)
+        assert new_ins_id.shape == new_boundary.shape == (800,)
+
+        dropped = new_ins_id == -100
+        assert dropped.any() or new_ins_id.min() >= 0
+        # points dropped by RandomDropout are not on the boundary
+        assert new_boundary[dropped].sum() == 0
+        new_points = new_points.numpy()
+        kept = ~dropped
+        np.testing.assert_equal(new_boundary[kept], (new_points[0, kept] > 0).astype(np.uint8))
+        # instance ids move with points
+        point_index = [np.flatnonzero((points == p).all(axis=1))[0] for p in new_points.T[kept]]
+        np.testing.assert_equal(new_ins_id[kept], ins_id_ref[point_index])
+
+
+def test_batch_transform_with_boundary():
+    torch.manual_seed(0)
+    batch_size, num_points = 4, 1000
+    transform = T.BatchComposeSeg([T.BatchShuffle(), T.BatchSample(800), T.BatchRandomDropout(), T.BatchTranspose()])
+    points = torch.rand(batch_size, num_points, 3) * 2 - 1
+    ins_id = torch.randint(0, 5, (batch_size, num_points))
+    boundary = (points[:, :, 0] > 0).type(torch.uint8)
+    new_points, new_ins_id, new_boundary = transform_with_boundary(transform, points.clone(), ins_id, boundary)
+    assert new_points.shape == (batch_size, 3, 800)
+    assert new_ins_id.shape == new_boundary.shape == (batch_size, 800)
+    assert new_boundary.dtype == torch.uint8
+
+    dropped = new_ins_id == -100
+    assert dropped.any()
+    assert new_boundary[dropped].sum() == 0
+    kept = ~dropped
+    np.testing.assert_equal(new_boundary[kept].numpy(), (new_points[:, 0][kept] > 0).numpy().astype(np.uint8))
+    for b in range(batch_size):
+        point_index = [(points[b] == p).all(dim=1).nonzero()[0, 0].item() for p in new_points[b].t()[kept[b]]]
+        np.testing.assert_equal(new_ins_id[b][kept[b]].numpy(), ins_id[b, point_index].numpy())
+
+
+def test_collate_ls_large_radius():
+    torch.manual_seed(0)
+    batch_size, num_points, num_centroids, num_neighbours = 2, 1000, 8, 64
+    batch = [{'points': torch.rand(3, num_points) * 2 - 1, 'ins_id': torch.randint(1, 5, (num_points,))}
+             for _ in range(batch_size)]
+    # radii larger than 0.5 give less than two nodes per axis, which are clamped to the two ends
+    for radius in (0.1, 0.8, 2.0):
+        data_batch = collate(batch, num_centroids, radius, num_neighbours,
+                             with_renorm=False, with_resample=False, with_shift=False,
+                             sample_method='LS', device='cpu')
+        assert data_batch['neighbour_index'].shape == (batch_size, num_centroids, num_neighbours)
+        centroid_index = data_batch['centroid_index']
+        assert centroid_index.shape == (batch_size, num_centroids)
+        assert ((centroid_index >= 0) & (centroid_index < num_points)).all()
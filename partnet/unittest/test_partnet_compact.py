@@ -0,0 +1,96 @@
+import json
+import os
+import os.path as osp
+import pickle
+import sys
+
+import h5py
+import numpy as np
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, osp.join(osp.dirname(__file__), '..', '..', 'tools'))
+
+from convert_partnet_compact import convert_h5
+from partnet.data.partnet import PartNetInsSeg, PartNetCompactInsSeg
+
+NUM_SHAPES = 3
+NUM_POINTS = 64
+
+
+def write_h5_store(root_dir):
+    """Write a tiny h5 file of the train split of Bag-1"""
+    rng = np.random.RandomState(0)
+    folder_path = osp.join(root_dir, 'Bag-1')
+    os.makedirs(folder_path)
+    gt_mask = np.zeros((NUM_SHAPES, 200, NUM_POINTS), dtype=bool)
+    gt_valid = np.zeros((NUM_SHAPES, 200), dtype=bool)
+    gt_other_mask = np.zeros((NUM_SHAPES, NUM_POINTS), dtype=bool)
+    for i in range(NUM_SHAPES):
+        # 4 instances of 16 points
+        for k in range(4):
+            gt_mask[i, k, k * 16:(k + 1) * 16] = True
+        gt_valid[i, :4] = True
+    # an empty valid instance
+    gt_valid[1, 4] = True
+    # an instance covered by the other mask
+    gt_other_mask[2, 48:] = True
+    with h5py.File(osp.join(folder_path, 'train-00.h5'), 'w') as f:
+        f.create_dataset('pts', data=rng.rand(NUM_SHAPES, NUM_POINTS, 3).astype(np.float32))
+        f.create_dataset('gt_label', data=np.zeros((NUM_SHAPES, NUM_POINTS), dtype=np.uint8))
+        f.create_dataset('gt_mask', data=gt_mask)
+        f.create_dataset('gt_valid', data=gt_valid)
+        f.create_dataset('gt_other_mask', data=gt_other_mask)
+    with open(osp.join(folder_path, 'train-00.json'), 'w') as f:
+        json.dump([{'anno_id': str(i)} for i in range(NUM_SHAPES)], f)
+
+
+def write_compact_store(h5_dir, compact_dir, with_gt_valid=True):
+    os.makedirs(osp.join(compact_dir, 'Bag-1'))
+    convert_h5(osp.join(h5_dir, 'Bag-1', 'train-00.h5'), osp.join(compact_dir, 'Bag-1', 'train-00'))
+    if not with_gt_valid:
+        # stores converted before gt_valid.npy is added
+        os.remove(osp.join(compact_dir, 'Bag-1', 'train-00.gt_valid.npy'))
+
+
+def test_compact_round_trip(tmpdir):
+    h5_dir = str(tmpdir.join('h5'))
+    write_h5_store(h5_dir)
+    h5_dataset = PartNetInsSeg(h5_dir, 'train', normalize=False, shape='Bag', level=1)
+    for with_gt_valid in (True, False):
+        compact_dir = str(tmpdir.join('compact_{}'.format(with_gt_valid)))
+        write_compact_store(h5_dir, compact_dir, with_gt_valid=with_gt_valid)
+        for cache_mode in (True, False):
+            dataset = PartNetCompactInsSeg(compact_dir, 'train', normalize=False, shape='Bag', level=1,
+                                           cache_mode=cache_mode)
+            assert len(dataset) == NUM_SHAPES
+            for index in range(NUM_SHAPES):
+                data = dataset[index]
+                ref = h5_dataset[index]
+                np.testing.assert_equal(data['points'], ref['points'])
+                np.testing.assert_equal(data['ins_id'], ref['ins_id'])
+                if with_gt_valid or index == 0:
+                    np.testing.assert_equal(data['gt_valid'], ref['gt_valid'])
+                else:
+                    # valid instances without points are missed
+                    assert data['gt_valid'].sum() == ref['gt_valid'].sum() - 1
+
+
+def test_compact_workers(tmpdir):
+    """Load the compact store in spawned DataLoader workers, with memory maps opened lazily in each worker"""
+    h5_dir = str(tmpdir.join('h5'))
+    compact_dir = str(tmpdir.join('compact'))
+    write_h5_store(h5_dir)
+    write_compact_store(h5_dir, compact_dir)
+    dataset = PartNetCompactInsSeg(compact_dir, 'train', normalize=False, shape='Bag', level=1, cache_mode=False)
+    ref = [dataset[index] for index in range(NUM_SHAPES)]
+    # memory maps opened by the main process are not pickled
+    assert len(dataset._mmap) > 0
+    assert pickle.loads(pickle.dumps(dataset))._mmap == {}
+
+    dataloader = DataLoader(dataset, batch_size=1, shuffle=False, num_workers=2,
+                            multiprocessing_context='spawn')
+    for _ in range(2):
+        for index, data_batch in enumerate(dataloader):
+            np.testing.assert_equal(data_batch['points'][0].numpy(), ref[index]['points'])
+            np.testing.assert_equal(data_batch['ins_id'][0].numpy(), ref[index]['ins_id'])
+            np.testing.assert_equal(data_batch['gt_valid'][0].numpy(), ref[index]['gt_valid'])
@@ -0,0 +1,120 @@
+import torch
+from torch import nn
+
+from core.nn import SharedMLP
+from core.nn.init import randomize_bn
+from core.nn.quantize import quantize_dynamic, quantize_dynamic_cpu
+from partnet.models.pn2 import PointNetCls
+import shaper.models.pointnet2.functions as _F
+
+
+def broadcast_head_input(xyz, global_features):
+    """The concatenated input of the verification heads, as in train_consumer"""
+    feature = [xyz]
+    for features in global_features:
+        segment_size = xyz.size(2) // len(features)
+        feature.append(torch.cat([f.unsqueeze(2).expand(-1, -1, segment_size) for f in features], dim=2))
+    return torch.cat(feature, dim=1)
+
+
+def merge_scores(model, xyz):
+    """Scores of the decisions in grouping: purity of xyz, and policy and verification of pairs of its halves"""
+    num_pairs = xyz.size(0) // 2
+    xyz1, xyz2 = xyz[:num_pairs], xyz[num_pairs:]
+    purity = model(xyz, 'purity').squeeze(1)
+    policy = model(torch.cat([model(xyz1, 'policy'), model(xyz2, 'policy')], dim=-1), 'policy_head').squeeze(1)
+    logits1, logits2 = model(xyz1, 'backbone'), model(xyz2, 'backbone')
+    merge_logits = model(torch.cat([xyz1, xyz2], dim=2), 'head', ((logits1, logits2),))
+    return purity, policy, merge_logits
+
+
+def test_head_global_features():
+    torch.manual_seed(0)
+    num_pairs, num_samples = 8, 64
+    model = PointNetCls(in_channels=3, out_channels=16)
+    randomize_bn(model)
+    xyz = torch.randn(num_pairs, 3, 2 * num_samples)
+    logits1, logits2, context_logits = torch.randn(3, num_pairs, 16).unbind(0)
+    inputs = [('head', ((logits1, logits2),)), ('head2', ((logits1, logits2), (context_logits,)))]
+
+    for training in (False, True):
+        model.train(training)
+        for infer_type, global_features in inputs:
+            # the same dropout masks
+            torch.manual_seed(1)
+            out = model(xyz, infer_type, global_features)
+            torch.manual_seed(1)
+            out_ref = model(broadcast_head_input(xyz, global_features), infer_type)
+            assert torch.allclose(out, out_ref, atol=1e-4)
+
+    # the quantized stem falls back to the concatenated input
+    model.eval()
+    quantized_model = quantize_dynamic(model)
+    assert not isinstance(quantized_model.stem8.mlp, SharedMLP)
+    with torch.no_grad():
+        for infer_type, global_features in inputs:
+            out = quantized_model(xyz, infer_type, global_features)
+            out_ref = quantized_model(broadcast_head_input(xyz, global_features), infer_type)
+            assert torch.equal(out, out_ref)
+
+
+def test_tuple_infer_type(monkeypatch):
+    torch.manual_seed(0)
+    num_calls = [0]
+    ball_query = _F.ball_query
+
+    def ball_query_count(*args, **kwargs):
+        num_calls[0] += 1
+        return ball_query(*args, **kwargs)
+
+    monkeypatch.setattr(_F, 'ball_query', ball_query_count)
+    model = PointNetCls(in_channels=3, out_channels=16)
+    randomize_bn(model)
+    model.eval()
+    x = torch.rand(4, 3, 512) * 2 - 1
+    infer_type = ('backbone', 'policy', 'purity')
+
+    # a single replica runs the module itself on CPU, and scatters the tuple to each replica on GPUs
+    for module in (model, nn.DataParallel(model)):
+        with torch.no_grad():
+            num_calls[0] = 0
+            outs_ref = [module(x, t) for t in infer_type]
+            num_calls_ref = num_calls[0]
+            num_calls[0] = 0
+            outs = module(x, infer_type)
+        assert isinstance(outs, tuple) and len(outs) == len(infer_type)
+        for out, out_ref in zip(outs, outs_ref):
+            assert out.shape == out_ref.shape
+            assert torch.allclose(out, out_ref, atol=1e-5)
+        # sampling and grouping are shared by the branches
+        assert num_calls[0] < num_calls_ref
+
+
+def test_quantize_dynamic_decisions():
+    torch.manual_seed(0)
+    model = PointNetCls(in_channels=3, out_channels=16)
+    # parts of various sizes
+    xyz = (torch.rand(128, 3, 256) * 2 - 1) * torch.rand(128, 3, 1)
+    randomize_bn(model)
+    # running statistics of the inputs, otherwise scores of random weights hardly depend on them
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.reset_running_stats()
+            m.momentum = None
+    model.train()
+    with torch.no_grad():
+        merge_scores(model, xyz)
+        model.eval()
+        purity, policy, merge_logits = merge_scores(model, xyz)
+        purity_q, policy_q, merge_logits_q = merge_scores(quantize_dynamic_cpu(model), xyz)
+
+    # thresholds at fp32 medians, so that both decisions are frequent
+    p_thresh = purity.median()
+    purity_acc = ((purity > p_thresh) == (purity_q > p_thresh)).float().mean()
+    # the pair to merge among candidates
+    policy_acc = (policy.view(8, 8).argmax(1) == policy_q.view(8, 8).argmax(1)).float().mean()
+    margin, margin_q = merge_logits[:, 1] - merge_logits[:, 0], merge_logits_q[:, 1] - merge_logits_q[:, 0]
+    merge_acc = ((margin > margin.median()) == (margin_q > margin.median())).float().mean()
+    # random weights have small margins compared to trained models, so only gross errors are caught,
+    # where agreement falls to chance
+    assert purity_acc >= 0.6 and policy_acc >= 0.6 and merge_acc >= 0.6
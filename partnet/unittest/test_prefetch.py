@@ -0,0 +1,68 @@
+import numpy as np
+import torch
+
+from partnet.utils.prefetch import MinibatchPrefetcher
+from partnet.utils.torch_pc import renorm_pairs
+
+
+def make_pools(num_samples=50):
+    return {
+        'index': torch.arange(num_samples),
+        'part_xyz1': torch.rand(num_samples, 3, 16),
+        'part_xyz2': np.random.rand(num_samples, 3, 16).astype(np.float32),
+    }
+
+
+def test_minibatch_prefetcher():
+    torch.manual_seed(0)
+    pools = make_pools()
+
+    def transform(batch):
+        batch['part_xyz'], batch['part_xyz1'], batch['part_xyz2'] = renorm_pairs(batch['part_xyz1'], batch['part_xyz2'])
+        return batch
+
+    prefetcher = MinibatchPrefetcher(pools, batch_size=8, train_len=40, transform=transform, device='cpu')
+    # the incomplete last batch is dropped
+    assert len(prefetcher) == 5
+    batches = list(prefetcher)
+    assert len(batches) == 5
+    index = torch.cat([batch['index'] for batch in batches])
+    # rows are drawn without replacement, and each row is loaded from all the pools
+    assert len(set(index.tolist())) == 40
+    for batch in batches:
+        assert batch['part_xyz'].shape == (8, 3, 32)
+        np.testing.assert_allclose(batch['part_xyz'].norm(dim=1).max(dim=-1)[0].numpy(), 1.0, rtol=1e-5)
+        ref_xyz = pools['part_xyz1'][batch['index']]
+        ref_xyz = ref_xyz - ref_xyz.mean(-1, keepdim=True)
+        ref_xyz = ref_xyz / ref_xyz.norm(dim=1).max(dim=-1)[0].view(-1, 1, 1)
+        np.testing.assert_allclose(batch['part_xyz1'].numpy(), ref_xyz.numpy(), rtol=1e-5, atol=1e-6)
+    assert not prefetcher._thread.is_alive()
+
+    # fewer samples than train_len
+    prefetcher = MinibatchPrefetcher(pools, batch_size=16, train_len=1024)
+    assert len(list(prefetcher)) == 3
+
+
+def test_minibatch_prefetcher_shutdown():
+    pools = make_pools(200)
+    # the thread is blocked on the full queue
+    prefetcher = MinibatchPrefetcher(pools, batch_size=2, train_len=200, num_prefetch=1)
+    for _ in prefetcher:
+        break
+    assert not prefetcher._thread.is_alive()
+    assert prefetcher._queue.empty()
+
+    prefetcher = MinibatchPrefetcher(pools, batch_size=2, train_len=200, num_prefetch=1)
+    prefetcher.close()
+    assert not prefetcher._thread.is_alive()
+
+    def transform(batch):
+        raise ValueError('broken transform')
+
+    prefetcher = MinibatchPrefetcher(pools, batch_size=2, train_len=200, transform=transform)
+    try:
+        list(prefetcher)
+        assert False
+    except ValueError:
+        pass
+    assert not prefetcher._thread.is_alive()
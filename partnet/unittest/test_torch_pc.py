@@ -0,0 +1,102 @@
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+import shaper.models.pointnet2.functions as _F
+from partnet.utils.torch_pc import voxel_grid_sample, knn_label_boundary, ball_query_kdtree
+
+
+def voxel_key_np(points, voxel_size, low=-1.0):
+    """Return the voxel key of each point in [-1, 1]^3 and the distance to its voxel centre"""
+    voxel = np.round((points.transpose(0, 2, 1) - low) / voxel_size)
+    dist = np.linalg.norm(points.transpose(0, 2, 1) - (voxel * voxel_size + low), axis=2)
+    num_voxels = int(round(2.0 / voxel_size)) + 1
+    voxel = voxel.astype(np.int64)
+    key = (voxel[..., 0] * num_voxels + voxel[..., 1]) * num_voxels + voxel[..., 2]
+    return key, dist
+
+
+def test_voxel_grid_sample():
+    torch.manual_seed(0)
+    voxel_size = 0.25
+    points = torch.rand(2, 3, 2048) * 2 - 1
+    key, dist = voxel_key_np(points.numpy(), voxel_size)
+
+    # more occupied voxels than samples: a random subset of voxels, each sampled once
+    index = voxel_grid_sample(points, voxel_size, 128).numpy()
+    assert index.shape == (2, 128)
+    for b in range(2):
+        sample_key = key[b, index[b]]
+        assert np.unique(sample_key).size == 128
+        # the sample of each voxel is the point nearest to its centre
+        for i, k in zip(index[b], sample_key):
+            assert dist[b, i] <= dist[b, key[b] == k].min() + 1e-6
+
+    # fewer occupied voxels than samples: all the voxels, padded by repeating samples
+    points[1, :, 1024:] = points[1, :, :1]
+    key, dist = voxel_key_np(points.numpy(), voxel_size)
+    index = voxel_grid_sample(points, voxel_size, 1000).numpy()
+    assert index.shape == (2, 1000)
+    for b in range(2):
+        num_voxels = np.unique(key[b]).size
+        assert num_voxels < 1000
+        assert np.unique(key[b, index[b]]).size == num_voxels
+        assert np.unique(index[b]).size == num_voxels
+        np.testing.assert_equal(index[b], index[b, np.arange(1000) % num_voxels])
+
+
+def knn_label_boundary_np(points, labels, k):
+    boundary = []
+    for points_per_batch, labels_per_batch in zip(points, labels):
+        tree = cKDTree(points_per_batch.T)
+        _, knn_index = tree.query(points_per_batch.T, k=k + 1)
+        boundary.append((labels_per_batch[knn_index] != labels_per_batch[:, None]).any(axis=1))
+    return np.asarray(boundary, dtype=np.uint8)
+
+
+def test_knn_label_boundary():
+    torch.manual_seed(0)
+    points = torch.rand(2, 3, 1000, dtype=torch.float64)
+    # labels of slabs along x, so that only points near the cuts are on the boundary
+    labels = (points[:, 0] * 4).long()
+    boundary_np = knn_label_boundary_np(points.numpy(), labels.numpy(), k=8)
+    assert 0 < boundary_np.sum() < boundary_np.size
+
+    boundary = knn_label_boundary(points, labels, k=8)
+    assert boundary.dtype == torch.uint8
+    np.testing.assert_equal(boundary.numpy(), boundary_np)
+    # chunks, including an incomplete last chunk, give the same result
+    boundary_chunk = knn_label_boundary(points, labels, k=8, chunk_size=300)
+    np.testing.assert_equal(boundary_chunk.numpy(), boundary_np)
+
+
+def test_ball_query_kdtree():
+    torch.manual_seed(0)
+    radius = 0.2
+    num_neighbours = 32
+    points = torch.rand(2, 3, 2000, dtype=torch.float64)
+    centroid_index = torch.randint(0, 2000, (2, 100))
+    centroids = _F.gather_points(points, centroid_index)
+    # the reference keeps the first neighbours in the order of indices
+    index_ref, count_ref = _F.ball_query(points, centroids, radius, num_neighbours)
+    dist = (centroids.unsqueeze(3) - points.unsqueeze(2)).pow(2).sum(1).sqrt()
+    num_inside = (dist < radius).sum(2)
+    assert (num_inside < num_neighbours).any() and (num_inside > num_neighbours).any()
+
+    index = ball_query_kdtree(points, centroids, radius, num_neighbours)
+    index_fill = ball_query_kdtree(points, centroids, radius, num_neighbours, fill_index=centroid_index)
+    assert index.shape == index_fill.shape == (2, 100, num_neighbours)
+    for b in range(2):
+        for i in range(100):
+            count = count_ref[b, i].item()
+            # neighbours are sorted by distance, and truncated to the nearest ones
+            neighbour_dist = dist[b, i, index[b, i, :count]]
+            assert (neighbour_dist[1:] >= neighbour_dist[:-1]).all()
+            assert set(index[b, i, :count].tolist()) == \
+                set(dist[b, i].argsort()[:count].tolist())
+            if num_inside[b, i] <= num_neighbours:
+                assert set(index[b, i, :count].tolist()) == set(index_ref[b, i, :count].tolist())
+            # empty slots are filled by the nearest neighbour, or fill_index if given
+            assert (index[b, i, count:] == index[b, i, 0]).all()
+            assert (index_fill[b, i, count:] == centroid_index[b, i]).all()
+            np.testing.assert_equal(index_fill[b, i, :count].numpy(), index[b, i, :count].numpy())
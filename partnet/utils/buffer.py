@@ -0,0 +1,196 @@
+"""Append-only replay buffer shards shared by the producer and the consumer
+
+Layout of the buffer directory:
+    manifest.json: the list of live shards (written atomically)
+    <shard_name>/<key>.npy: one array per pool in each shard
+
+The producer appends shards and evicts the oldest ones beyond the retention window.
+The consumer memory-maps the live shards and samples across all of them.
+"""
+
+import os
+import os.path as osp
+import json
+import shutil
+
+import numpy as np
+import torch
+
+MANIFEST = 'manifest.json'
+
+
+def _read_manifest(buffer_dir):
+    path = osp.join(buffer_dir, MANIFEST)
+    if not osp.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_manifest(buffer_dir, manifest):
+    path = osp.join(buffer_dir, MANIFEST)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+class ShardWriter(object):
+    """Write pools as append-only shards with a bounded retention window
+
+    Args:
+        buffer_dir (str): the buffer directory
+        max_shards (int): the maximum number of live shards. Non-positive for no limit.
+        max_bytes (int): the maximum total bytes of live shards. Non-positive for no limit.
+            The newest shard is always kept.
+
+    """
+
+    def __init__(self, buffer_dir, max_shards=10, max_bytes=0):
+        self.buffer_dir = buffer_dir
+        self.max_shards = max_shards
+        self.max_bytes = max_bytes
+        os.makedirs(buffer_dir, exist_ok=True)
+
+        # start from an empty window, but keep the version increasing for readers
+        manifest = _read_manifest(buffer_dir)
+        next_id = manifest['next_id'] + 1 if manifest is not None else 0
+        for shard in (manifest['shards'] if manifest is not None else []):
+            self._remove(shard['name'])
+        self.manifest = {'next_id': next_id, 'shards': []}
+        _write_manifest(buffer_dir, self.manifest)
+
+    def _remove(self, name):
+        shutil.rmtree(osp.join(self.buffer_dir, name), ignore_errors=True)
+
+    def append(self, pools):
+        """Write a new shard
+
+        Args:
+            pools (dict): name -> torch.Tensor or np.ndarray
+
+        Returns:
+            str: the name of the new shard
+
+        """
+        name = '%08d' % self.manifest['next_id']
+        tmp_dir = osp.join(self.buffer_dir, name + '.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        shapes = {}
+        dtypes = {}
+        num_bytes = 0
+        for k, v in pools.items():
+            if isinstance(v, torch.Tensor):
+                v = v.detach().cpu().numpy()
+            np.save(osp.join(tmp_dir, k + '.npy'), np.ascontiguousarray(v))
+            shapes[k] = list(v.shape)
+            dtypes[k] = v.dtype.str
+            num_bytes += v.nbytes
+        # make the shard visible only when all the files are written
+        os.rename(tmp_dir, osp.join(self.buffer_dir, name))
+
+        shards = self.manifest['shards'] + [{'name': name, 'shapes': shapes, 'dtypes': dtypes, 'bytes': num_bytes}]
+        evicted = []
+        while len(shards) > 1:
+            too_many = self.max_shards > 0 and len(shards) > self.max_shards
+            too_large = self.max_bytes > 0 and sum(s['bytes'] for s in shards) > self.max_bytes
+            if not (too_many or too_large):
+                break
+            evicted.append(shards.pop(0))
+        self.manifest = {'next_id': self.manifest['next_id'] + 1, 'shards': shards}
+        _write_manifest(self.buffer_dir, self.manifest)
+        # readers holding memory maps of evicted shards are not affected by unlinking
+        for shard in evicted:
+            self._remove(shard['name'])
+        return name
+
+
+class ShardedArray(object):
+    """A read-only concatenation of memory-mapped arrays along the first dimension"""
+
+    def __init__(self, arrays, row_shape, dtype):
+        self.arrays = [a for a in arrays if a.shape[0] > 0]
+        self.offsets = np.cumsum([0] + [a.shape[0] for a in self.arrays])
+        self.shape = (int(self.offsets[-1]),) + tuple(row_shape)
+        self.dtype = dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """Gather rows by global indices
+
+        Args:
+            index (np.ndarray or torch.Tensor): (n,), global row indices
+
+        Returns:
+            np.ndarray: (n, ...)
+
+        """
+        if isinstance(index, torch.Tensor):
+            index = index.cpu().numpy()
+        index = np.asarray(index, dtype=np.int64)
+        out = np.empty((index.shape[0],) + self.shape[1:], dtype=self.dtype)
+        shard_idx = np.searchsorted(self.offsets, index, side='right') - 1
+        for i in np.unique(shard_idx):
+            sel = np.nonzero(shard_idx == i)[0]
+            local_idx = index[sel] - self.offsets[i]
+            # sorted reads are friendly to the page cache
+            order = np.argsort(local_idx)
+            out[sel[order]] = self.arrays[i][local_idx[order]]
+        return out
+
+
+class ShardReader(object):
+    """Memory-map the live shards listed in the manifest
+
+    Args:
+        buffer_dir (str): the buffer directory
+
+    """
+
+    def __init__(self, buffer_dir):
+        self.buffer_dir = buffer_dir
+        self.version = -1
+        self.shards = []
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.shards)
+
+    def refresh(self):
+        """Reload the manifest
+
+        Returns:
+            bool: whether the window has changed
+
+        """
+        manifest = _read_manifest(self.buffer_dir)
+        if manifest is None or manifest['next_id'] == self.version:
+            return False
+        arrays = {}
+        for shard in manifest['shards']:
+            name = shard['name']
+            if name in self._arrays:
+                arrays[name] = self._arrays[name]
+                continue
+            try:
+                arrays[name] = {k: np.load(osp.join(self.buffer_dir, name, k + '.npy'), mmap_mode='r')
+                                for k, shape in shard['shapes'].items() if shape[0] > 0}
+            except (IOError, OSError):
+                # the shard has been evicted after the manifest is read
+                return False
+        self.version = manifest['next_id']
+        self.shards = manifest['shards']
+        self._arrays = arrays
+        return True
+
+    def __getitem__(self, key):
+        shards = [s for s in self.shards if key in s['shapes']]
+        if len(shards) == 0:
+            raise KeyError('No data of {} in the buffer'.format(key))
+        arrays = [self._arrays[s['name']][key] for s in shards if key in self._arrays[s['name']]]
+        return ShardedArray(arrays, shards[-1]['shapes'][key][1:], np.dtype(shards[-1]['dtypes'][key]))
+
+    def num_samples(self, key):
+        return sum(s['shapes'][key][0] for s in self.shards if key in s['shapes'])
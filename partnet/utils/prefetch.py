@@ -0,0 +1,93 @@
+import threading
+from queue import Queue, Empty
+
+import torch
+
+
+def _take(pool, index):
+    if isinstance(pool, torch.Tensor):
+        return torch.index_select(pool, dim=0, index=index)
+    # array-like pools, e.g. memory-mapped buffer shards
+    return torch.from_numpy(pool[index.numpy()])
+
+
+class MinibatchPrefetcher(object):
+    """Assemble minibatches from CPU pools in a background thread
+
+    A random subset of at most train_len samples is drawn from the pools.
+    Minibatches are sliced, transformed and copied to the device by a daemon thread,
+    while the consumer is running the current step. Incomplete last batch is dropped.
+    The thread exits when all the minibatches are consumed or close is called.
+
+    Args:
+        pools (dict): name -> torch.Tensor or ShardedArray, pools with the same length
+        batch_size (int): the number of samples in a minibatch
+        train_len (int): the maximum number of samples to iterate
+        transform (callable, optional): dict -> dict, applied on CPU to each minibatch
+        num_prefetch (int): the maximum number of staged minibatches
+        device (torch.device or str, optional): the device to copy minibatches to
+
+    """
+
+    def __init__(self, pools, batch_size, train_len, transform=None, num_prefetch=2, device=None):
+        assert len(pools) > 0
+        cur_len = list(pools.values())[0].shape[0]
+        assert all(v.shape[0] == cur_len for v in pools.values())
+        self.pools = pools
+        self.batch_size = batch_size
+        self.cur_train_len = min(train_len, cur_len)
+        self.transform = transform
+        self.device = device
+        self.perm_idx = torch.randperm(cur_len)[:self.cur_train_len]
+
+        self._queue = Queue(maxsize=max(num_prefetch, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return self.cur_train_len // self.batch_size
+
+    def _load(self, i):
+        index = self.perm_idx[i * self.batch_size:(i + 1) * self.batch_size]
+        batch = {k: _take(v, index) for k, v in self.pools.items()}
+        if self.transform is not None:
+            batch = self.transform(batch)
+        if self.device is not None and torch.device(self.device).type == 'cuda':
+            batch = {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in batch.items()}
+        elif self.device is not None:
+            batch = {k: v.to(self.device) for k, v in batch.items()}
+        return batch
+
+    def _worker(self):
+        try:
+            for i in range(len(self)):
+                if self._stop.is_set():
+                    return
+                self._queue.put(self._load(i))
+        except Exception as e:
+            self._queue.put(e)
+
+    def __iter__(self):
+        try:
+            for _ in range(len(self)):
+                batch = self._queue.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the thread and release staged minibatches"""
+        self._stop.set()
+        while self._thread.is_alive():
+            # unblock the thread waiting for a free slot
+            try:
+                self._queue.get(timeout=0.01)
+            except Empty:
+                pass
+        self._thread.join()
+        while not self._queue.empty():
+            self._queue.get_nowait()
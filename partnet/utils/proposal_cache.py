@@ -0,0 +1,69 @@
+import os
+import os.path as osp
+import json
+from hashlib import md5
+
+import numpy as np
+
+from core.utils.io import get_md5
+
+
+class ProposalCache(object):
+    """Persistent cache of stage-1 proposals (sub-part masks after filtering)
+
+    Entries are content-addressed by the sampler configuration and MD5 of checkpoints,
+    so that a new checkpoint or sampler never hits stale proposals.
+    Masks are stored as packed bits, one npz file per shape.
+
+    Args:
+        cache_dir (str): the root directory of the cache
+        sampler_cfg (dict): the configuration to generate proposals, e.g. sampling method, seed and thresholds
+        checkpoint_files (list of str): checkpoints which proposals depend on
+
+    """
+
+    def __init__(self, cache_dir, sampler_cfg, checkpoint_files):
+        key = {
+            'sampler': sampler_cfg,
+            'checkpoints': [get_md5(f) if f and osp.exists(f) else '' for f in checkpoint_files],
+        }
+        self.key = md5(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        self.cache_dir = osp.join(cache_dir, self.key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(osp.join(self.cache_dir, 'key.json'), 'w') as f:
+            json.dump(key, f, sort_keys=True, indent=2)
+
+    def _get_path(self, shape_id):
+        return osp.join(self.cache_dir, '{}.npz'.format(shape_id))
+
+    def get(self, shape_id):
+        """Load proposals of a shape
+
+        Returns:
+            dict or None: 'masks' (np.ndarray, (num_parts, num_points), uint8) and extra arrays.
+                None if missing.
+
+        """
+        path = self._get_path(shape_id)
+        if not osp.exists(path):
+            return None
+        with np.load(path) as data:
+            out = {k: data[k] for k in data.files if k not in ('masks', 'num_points')}
+            out['masks'] = np.unpackbits(data['masks'], axis=1)[:, :int(data['num_points'])]
+        return out
+
+    def put(self, shape_id, masks, **kwargs):
+        """Save proposals of a shape
+
+        Args:
+            shape_id (str): e.g. anno_id
+            masks (np.ndarray): (num_parts, num_points), binary masks of sub-parts
+            kwargs: extra arrays to save
+
+        """
+        masks = np.asarray(masks) > 0
+        path = self._get_path(shape_id)
+        # write to a temporary file first, so that concurrent readers never see partial files
+        tmp_path = path[:-len('.npz')] + '.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp_path, masks=np.packbits(masks, axis=1), num_points=masks.shape[1], **kwargs)
+        os.replace(tmp_path, path)
@@ -1,4 +1,6 @@
+import numpy as np
 import torch
+from scipy.spatial import cKDTree
 
 
 def normalize_points(points):
@@ -19,6 +21,29 @@ def normalize_points(points):
     return new_points
 
 
+def renorm_pairs(part_xyz1, part_xyz2):
+    """Normalize a batch of sub-part pairs as the input of the verification network
+
+    Args:
+        part_xyz1 (torch.Tensor): (batch_size, 3, num_samples)
+        part_xyz2 (torch.Tensor): (batch_size, 3, num_samples)
+
+    Returns:
+        part_xyz (torch.Tensor): (batch_size, 3, 2 * num_samples), the normalized union
+        part_xyz1 (torch.Tensor): (batch_size, 3, num_samples), normalized individually
+        part_xyz2 (torch.Tensor): (batch_size, 3, num_samples), normalized individually
+
+    """
+    part_xyz = torch.cat([part_xyz1, part_xyz2], -1)
+    part_xyz = part_xyz - torch.mean(part_xyz, -1).unsqueeze(-1)
+    part_xyz1 = part_xyz1 - torch.mean(part_xyz1, -1).unsqueeze(-1)
+    part_xyz2 = part_xyz2 - torch.mean(part_xyz2, -1).unsqueeze(-1)
+    part_xyz1 = part_xyz1 / part_xyz1.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+    part_xyz2 = part_xyz2 / part_xyz2.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+    part_xyz = part_xyz / part_xyz.norm(dim=1).max(dim=-1)[0].unsqueeze(-1).unsqueeze(-1)
+    return part_xyz, part_xyz1, part_xyz2
+
+
 def select_points(points, index):
     """Gather xyz of centroids according to indices
 
@@ -63,3 +88,140 @@ def group_points(points, index):
     return output
 
 
+
+
+def ball_query_kdtree(points, centroids, radius, num_neighbours, fill_index=None):
+    """Find the nearest neighbours within a radius with a KD-tree of each point cloud
+
+    The tree is built once for each point cloud, so that the cost is nearly linear in the number of points,
+    instead of computing distances between all the centroids and all the points. It runs on CPU.
+
+    Args:
+        points (torch.Tensor): (batch_size, 3, num_points)
+        centroids (torch.Tensor): (batch_size, 3, num_centroids)
+        radius (float): the radius of balls
+        num_neighbours (int): the maximum number of neighbours
+        fill_index (torch.Tensor, optional): (batch_size, num_centroids), indices to fill empty slots,
+            usually the indices of centroids. If None, the nearest neighbour is used.
+
+    Returns:
+        torch.Tensor: (batch_size, num_centroids, num_neighbours), indices of neighbours sorted by distance
+
+    """
+    batch_size, _, num_points = points.size()
+    points_np = points.detach().cpu().numpy().transpose(0, 2, 1)
+    centroids_np = centroids.detach().cpu().numpy().transpose(0, 2, 1)
+    index = np.empty((batch_size, centroids_np.shape[1], num_neighbours), dtype=np.int64)
+    for i in range(batch_size):
+        tree = cKDTree(points_np[i])
+        _, index_i = tree.query(centroids_np[i], k=num_neighbours, distance_upper_bound=radius)
+        index_i = index_i.reshape(centroids_np.shape[1], num_neighbours)
+        # missing neighbours are indicated by num_points
+        missing = index_i == num_points
+        if fill_index is None:
+            fill = np.broadcast_to(index_i[:, :1], index_i.shape)
+        else:
+            fill = np.broadcast_to(fill_index[i].cpu().numpy()[:, None], index_i.shape)
+        index[i] = np.where(missing, fill, index_i)
+    return torch.from_numpy(index).to(points.device)
+
+
+def voxel_grid_sample(points, voxel_size, num_samples, low=-1.0):
+    """Sample the point nearest to the centre of each occupied voxel
+
+    Voxel centres are low + k * voxel_size along each axis. Points are hashed into voxels in one pass,
+    instead of computing distances between all the grid nodes and all the points.
+    If more voxels are occupied than num_samples, a random subset is kept. Otherwise, samples are repeated.
+
+    Args:
+        points (torch.Tensor): (batch_size, 3, num_points)
+        voxel_size (float): the size of voxels
+        num_samples (int): the number of samples of each point cloud
+        low (float): the centre of the first voxel
+
+    Returns:
+        torch.Tensor: (batch_size, num_samples), indices of sampled points
+
+    """
+    batch_size, _, num_points = points.size()
+    # (batch_size, num_points, 3)
+    voxel_index = torch.round((points.transpose(1, 2) - low) / voxel_size)
+    centre = voxel_index * voxel_size + low
+    # (batch_size, num_points)
+    dist = (points.transpose(1, 2) - centre).norm(dim=2)
+
+    # hash voxels of all the point clouds into one key space
+    voxel_index = voxel_index.long()
+    voxel_index = voxel_index - voxel_index.reshape(-1, 3).min(dim=0)[0]
+    dims = voxel_index.reshape(-1, 3).max(dim=0)[0] + 1
+    key = (voxel_index[..., 0] * dims[1] + voxel_index[..., 1]) * dims[2] + voxel_index[..., 2]
+    key = key + torch.arange(batch_size, device=points.device).view(-1, 1) * (dims[0] * dims[1] * dims[2])
+
+    # sort by voxel, then by distance to the centre. dist is at most half of the voxel diagonal.
+    order = torch.argsort(key.reshape(-1).double() + dist.reshape(-1).double() / (voxel_size * 2.0))
+    sorted_key = key.reshape(-1)[order]
+    is_first = torch.ones_like(sorted_key, dtype=torch.uint8)
+    is_first[1:] = (sorted_key[1:] != sorted_key[:-1])
+    first = order[is_first.nonzero().view(-1)]
+
+    # (num_voxels,), sorted by batch
+    batch_index = first // num_points
+    point_index = first % num_points
+    counts = torch.bincount(batch_index, minlength=batch_size).tolist()
+    sample_index = []
+    for b, index in enumerate(torch.split(point_index, counts)):
+        if index.numel() >= num_samples:
+            index = index[torch.randperm(index.numel(), device=index.device)[:num_samples]]
+        else:
+            index = index.repeat((num_samples + index.numel() - 1) // index.numel())[:num_samples]
+        sample_index.append(index)
+    return torch.stack(sample_index, dim=0)
+
+
+def knn_label_boundary(points, labels, k=16, chunk_size=1024):
+    """Find points whose k nearest neighbours have different labels
+
+    Args:
+        points (torch.Tensor): (batch_size, 3, num_points)
+        labels (torch.Tensor): (batch_size, num_points)
+        k (int): the number of neighbours
+        chunk_size (int): the number of query points in each block, to bound the memory of distances
+
+    Returns:
+        torch.Tensor: (batch_size, num_points), uint8, 1 for boundary points
+
+    """
+    batch_size, _, num_points = points.size()
+    sq_norm = (points ** 2).sum(dim=1)
+    boundary = []
+    for start in range(0, num_points, chunk_size):
+        query = points[:, :, start:start + chunk_size]
+        # (batch_size, chunk_size, num_points)
+        dist = sq_norm[:, start:start + chunk_size].unsqueeze(2) + sq_norm.unsqueeze(1) \
+            - 2 * torch.bmm(query.transpose(1, 2), points)
+        _, knn_index = dist.topk(min(k + 1, num_points), dim=2, largest=False)
+        knn_labels = labels.gather(1, knn_index.view(batch_size, -1)).view_as(knn_index)
+        query_labels = labels[:, start:start + chunk_size].unsqueeze(2)
+        boundary.append((knn_labels != query_labels).sum(dim=2) > 0)
+    return torch.cat(boundary, dim=1).type(torch.uint8)
+
+
+def boundary_distance(points, index, boundary):
+    """Compute the distance from sampled points to the nearest boundary point
+
+    Args:
+        points (torch.Tensor): (batch_size, 3, num_points)
+        index (torch.Tensor): (batch_size, num_samples), indices of sampled points
+        boundary (torch.Tensor): (batch_size, num_points), 1 for boundary points
+
+    Returns:
+        torch.Tensor: (batch_size, num_samples), inf if there is no boundary point
+
+    """
+    query = select_points(points, index)
+    # (batch_size, num_samples, num_points)
+    dist = (query ** 2).sum(dim=1).unsqueeze(2) + (points ** 2).sum(dim=1).unsqueeze(1) \
+        - 2 * torch.bmm(query.transpose(1, 2), points)
+    dist = dist.masked_fill((boundary == 0).unsqueeze(1).expand_as(dist), float('inf'))
+    min_dist, _ = dist.min(dim=2)
+    return min_dist.clamp(min=0.0).sqrt()
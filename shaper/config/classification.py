@@ -66,6 +66,8 @@ _C.MODEL.PN2SSG.sa_channels = ((64, 64, 128), (128, 128, 256), (256, 512, 1024))
 _C.MODEL.PN2SSG.global_channels = (512, 256)
 _C.MODEL.PN2SSG.dropout_prob = 0.5
 _C.MODEL.PN2SSG.use_xyz = True
+# If positive, FPS samples centroids on voxel-grid candidates, about fps_ratio per centroid
+_C.MODEL.PN2SSG.fps_ratio = 0.0
 
 # -----------------------------------------------------------------------------
 # PN2MSG options
@@ -83,6 +85,8 @@ _C.MODEL.PN2MSG.sa_channels_list = (
 _C.MODEL.PN2MSG.global_channels = (512, 256)
 _C.MODEL.PN2MSG.dropout_prob = 0.5
 _C.MODEL.PN2MSG.use_xyz = True
+# If positive, FPS samples centroids on voxel-grid candidates, about fps_ratio per centroid
+_C.MODEL.PN2MSG.fps_ratio = 0.0
 
 # -----------------------------------------------------------------------------
 # DGCNN options
@@ -93,6 +97,8 @@ _C.MODEL.DGCNN.edge_conv_channels = (64, 64, 64, 128)
 _C.MODEL.DGCNN.local_channels = (1024,)
 _C.MODEL.DGCNN.global_channels = (512, 256)
 _C.MODEL.DGCNN.k = 20
+# search nearest neighbours block by block to save memory for large point clouds, 0 for the full pairwise distance
+_C.MODEL.DGCNN.knn_block_size = 0
 
 _C.MODEL.DGCNN.dropout_prob = 0.5
 _C.MODEL.DGCNN.with_transform = True
@@ -82,6 +82,8 @@ _C.MODEL.PN2SSG.seg_channels = (128,)
 _C.MODEL.PN2SSG.dropout_prob = 0.5
 _C.MODEL.PN2SSG.use_xyz = True
 _C.MODEL.PN2SSG.use_one_hot = True
+# If positive, FPS samples centroids on voxel-grid candidates, about fps_ratio per centroid
+_C.MODEL.PN2SSG.fps_ratio = 0.0
 
 # ---------------------------------------------------------------------------- #
 # PN2MSG options
@@ -102,6 +104,8 @@ _C.MODEL.PN2MSG.seg_channels = (128,)
 _C.MODEL.PN2MSG.dropout_prob = 0.5
 _C.MODEL.PN2MSG.use_xyz = True
 _C.MODEL.PN2MSG.use_one_hot = True
+# If positive, FPS samples centroids on voxel-grid candidates, about fps_ratio per centroid
+_C.MODEL.PN2MSG.fps_ratio = 0.0
 
 # ---------------------------------------------------------------------------- #
 # DGCNN options
@@ -112,6 +116,8 @@ _C.MODEL.DGCNN.edge_conv_channels = ((64, 64), (64, 64), 64)
 _C.MODEL.DGCNN.local_channels = (1024,)
 _C.MODEL.DGCNN.seg_channels = (256, 256, 128)
 _C.MODEL.DGCNN.k = 20
+# search nearest neighbours block by block to save memory for large point clouds, 0 for the full pairwise distance
+_C.MODEL.DGCNN.knn_block_size = 0
 
 _C.MODEL.DGCNN.dropout_prob = 0.4
 _C.MODEL.DGCNN.with_transform = True
@@ -286,11 +286,11 @@ class RandomDropout(object):
         is_drop = dropout_indices.numel() > 0
         if seg_label is None:
             if is_drop:
-                points[dropout_indices] = points[0]  # set to the first point
+                points[dropout_indices] = points[0].clone()  # set to the first point
             return points
         else:
             if is_drop:
-                points[dropout_indices] = points[0]
+                points[dropout_indices] = points[0].clone()
                 # ignore the labels of duplicated points
                 seg_label[dropout_indices] = self.ignore_index
             return points, seg_label
@@ -306,3 +306,135 @@ class Sample(object):
             return points[choice]
         else:
             return points[choice], seg_label[choice]
+
+
+# ---------------------------------------------------------------------------- #
+# Batch transformation
+# Points are (batch_size, num_points, num_channels) tensors on any device, and labels are (batch_size, num_points).
+# Random parameters of the whole batch are drawn at once.
+# ---------------------------------------------------------------------------- #
+def get_rotation_matrix_batch(angle, axis):
+    """Return rotation matrices by angles around a given axis
+    Batch version of get_rotation_matrix_np
+
+    Args:
+        angle (torch.Tensor): angles to rotate by. (batch_size,)
+        axis (np.ndarray): axis to rotate about
+
+    Returns:
+        torch.Tensor: rotation matrices (batch_size, 3, 3) A. (y=A'x)
+
+    """
+    axis = np.asarray(axis)
+    u = axis / np.linalg.norm(axis)
+    eye = angle.new_tensor(np.eye(3))
+    cross_product_matrix = angle.new_tensor(np.cross(u, np.eye(3)))
+    outer_product_matrix = angle.new_tensor(np.outer(u, u))
+    cos_angle = torch.cos(angle).view(-1, 1, 1)
+    sin_angle = torch.sin(angle).view(-1, 1, 1)
+    R = cos_angle * eye + sin_angle * cross_product_matrix + (1.0 - cos_angle) * outer_product_matrix
+    return R
+
+
+class BatchComposeSeg(Compose):
+    def __call__(self, points, seg_label):
+        for t in self.transforms:
+            if isinstance(t, (BatchShuffle, BatchRandomDropout, BatchSample)):
+                points, seg_label = t(points, seg_label)
+            else:
+                points = t(points)
+        return points, seg_label
+
+
+class BatchTranspose(object):
+    def __call__(self, points):
+        return points.transpose(1, 2).contiguous()
+
+
+class BatchRotate(Rotate):
+    """Rotate each point cloud along an axis by a random angle"""
+
+    def __call__(self, points):
+        angle = points.new(points.size(0)).uniform_(0, 2 * np.pi)
+        rotation_matrix = get_rotation_matrix_batch(angle, self.axis)
+        points[:, :, 0:3] = torch.bmm(points[:, :, 0:3], rotation_matrix)
+        return points
+
+
+class BatchRotateY(BatchRotate):
+    def __init__(self):
+        super(BatchRotateY, self).__init__((0., 1., 0.))
+
+
+class BatchRotatePerturbation(RotatePerturbation):
+    """Small perturbation along three axes of each point cloud"""
+
+    def __call__(self, points):
+        angles = points.new(points.size(0), 3).normal_(mean=0.0, std=self.angle_sigma)
+        angles = angles.clamp_(-self.angle_clip, self.angle_clip)
+        Rx = get_rotation_matrix_batch(angles[:, 0], self.axes[0])
+        Ry = get_rotation_matrix_batch(angles[:, 1], self.axes[1])
+        Rz = get_rotation_matrix_batch(angles[:, 2], self.axes[2])
+        rotation_matrix = torch.bmm(torch.bmm(Rz, Ry), Rx)
+        points[:, :, 0:3] = torch.bmm(points[:, :, 0:3], rotation_matrix)
+        return points
+
+
+class BatchTranslate(Translate):
+    def __call__(self, points):
+        translation = points.new(points.size(0), 1, 3).uniform_(-self.translate_range, self.translate_range)
+        points[:, :, 0:3] += translation  # broadcast the points dimension
+        return points
+
+
+class BatchScale(Scale):
+    def __call__(self, points):
+        scale = points.new(points.size(0), 1, 1).uniform_(self.lo, self.hi)
+        points[:, :, 0:3] *= scale
+        return points
+
+
+class BatchJitter(Jitter):
+    def __call__(self, points):
+        jittered_data = points.new(points.size(0), points.size(1), 3).normal_(mean=0.0, std=self.std)
+        jittered_data = jittered_data.clamp_(-self.clip, self.clip)
+        points[:, :, 0:3] += jittered_data
+        return points
+
+
+class BatchShuffle(Shuffle):
+    def __call__(self, points, seg_label=None):
+        batch_size, num_points = points.shape[0:2]
+        # a random permutation for each point cloud
+        index = torch.rand(batch_size, num_points, device=points.device).argsort(dim=1)
+        points = points.gather(1, index.unsqueeze(-1).expand_as(points))
+        if seg_label is None:
+            return points
+        else:
+            return points, seg_label.gather(1, index.to(seg_label.device))
+
+
+class BatchRandomDropout(RandomDropout):
+    def __call__(self, points, seg_label=None):
+        batch_size, num_points = points.shape[0:2]
+        dropout_ratio = torch.rand(batch_size, 1, device=points.device) * self.max_dropout_ratio
+        is_drop = torch.rand(batch_size, num_points, device=points.device) <= dropout_ratio
+        # set to the first point
+        points = torch.where(is_drop.unsqueeze(-1), points[:, 0:1], points)
+        if seg_label is None:
+            return points
+        else:
+            # ignore the labels of duplicated points
+            seg_label = seg_label.masked_fill(is_drop.to(seg_label.device), self.ignore_index)
+            return points, seg_label
+
+
+class BatchSample(Sample):
+    def __call__(self, points, seg_label=None):
+        batch_size, num_points = points.shape[0:2]
+        choice = torch.randint(num_points, size=(batch_size, self.num_points), dtype=torch.int64, device=points.device)
+        points = points.gather(1, choice.unsqueeze(-1).expand(-1, -1, points.size(2)))
+        if seg_label is None:
+            return points
+        else:
+            return points, seg_label.gather(1, choice.to(seg_label.device))
@@ -27,6 +27,7 @@ class TNet(nn.Module):
         local_channels (tuple of int): the numbers of channels in local mlp
         global_channels (tuple of int): the numbers of channels in global mlp
         k: the number of neareast neighbours for edge feature extractor
+        knn_block_size (int): the block size to search nearest neighbours, 0 for the full pairwise distance
 
     """
 
@@ -36,13 +37,14 @@ class TNet(nn.Module):
                  conv_channels=(64, 128),
                  local_channels=(1024,),
                  global_channels=(512, 256),
-                 k=20):
+                 k=20,
+                 knn_block_size=0):
         super(TNet, self).__init__()
 
         self.in_channels = in_channels
         self.out_channels = out_channels
 
-        self.edge_conv = EdgeConvBlock(in_channels, conv_channels, k)
+        self.edge_conv = EdgeConvBlock(in_channels, conv_channels, k, knn_block_size=knn_block_size)
         self.mlp_local = SharedMLP(conv_channels[-1], local_channels)
         self.mlp_global = MLP(local_channels[-1], global_channels)
         self.linear = nn.Linear(global_channels[-1], self.in_channels * self.out_channels, bias=True)
@@ -85,6 +87,7 @@ class DGCNNCls(nn.Module):
         k (int): the number of neareast neighbours for edge feature extractor
         dropout_prob (float): the probability to dropout
         with_transform (bool): whether to use TNet to transform features.
+        knn_block_size (int): the block size to search nearest neighbours, 0 for the full pairwise distance
 
     """
 
@@ -96,7 +99,8 @@ class DGCNNCls(nn.Module):
                  global_channels=(512, 256),
                  k=20,
                  dropout_prob=0.5,
-                 with_transform=True):
+                 with_transform=True,
+                 knn_block_size=0):
         super(DGCNNCls, self).__init__()
 
         self.in_channels = in_channels
@@ -105,7 +109,7 @@ class DGCNNCls(nn.Module):
 
         # input transform
         if self.with_transform:
-            self.transform_input = TNet(in_channels, in_channels, k=k)
+            self.transform_input = TNet(in_channels, in_channels, k=k, knn_block_size=knn_block_size)
 
         self.edge_convs = nn.ModuleList()
         inter_channels = []
@@ -114,7 +118,7 @@ class DGCNNCls(nn.Module):
                 conv_channels = [conv_channels]
             else:
                 assert isinstance(conv_channels, (tuple, list))
-            self.edge_convs.append(EdgeConvBlock(in_channels, conv_channels, k))
+            self.edge_convs.append(EdgeConvBlock(in_channels, conv_channels, k, knn_block_size=knn_block_size))
             inter_channels.append(conv_channels[-1])
             in_channels = conv_channels[-1]
         self.mlp_local = SharedMLP(sum(inter_channels), local_channels)
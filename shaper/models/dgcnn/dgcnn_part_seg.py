@@ -33,6 +33,7 @@ class DGCNNPartSeg(nn.Module):
         k (int): the number of neareast neighbours for edge feature extractor
         dropout_prob (float): the probability to dropout
         with_transform (bool): whether to use TNet to transform features.
+        knn_block_size (int): the block size to search nearest neighbours, 0 for the full pairwise distance
 
     """
 
@@ -45,7 +46,8 @@ class DGCNNPartSeg(nn.Module):
                  seg_channels=(256, 256, 128),
                  k=20,
                  dropout_prob=0.4,
-                 with_transform=True):
+                 with_transform=True,
+                 knn_block_size=0):
         super(DGCNNPartSeg, self).__init__()
 
         self.in_channels = in_channels
@@ -55,7 +57,7 @@ class DGCNNPartSeg(nn.Module):
 
         # input transform
         if self.with_transform:
-            self.transform_input = TNet(in_channels, in_channels, k=k)
+            self.transform_input = TNet(in_channels, in_channels, k=k, knn_block_size=knn_block_size)
 
         self.edge_convs = nn.ModuleList()
         inter_channels = []
@@ -64,7 +66,7 @@ class DGCNNPartSeg(nn.Module):
                 conv_channels = [conv_channels]
             else:
                 assert isinstance(conv_channels, (tuple, list))
-            self.edge_convs.append(EdgeConvBlock(in_channels, conv_channels, k))
+            self.edge_convs.append(EdgeConvBlock(in_channels, conv_channels, k, knn_block_size=knn_block_size))
             inter_channels.append(conv_channels[-1])
             in_channels = conv_channels[-1]
 
@@ -2,7 +2,7 @@
 
 import torch
 
-from core.nn.functional import bpdist
+from core.nn.functional import bpdist, bpdist2
 from shaper.models.pointnet2.functions import group_points
 
 
@@ -26,6 +26,45 @@ def get_knn_inds(pairwise_distance, k=20, remove=False):
         return knn_inds
 
 
+def get_knn_inds_blocked(feature, k=20, block_size=1024, remove=False):
+    """Get k nearest neighbour index, computed block by block without the full pairwise distance
+
+    For each block of query nodes, blocks of key nodes are streamed and a running top-k is kept.
+    Therefore, at most (batch_size, block_size, k + block_size) distances are in memory
+    instead of (batch_size, num_nodes, num_nodes).
+
+    Args:
+        feature (torch.Tensor): (batch_size, channels, num_nodes)
+        k (int): the number of nearest neighbours
+        block_size (int): the number of query (or key) nodes in a block
+        remove (bool): whether to remove itself
+
+    Returns:
+        knn_inds (torch.Tensor): (batch_size, num_nodes, k)
+
+    """
+    num_nodes = feature.size(2)
+    num_neighbours = k + 1 if remove else k
+    assert num_neighbours <= num_nodes
+    knn_inds_list = []
+    for query_start in range(0, num_nodes, block_size):
+        query = feature[:, :, query_start:query_start + block_size]
+        knn_distance = knn_inds = None
+        for key_start in range(0, num_nodes, block_size):
+            key = feature[:, :, key_start:key_start + block_size]
+            # (batch_size, query_block_size, key_block_size)
+            distance = bpdist2(query, key)
+            inds = torch.arange(key_start, key_start + key.size(2), device=feature.device).expand_as(distance)
+            if knn_distance is not None:
+                distance = torch.cat([knn_distance, distance], dim=2)
+                inds = torch.cat([knn_inds, inds], dim=2)
+            knn_distance, index = torch.topk(distance, min(num_neighbours, distance.size(2)),
+                                             largest=False, sorted=remove)
+            knn_inds = inds.gather(2, index)
+        knn_inds_list.append(knn_inds[..., 1:] if remove else knn_inds)
+    return torch.cat(knn_inds_list, dim=1)
+
+
 def construct_edge_feature_index(feature, knn_inds):
     """Construct edge feature for each point (or regarded as a node)
     using advanced indexing
@@ -88,19 +127,24 @@ def construct_edge_feature(feature, knn_inds):
     return edge_feature
 
 
-def get_edge_feature(feature, k):
+def get_edge_feature(feature, k, knn_block_size=0):
     """Get edge feature
 
     Args:
         feature (torch.Tensor): (batch_size, channels, num_nodes)
         k (int): the number of nearest neighbours
+        knn_block_size (int): the block size to search nearest neighbours (see get_knn_inds_blocked).
+            If non-positive or not less than num_nodes, the full pairwise distance is used.
 
     Returns:
         edge_feature (torch.Tensor): (batch_size, 2*channels, num_nodes, k)
 
     """
     with torch.no_grad():
-        distance = bpdist(feature)
-        knn_inds = get_knn_inds(distance, k)
+        if 0 < knn_block_size < feature.size(2):
+            knn_inds = get_knn_inds_blocked(feature, k, knn_block_size)
+        else:
+            distance = bpdist(feature)
+            knn_inds = get_knn_inds(distance, k)
     edge_feature = construct_edge_feature(feature, knn_inds)
     return edge_feature
@@ -7,7 +7,7 @@ from .functions import get_edge_feature
 class EdgeConvBlock(SharedMLP):
     """EdgeConv Block"""
 
-    def __init__(self, in_channels, conv_channels, k, **kwargs):
+    def __init__(self, in_channels, conv_channels, k, knn_block_size=0, **kwargs):
         super(EdgeConvBlock, self).__init__(
             in_channels=2 * in_channels,
             mlp_channels=conv_channels,
@@ -15,15 +15,18 @@ class EdgeConvBlock(SharedMLP):
             **kwargs
         )
         self.k = k
+        self.knn_block_size = knn_block_size
 
     def forward(self, x):
         # input x: (batch_size, channels, num_nodes)
-        x = get_edge_feature(x, self.k)  # (batch_size, 2* channels, num_nodes, k)
+        x = get_edge_feature(x, self.k, self.knn_block_size)  # (batch_size, 2* channels, num_nodes, k)
         x = super(EdgeConvBlock, self).forward(x)  # (batch_size, conv_channels[-1], num_nodes, k)
         x, _ = torch.max(x, 3)  # (batch_size, conv_channels[-1], num_nodes)
         return x
 
     def extra_repr(self):
         extra_str = 'k={}'.format(self.k)
+        if self.knn_block_size > 0:
+            extra_str += ', knn_block_size={}'.format(self.knn_block_size)
         other_str = super(EdgeConvBlock, self).extra_repr()
         return extra_str if other_str == '' else ','.join([extra_str, other_str])
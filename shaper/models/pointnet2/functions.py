@@ -42,6 +42,8 @@ class FarthestPointSample(torch.autograd.Function):
             index (torch.Tensor): (batch_size, num_centroids), sample indices of centroids.
 
         """
+        if not points.is_cuda:
+            return _farthest_point_sample_cpu(points, num_centroids)
         index = pn2_ext.farthest_point_sample(points, num_centroids)
         return index
 
@@ -53,6 +55,82 @@ class FarthestPointSample(torch.autograd.Function):
 farthest_point_sample = FarthestPointSample.apply
 
 
+def _farthest_point_sample_cpu(points, num_centroids):
+    """Farthest point sample on cpu, the same as the cuda kernel (start from the first point)"""
+    batch_size, _, num_points = points.size()
+    index = points.new_zeros(batch_size, num_centroids, dtype=torch.int64)
+    min_dist = points.new_full((batch_size, num_points), float('inf'))
+    cur_ind = index[:, 0]
+    for i in range(1, num_centroids):
+        # (batch_size, 3, 1)
+        cur_xyz = points.gather(2, cur_ind.view(batch_size, 1, 1).expand(batch_size, points.size(1), 1))
+        dist = (points - cur_xyz).pow(2).sum(1)
+        min_dist = torch.min(min_dist, dist)
+        cur_ind = min_dist.argmax(1)
+        index[:, i] = cur_ind
+    return index
+
+
+def farthest_point_sample_voxel(points, num_centroids, ratio=4.0, max_iters=4):
+    """Approximate farthest point sample on voxel-grid downsampled points
+
+    Points are hashed into a grid, whose voxel size is chosen from the bounding box so that
+    about ratio * num_centroids voxels are occupied by a surface. The first point of each voxel
+    is a candidate, and exact farthest point sample runs on candidates. It costs O(N + ratio * M^2)
+    instead of O(N * M), where N is the number of points and M is the number of centroids.
+    The larger the ratio is, the closer it is to exact FPS.
+
+    Args:
+        points (torch.Tensor): (batch_size, 3, num_points)
+        num_centroids (int): the number of centroids
+        ratio (float): the expected number of candidates per centroid
+        max_iters (int): the number of times to halve the voxel size
+            if any point cloud has fewer candidates than centroids
+
+    Returns:
+        index (torch.Tensor): (batch_size, num_centroids), indices of centroids
+
+    """
+    batch_size, _, num_points = points.size()
+    num_candidates = int(ratio * num_centroids)
+    if num_candidates >= num_points:
+        return farthest_point_sample(points, num_centroids)
+
+    with torch.no_grad():
+        low = points.min(2, keepdim=True)[0]
+        extent = points.max(2, keepdim=True)[0] - low
+        # the number of voxels occupied by a surface grows with the square of the resolution
+        voxel_size = extent.norm(dim=1, keepdim=True).clamp(min=1e-6) / (num_candidates ** 0.5)
+        # flat indices of points in the batch
+        arange = torch.arange(batch_size * num_points, device=points.device)
+        for _ in range(max_iters):
+            # (batch_size, 3, num_points)
+            voxel_index = ((points - low) / voxel_size).long()
+            dims = voxel_index.transpose(0, 1).reshape(3, -1).max(1)[0] + 1
+            # hash voxels of all the point clouds into one key space, ordered by batch
+            key = (voxel_index[:, 0] * dims[1] + voxel_index[:, 1]) * dims[2] + voxel_index[:, 2]
+            key = key + torch.arange(batch_size, device=points.device).view(-1, 1) * (dims[0] * dims[1] * dims[2])
+            unique_key, inverse = torch.unique(key.view(-1), return_inverse=True)
+            # (num_voxels,), the first point of each voxel, which is a flat index
+            first = torch.full_like(unique_key, batch_size * num_points)
+            first.scatter_reduce_(0, inverse, arange, reduce='amin')
+            counts = torch.bincount(first // num_points, minlength=batch_size)
+            if counts.min().item() >= num_centroids:
+                break
+            voxel_size = voxel_size / 2.0
+        else:
+            return farthest_point_sample(points, num_centroids)
+
+        # (batch_size, max_count), padded with the first candidate, which is never sampled again
+        candidate_index = [x % num_points for x in torch.split(first, counts.tolist())]
+        max_count = max(x.numel() for x in candidate_index)
+        candidate_index = torch.stack([torch.cat([x, x[:1].expand(max_count - x.numel())])
+                                       for x in candidate_index])
+        candidate_xyz = gather_points(points, candidate_index)
+        index = farthest_point_sample(candidate_xyz.contiguous(), num_centroids)
+    return candidate_index.gather(1, index)
+
+
 class BallQuery(torch.autograd.Function):
     @staticmethod
     def forward(ctx, points, centroids, radius, num_neighbours):
@@ -72,6 +150,8 @@ class BallQuery(torch.autograd.Function):
                 the number of unique neighbours of each centroid.
 
         """
+        if not points.is_cuda:
+            return _ball_query_cpu(points, centroids, radius, num_neighbours)
         index, count = pn2_ext.ball_query(points, centroids, radius, num_neighbours)
         return index, count
 
@@ -82,6 +162,84 @@ class BallQuery(torch.autograd.Function):
 
 ball_query = BallQuery.apply
 
+
+def _ball_query_cpu(points, centroids, radius, num_neighbours, chunk_size=256):
+    """Ball query on cpu, the same as the cuda kernel
+
+    The first num_neighbours points (in the order of indices) within the ball are selected,
+    and the rest is padded with the first one. If there is no point within the ball, indices are zeros.
+
+    """
+    index, count = _ball_query_multi_chunked(points, centroids, [radius], [num_neighbours], chunk_size=chunk_size)
+    return index, count[:, :, 0]
+
+
+def ball_query_multi(points, centroids, radius_list, num_neighbours_list, chunk_size=256):
+    """Ball query of several radii on the same points and centroids
+
+    On any device, distances to chunks of centroids are computed once for all the radii,
+    instead of a kernel launch per radius. The result is the same as ball_query of each radius.
+
+    Args:
+        points (torch.Tensor): (batch_size, channels, num_points)
+        centroids (torch.Tensor): (batch_size, channels, num_centroids)
+        radius_list (list of float): the radius of each ball
+        num_neighbours_list (list of int): the number of neighbours within each ball
+        chunk_size (int): the number of centroids whose distances are computed at once
+
+    Returns:
+        index (torch.Tensor): (batch_size, num_centroids, sum(num_neighbours_list))
+            indices of neighbours of each centroid, concatenated in the order of radii.
+        count (torch.Tensor): (batch_size, num_centroids, num_radii)
+            the number of unique neighbours of each centroid within each ball.
+
+    """
+    return _ball_query_multi_chunked(points, centroids, radius_list, num_neighbours_list, chunk_size=chunk_size)
+
+
+def _ball_query_multi_chunked(points, centroids, radius_list, num_neighbours_list, chunk_size=256):
+    batch_size, _, num_points = points.size()
+    num_centroids = centroids.size(2)
+    index_list = []
+    count_list = []
+    arange = torch.arange(num_points, device=points.device)
+    points_t = points.transpose(1, 2)  # (batch_size, num_points, channels)
+    points_sq = points.pow(2).sum(1, keepdim=True)  # (batch_size, 1, num_points)
+    radius_sq = points.new_tensor([radius * radius for radius in radius_list])
+    eps = torch.finfo(points.dtype).eps * 16
+    for start in range(0, num_centroids, chunk_size):
+        chunk = centroids[:, :, start:start + chunk_size]
+        centroids_sq = chunk.pow(2).sum(1).unsqueeze(2)  # (batch_size, chunk_size, 1)
+        # (batch_size, chunk_size, num_points), shared by all the radii.
+        # |c|^2 + |p|^2 - 2c^Tp avoids materializing (batch_size, channels, chunk_size, num_points).
+        norm_sum = centroids_sq + points_sq
+        dist = torch.baddbmm(norm_sum, chunk.transpose(1, 2), points, alpha=-2)
+        # recompute exactly the few distances whose rounding error could flip the comparison to a radius
+        tol = eps * norm_sum
+        ambiguous = ((dist.unsqueeze(3) - radius_sq).abs() <= tol.unsqueeze(3)).any(3)
+        batch_index, centroid_index, point_index = ambiguous.nonzero(as_tuple=True)
+        if batch_index.numel() > 0:
+            diff = chunk[batch_index, :, centroid_index] - points_t[batch_index, point_index]
+            dist[batch_index, centroid_index, point_index] = diff.pow(2).sum(1)
+        chunk_index_list = []
+        chunk_count_list = []
+        for radius, num_neighbours in zip(radius_list, num_neighbours_list):
+            mask = dist < radius * radius
+            # invalid points are ranked at the end
+            key = torch.where(mask, arange.expand_as(mask), torch.full_like(arange, num_points).expand_as(mask))
+            key, _ = key.topk(min(num_neighbours, num_points), dim=2, largest=False, sorted=True)
+            if key.size(2) < num_neighbours:
+                key = torch.cat([key, key.new_full(key.shape[:2] + (num_neighbours - key.size(2),), num_points)],
+                                dim=2)
+            count = mask.sum(2).clamp(max=num_neighbours)
+            first = torch.where(count > 0, key[:, :, 0], torch.zeros_like(key[:, :, 0]))
+            index = torch.where(key < num_points, key, first.unsqueeze(2).expand_as(key))
+            chunk_index_list.append(index)
+            chunk_count_list.append(count.long())
+        index_list.append(torch.cat(chunk_index_list, dim=2))
+        count_list.append(torch.stack(chunk_count_list, dim=2))
+    return torch.cat(index_list, dim=1), torch.cat(count_list, dim=1)
+
 class BoxQuery(torch.autograd.Function):
     @staticmethod
     def forward(ctx, points, centroids, lens, num_neighbours):
@@ -157,12 +315,23 @@ class GroupPoints(torch.autograd.Function):
         """
         ctx.save_for_backward(index)
         ctx.num_points = points.size(2)
+        if not points.is_cuda:
+            batch_size, channels, _ = points.size()
+            _, num_centroids, num_neighbours = index.size()
+            index_expand = index.view(batch_size, 1, -1).expand(batch_size, channels, num_centroids * num_neighbours)
+            return points.gather(2, index_expand).view(batch_size, channels, num_centroids, num_neighbours)
         group_points = pn2_ext.group_points_forward(points, index)
         return group_points
 
     @staticmethod
     def backward(ctx, *grad_output):
         index = ctx.saved_tensors[0]
+        if not grad_output[0].is_cuda:
+            batch_size, channels = grad_output[0].shape[:2]
+            index_expand = index.view(batch_size, 1, -1).expand(batch_size, channels, index[0].numel())
+            grad_input = grad_output[0].new_zeros(batch_size, channels, ctx.num_points)
+            grad_input.scatter_add_(2, index_expand, grad_output[0].contiguous().view(batch_size, channels, -1))
+            return grad_input, None
         grad_input = pn2_ext.group_points_backward(grad_output[0], index, ctx.num_points)
         return grad_input, None
 
@@ -185,6 +354,8 @@ class SearchNNDistance(torch.autograd.Function):
             index: (B, N1, K), indices of these neighbors in key_xyz.
             distance: (B, N1, K), distance to the k nearest neighbors in key_xyz.
         """
+        if not query_xyz.is_cuda:
+            return _search_nn_distance_cpu(query_xyz, key_xyz, num_neighbors)
         index, distance = pn2_ext.point_search(query_xyz, key_xyz, num_neighbors)
         return index, distance
 
@@ -196,6 +367,19 @@ class SearchNNDistance(torch.autograd.Function):
 search_nn_distance = SearchNNDistance.apply
 
 
+def _search_nn_distance_cpu(query_xyz, key_xyz, num_neighbors, chunk_size=1024):
+    """Search nearest neighbours on cpu, the same as the cuda kernel (squared distances)"""
+    index_list = []
+    distance_list = []
+    for start in range(0, query_xyz.size(2), chunk_size):
+        # (B, chunk_size, N2)
+        distance = (query_xyz[:, :, start:start + chunk_size].unsqueeze(3) - key_xyz.unsqueeze(2)).pow(2).sum(1)
+        distance, index = distance.topk(num_neighbors, dim=2, largest=False, sorted=True)
+        index_list.append(index)
+        distance_list.append(distance)
+    return torch.cat(index_list, dim=1), torch.cat(distance_list, dim=1)
+
+
 # def search_nn_distance(query_xyz, key_xyz, num_neighbors):
 #     from core.nn.functional import bpdist2
 #     distance = bpdist2(query_xyz, key_xyz)
@@ -221,6 +405,12 @@ class FeatureInterpolate(torch.autograd.Function):
         _, _, num_inst = feature.size()
         ctx.save_for_backward(index, weight)
         ctx.num_inst = num_inst
+        if not feature.is_cuda:
+            batch_size, channels, _ = feature.size()
+            _, num_points, num_neighbors = index.size()
+            index_expand = index.view(batch_size, 1, -1).expand(batch_size, channels, num_points * num_neighbors)
+            neighbour_feature = feature.gather(2, index_expand).view(batch_size, channels, num_points, num_neighbors)
+            return (neighbour_feature * weight.unsqueeze(1)).sum(3)
         interpolated_feature = pn2_ext.interpolate_forward(feature, index, weight)
         return interpolated_feature
 
@@ -228,6 +418,13 @@ class FeatureInterpolate(torch.autograd.Function):
     def backward(ctx, *grad_out):
         index, weight = ctx.saved_tensors
         num_inst = ctx.num_inst
+        if not grad_out[0].is_cuda:
+            batch_size, channels, _ = grad_out[0].size()
+            index_expand = index.view(batch_size, 1, -1).expand(batch_size, channels, index[0].numel())
+            grad_neighbour = grad_out[0].unsqueeze(3) * weight.unsqueeze(1)
+            grad_input = grad_out[0].new_zeros(batch_size, channels, num_inst)
+            grad_input.scatter_add_(2, index_expand, grad_neighbour.reshape(batch_size, channels, -1))
+            return grad_input, None, None
         grad_input = pn2_ext.interpolate_backward(grad_out[0], index, weight, num_inst)
         return grad_input, None, None
 
@@ -10,20 +10,26 @@ class FarthestPointSampler(nn.Module):
 
     Args:
         num_centroids (int): the number of centroids
+        ratio (float): if positive, sample approximately on voxel-grid downsampled points,
+            with about ratio candidates per centroid. See farthest_point_sample_voxel.
 
     """
 
-    def __init__(self, num_centroids):
+    def __init__(self, num_centroids, ratio=0.0):
         super(FarthestPointSampler, self).__init__()
         self.num_centroids = num_centroids
+        self.ratio = ratio
 
     def forward(self, points):
         with torch.no_grad():
-            index = _F.farthest_point_sample(points, self.num_centroids)
+            if self.ratio > 0.0:
+                index = _F.farthest_point_sample_voxel(points, self.num_centroids, self.ratio)
+            else:
+                index = _F.farthest_point_sample(points, self.num_centroids)
         return index
 
     def extra_repr(self):
-        return 'num_centroids={:d}'.format(self.num_centroids)
+        return 'num_centroids={:d}, ratio={}'.format(self.num_centroids, self.ratio)
 
 
 class QueryGrouper(nn.Module):
@@ -33,10 +39,20 @@ class QueryGrouper(nn.Module):
         self.radius = radius
         self.num_neighbours = num_neighbours
 
-    def forward(self, new_xyz, xyz, feature, use_xyz):
+    def search(self, new_xyz, xyz):
+        """Query neighbours of centroids, (batch_size, num_centroids, num_neighbours)"""
         with torch.no_grad():
             index, unique_count = _F.ball_query(xyz, new_xyz, self.radius, self.num_neighbours)
+        return index
+
+    def forward(self, new_xyz, xyz, feature, use_xyz, index=None):
+        if index is None:
+            index = self.search(new_xyz, xyz)
+        return self.group(new_xyz, xyz, feature, use_xyz, index)
 
+    @staticmethod
+    def group(new_xyz, xyz, feature, use_xyz, index):
+        """Group neighbours by index, (batch_size, num_centroids, num_neighbours)"""
         # (batch_size, 3, num_centroids, num_neighbours)
         group_xyz = _F.group_points(xyz, index)
         # translation normalization
@@ -62,7 +78,23 @@ class FeatureInterpolator(nn.Module):
         self.num_neighbors = num_neighbors
         self._eps = eps
 
-    def forward(self, dense_xyz, sparse_xyz, dense_feature, sparse_feature):
+    def search(self, dense_xyz, sparse_xyz):
+        """Compute the interpolation plan, which only depends on xyz
+
+        Returns:
+            index: (B, N1, K), indices of nearest neighbours in sparse_xyz
+            weight: (B, N1, K), inverse distance weights
+
+        """
+        with torch.no_grad():
+            # index: (B, N1, K), distance: (B, N1, K)
+            index, distance = _F.search_nn_distance(dense_xyz, sparse_xyz, self.num_neighbors)
+            inv_distance = 1.0 / torch.clamp(distance, min=self._eps)
+            norm = torch.sum(inv_distance, dim=2, keepdim=True)
+            weight = inv_distance / norm
+        return index, weight
+
+    def forward(self, dense_xyz, sparse_xyz, dense_feature, sparse_feature, plan=None):
         """
 
         Args:
@@ -70,17 +102,15 @@ class FeatureInterpolator(nn.Module):
             sparse_xyz: key xyz, (B, 3, N2)
             dense_feature: (B, C1, N1), feature corresponding to xyz1
             sparse_feature: (B, C2, N2), feature corresponding to xyz2
+            plan (tuple, optional): (index, weight) returned by search on the same xyz
 
         Returns:
             new_feature: (B, C1+C2, N1), propagated feature
 
         """
-        with torch.no_grad():
-            # index: (B, N1, K), distance: (B, N1, K)
-            index, distance = _F.search_nn_distance(dense_xyz, sparse_xyz, self.num_neighbors)
-            inv_distance = 1.0 / torch.clamp(distance, min=self._eps)
-            norm = torch.sum(inv_distance, dim=2, keepdim=True)
-            weight = inv_distance / norm
+        if plan is None:
+            plan = self.search(dense_xyz, sparse_xyz)
+        index, weight = plan
 
         interpolated_feature = _F.feature_interpolate(sparse_feature, index, weight)
 
@@ -96,7 +126,10 @@ class FeatureInterpolator(nn.Module):
 
 
 class PointNetSAModule(nn.Module):
-    """PointNet set abstraction module"""
+    """PointNet set abstraction module
+
+    If fps_ratio is positive, centroids are sampled approximately on voxel-grid candidates (see FarthestPointSampler).
+    """
 
     def __init__(self,
                  in_channels,
@@ -104,12 +137,14 @@ class PointNetSAModule(nn.Module):
                  num_centroids,
                  radius,
                  num_neighbours,
-                 use_xyz):
+                 use_xyz,
+                 fps_ratio=0.0):
         super(PointNetSAModule, self).__init__()
 
         self.in_channels = in_channels
         self.out_channels = mlp_channels[-1]
         self.num_centroids = num_centroids
+        self.fps_ratio = fps_ratio
         # self.num_neighbours = num_neighbours
         self.use_xyz = use_xyz
 
@@ -120,7 +155,7 @@ class PointNetSAModule(nn.Module):
         if num_centroids <= 0:
             self.sampler = None
         else:
-            self.sampler = FarthestPointSampler(num_centroids)
+            self.sampler = FarthestPointSampler(num_centroids, fps_ratio)
 
         if num_neighbours < 0:
             assert radius < 0.0
@@ -129,13 +164,23 @@ class PointNetSAModule(nn.Module):
             assert num_neighbours > 0 and radius > 0.0
             self.grouper = QueryGrouper(radius, num_neighbours)
 
-    def forward(self, xyz, feature=None):
+    @property
+    def group_config(self):
+        """Configuration of sampling and grouping. Modules with the same one group the same xyz identically."""
+        if self.grouper is None:
+            return self.num_centroids, -1.0, -1, self.fps_ratio
+        return self.num_centroids, self.grouper.radius, self.grouper.num_neighbours, self.fps_ratio
+
+    def forward(self, xyz, feature=None, cache=None):
         """
 
         Args:
             xyz (torch.Tensor): (batch_size, 3, num_points)
                 xyz coordinates of feature
             feature (torch.Tensor, optional): (batch_size, in_channels, num_points)
+            cache (dict, optional): sampled centroids and neighbour indices of xyz.
+                If empty, it is filled by this module, so that other modules with the same group_config
+                can skip sampling and ball query on the same xyz.
 
         Returns:
             new_xyz (torch.Tensor): (batch_size, 3, num_centroids)
@@ -152,16 +197,22 @@ class PointNetSAModule(nn.Module):
             if self.use_xyz:
                 group_feature = torch.cat([group_xyz, group_feature], dim=1)
         else:
-            if self.num_centroids == -1:
-                # use all points
-                new_xyz = xyz
+            if cache:
+                new_xyz, index = cache['new_xyz'], cache['index']
             else:
-                # sample new points
-                index = self.sampler(xyz)
-                new_xyz = _F.gather_points(xyz, index)  # (batch_size, 3, num_centroids)
+                if self.num_centroids == -1:
+                    # use all points
+                    new_xyz = xyz
+                else:
+                    # sample new points
+                    index = self.sampler(xyz)
+                    new_xyz = _F.gather_points(xyz, index)  # (batch_size, 3, num_centroids)
+                index = self.grouper.search(new_xyz, xyz)
+                if cache is not None:
+                    cache.update(new_xyz=new_xyz, index=index)
 
             # group_feature, (batch_size, in_channels, num_centroids, num_neighbours)
-            group_feature, group_xyz = self.grouper(new_xyz, xyz, feature, use_xyz=self.use_xyz)
+            group_feature, group_xyz = self.grouper(new_xyz, xyz, feature, use_xyz=self.use_xyz, index=index)
 
         new_feature = self.mlp(group_feature)
         new_feature, _ = torch.max(new_feature, 3)
@@ -175,7 +226,10 @@ class PointNetSAModule(nn.Module):
 
 
 class PointNetSAModuleMSG(nn.Module):
-    """PointNet set abstraction module (multi scale grouping)"""
+    """PointNet set abstraction module (multi scale grouping)
+
+    If fps_ratio is positive, centroids are sampled approximately on voxel-grid candidates (see FarthestPointSampler).
+    """
 
     def __init__(self,
                  in_channels,
@@ -183,12 +237,14 @@ class PointNetSAModuleMSG(nn.Module):
                  num_centroids,
                  radius_list,
                  num_neighbours_list,
-                 use_xyz):
+                 use_xyz,
+                 fps_ratio=0.0):
         super(PointNetSAModuleMSG, self).__init__()
 
         self.in_channels = in_channels
         self.out_channels = sum(mlp_channels[-1] for mlp_channels in mlp_channels_list)
         self.num_centroids = num_centroids
+        self.fps_ratio = fps_ratio
         self.use_xyz = use_xyz
 
         num_scales = len(mlp_channels_list)
@@ -200,7 +256,7 @@ class PointNetSAModuleMSG(nn.Module):
             self.sampler = None
         else:
             assert num_centroids > 0
-            self.sampler = FarthestPointSampler(num_centroids)
+            self.sampler = FarthestPointSampler(num_centroids, fps_ratio)
         self.grouper = nn.ModuleList()
 
         if self.use_xyz:
@@ -230,12 +286,19 @@ class PointNetSAModuleMSG(nn.Module):
         else:
             new_xyz = xyz
 
+        # query all the scales in a single pass
+        num_neighbours_list = [grouper.num_neighbours for grouper in self.grouper]
+        with torch.no_grad():
+            index, _ = _F.ball_query_multi(xyz, new_xyz,
+                                           [grouper.radius for grouper in self.grouper], num_neighbours_list)
+        # (batch_size, in_channels, num_centroids, sum(num_neighbours_list)), grouped once
+        group_feature, group_xyz = QueryGrouper.group(new_xyz, xyz, feature, self.use_xyz, index)
+
         # multi-scale
         new_feature_list = []
-        for mlp, grouper in zip(self.mlp, self.grouper):
+        for mlp, group_feature_per_scale in zip(self.mlp, group_feature.split(num_neighbours_list, dim=3)):
             # (batch_size, in_channels, num_centroids, num_neighbours)
-            group_feature, group_xyz = grouper(new_xyz, xyz, feature, use_xyz=self.use_xyz)
-            new_feature = mlp(group_feature)
+            new_feature = mlp(group_feature_per_scale)
             new_feature, _ = torch.max(new_feature, 3)
             new_feature_list.append(new_feature)
 
@@ -269,13 +332,34 @@ class PointnetFPModule(nn.Module):
         else:
             raise ValueError('Expected value 1 or 3, but {} given.'.format(num_neighbors))
 
-    def forward(self, dense_xyz, sparse_xyz, dense_feature, sparse_feature):
+    def forward(self, dense_xyz, sparse_xyz, dense_feature, sparse_feature, cache=None):
+        """
+
+        Args:
+            dense_xyz (torch.Tensor): (batch_size, 3, num_dense_points)
+            sparse_xyz (torch.Tensor): (batch_size, 3, num_sparse_points)
+            dense_feature (torch.Tensor): (batch_size, dense_channels, num_dense_points)
+            sparse_feature (torch.Tensor): (batch_size, sparse_channels, num_sparse_points)
+            cache (dict, optional): the interpolation plan (neighbour indices and weights) of dense_xyz and sparse_xyz.
+                If empty, it is filled by this module, so that other modules or later calls
+                on the same xyz can skip nearest neighbour search.
+
+        Returns:
+            new_feature (torch.Tensor): (batch_size, out_channels, num_dense_points)
+
+        """
         if self.interpolator is None:
             assert sparse_xyz.size(2) == 1 and sparse_feature.size(2) == 1
             sparse_feature_expand = sparse_feature.expand(-1, -1, dense_xyz.size(2))
             new_feature = torch.cat([sparse_feature_expand, dense_feature], dim=1)
         else:
-            new_feature = self.interpolator(dense_xyz, sparse_xyz, dense_feature, sparse_feature)
+            if cache:
+                plan = cache['index'], cache['weight']
+            else:
+                plan = self.interpolator.search(dense_xyz, sparse_xyz)
+                if cache is not None:
+                    cache.update(index=plan[0], weight=plan[1])
+            new_feature = self.interpolator(dense_xyz, sparse_xyz, dense_feature, sparse_feature, plan=plan)
         new_feature = self.mlp(new_feature)
 
         return new_feature
@@ -33,7 +33,8 @@ class PointNet2MSGCls(nn.Module):
                  ),
                  global_channels=(512, 256),
                  dropout_prob=0.5,
-                 use_xyz=True):
+                 use_xyz=True,
+                 fps_ratio=0.0):
         super(PointNet2MSGCls, self).__init__()
 
         self.in_channels = in_channels
@@ -54,7 +55,8 @@ class PointNet2MSGCls(nn.Module):
                                             num_centroids=num_centroids[ind],
                                             radius_list=radius_list[ind],
                                             num_neighbours_list=num_neighbours_list[ind],
-                                            use_xyz=use_xyz)
+                                            use_xyz=use_xyz,
+                                            fps_ratio=fps_ratio)
             self.sa_modules.append(sa_module)
             feature_channels = sa_module.out_channels
 
@@ -63,7 +65,8 @@ class PointNet2MSGCls(nn.Module):
                                      num_centroids=num_centroids[-1],
                                      radius=radius_list[-1],
                                      num_neighbours=num_neighbours_list[-1],
-                                     use_xyz=use_xyz)
+                                     use_xyz=use_xyz,
+                                     fps_ratio=fps_ratio)
         self.sa_modules.append(sa_module)
 
         self.mlp_global = MLP(sa_channels_list[-1][-1], global_channels, dropout_prob=dropout_prob)
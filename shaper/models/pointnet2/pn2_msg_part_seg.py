@@ -37,7 +37,8 @@ class PointNet2MSGPartSeg(nn.Module):
                  seg_channels=(128,),
                  dropout_prob=0.5,
                  use_xyz=True,
-                 use_one_hot=True):
+                 use_one_hot=True,
+                 fps_ratio=0.0):
         super(PointNet2MSGPartSeg, self).__init__()
 
         self.in_channels = in_channels
@@ -64,7 +65,8 @@ class PointNet2MSGPartSeg(nn.Module):
                                             num_centroids=num_centroids[ind],
                                             radius_list=radius_list[ind],
                                             num_neighbours_list=num_neighbours_list[ind],
-                                            use_xyz=use_xyz)
+                                            use_xyz=use_xyz,
+                                            fps_ratio=fps_ratio)
             self.sa_modules.append(sa_module)
             feature_channels = sa_module.out_channels
 
@@ -73,7 +75,8 @@ class PointNet2MSGPartSeg(nn.Module):
                                      num_centroids=num_centroids[-1],
                                      radius=radius_list[-1],
                                      num_neighbours=num_neighbours_list[-1],
-                                     use_xyz=use_xyz)
+                                     use_xyz=use_xyz,
+                                     fps_ratio=fps_ratio)
         self.sa_modules.append(sa_module)
 
         inter_channels = [in_channels if use_xyz else in_channels - 3]
@@ -97,7 +100,7 @@ class PointNet2MSGPartSeg(nn.Module):
 
         self.reset_parameters()
 
-    def forward(self, data_batch):
+    def forward(self, data_batch, cache=None):
         points = data_batch['points']
         end_points = {}
 
@@ -133,7 +136,8 @@ class PointNet2MSGPartSeg(nn.Module):
         for fp_ind, fp_module in enumerate(self.fp_modules):
             dense_xyz = inter_xyz[-2 - fp_ind]
             dense_feature = inter_feature[-2 - fp_ind]
-            fp_feature = fp_module(dense_xyz, sparse_xyz, dense_feature, sparse_feature)
+            fp_cache = None if cache is None else cache.setdefault(('fp', fp_ind), {})
+            fp_feature = fp_module(dense_xyz, sparse_xyz, dense_feature, sparse_feature, cache=fp_cache)
             sparse_xyz = dense_xyz
             sparse_feature = fp_feature
 
@@ -30,6 +30,7 @@ class PointNet2SSGCls(nn.Module):
         global_channels (tuple of int): the numbers of channels to extract global features
         dropout_prob (float): the probability to dropout input features
         use_xyz (bool): whether or not to use the xyz position of a points as a feature
+        fps_ratio (float): if positive, sample centroids approximately on voxel-grid candidates, about fps_ratio per centroid
 
     Notes:
         1. num_centroids == -1: use all points; num_centroids == 0: use the origin.
@@ -46,7 +47,8 @@ class PointNet2SSGCls(nn.Module):
                  sa_channels=((64, 64, 128), (128, 128, 256), (256, 512, 1024)),
                  global_channels=(512, 256),
                  dropout_prob=0.5,
-                 use_xyz=True):
+                 use_xyz=True,
+                 fps_ratio=0.0):
         super(PointNet2SSGCls, self).__init__()
 
         self.in_channels = in_channels
@@ -67,7 +69,8 @@ class PointNet2SSGCls(nn.Module):
                                          num_centroids=num_centroids[ind],
                                          radius=radius[ind],
                                          num_neighbours=num_neighbours[ind],
-                                         use_xyz=use_xyz)
+                                         use_xyz=use_xyz,
+                                         fps_ratio=fps_ratio)
             self.sa_modules.append(sa_module)
             feature_channels = sa_channels[ind][-1]
 
@@ -37,6 +37,7 @@ class PointNet2SSGPartSeg(nn.Module):
         dropout_prob (float): the probability to dropout input features
         use_xyz (bool): whether or not to use the xyz position of a points as a feature
         use_one_hot (bool): whehter to use one hot vector of class labels.
+        fps_ratio (float): if positive, sample centroids approximately on voxel-grid candidates, about fps_ratio per centroid
 
     References:
         https://github.com/charlesq34/pointnet2/blob/master/models/pointnet2_part_seg.py
@@ -56,7 +57,8 @@ class PointNet2SSGPartSeg(nn.Module):
                  seg_channels=(128,),
                  dropout_prob=0.5,
                  use_xyz=True,
-                 use_one_hot=True):
+                 use_one_hot=True,
+                 fps_ratio=0.0):
         super(PointNet2SSGPartSeg, self).__init__()
 
         self.in_channels = in_channels
@@ -83,7 +85,8 @@ class PointNet2SSGPartSeg(nn.Module):
                                          num_centroids=num_centroids[ind],
                                          radius=radius[ind],
                                          num_neighbours=num_neighbours[ind],
-                                         use_xyz=use_xyz)
+                                         use_xyz=use_xyz,
+                                         fps_ratio=fps_ratio)
             self.sa_modules.append(sa_module)
             feature_channels = sa_channels[ind][-1]
 
@@ -108,7 +111,7 @@ class PointNet2SSGPartSeg(nn.Module):
 
         self.reset_parameters()
 
-    def forward(self, data_batch):
+    def forward(self, data_batch, cache=None):
         points = data_batch['points']
         end_points = {}
 
@@ -133,10 +136,15 @@ class PointNet2SSGPartSeg(nn.Module):
                 inter_feature[0] = torch.cat((inter_feature[0], one_hot_expand), dim=1)
 
         # Set Abstraction Layers
+        # xyz of each level only depends on sampling of previous modules, which keys the cache
+        inter_key = [()]
         for sa_module in self.sa_modules:
-            xyz, feature = sa_module(xyz, feature)
+            key = inter_key[-1] + sa_module.group_config
+            sa_cache = None if cache is None else cache.setdefault(key, {})
+            xyz, feature = sa_module(xyz, feature, cache=sa_cache)
             inter_xyz.append(xyz)
             inter_feature.append(feature)
+            inter_key.append(key)
 
         # Feature Propagation Layers
         sparse_xyz = xyz
@@ -144,7 +152,9 @@ class PointNet2SSGPartSeg(nn.Module):
         for fp_ind, fp_module in enumerate(self.fp_modules):
             dense_xyz = inter_xyz[-2 - fp_ind]
             dense_feature = inter_feature[-2 - fp_ind]
-            fp_feature = fp_module(dense_xyz, sparse_xyz, dense_feature, sparse_feature)
+            # the interpolation plan from the sparse level to the dense level
+            fp_cache = None if cache is None else cache.setdefault((inter_key[-2 - fp_ind], inter_key[-1 - fp_ind]), {})
+            fp_feature = fp_module(dense_xyz, sparse_xyz, dense_feature, sparse_feature, cache=fp_cache)
             sparse_xyz = dense_xyz
             sparse_feature = fp_feature
 
@@ -2,7 +2,7 @@ import torch
 
 from core.nn.functional import bpdist
 from shaper.models.dgcnn.functions import construct_edge_feature_index, construct_edge_feature_gather, \
-    construct_edge_feature
+    construct_edge_feature, get_knn_inds, get_knn_inds_blocked
 
 
 def generate_data(batch_size=16, num_points=1024, in_channels=64, k=20):
@@ -37,3 +37,16 @@ def test_construct_edge_feature():
     # backward
     assert g_index.allclose(g_gather)
     assert g_gather.allclose(g_knn)
+
+
+def test_get_knn_inds_blocked():
+    torch.manual_seed(0)
+    feature = torch.randn(2, 16, 500)
+    knn_inds = get_knn_inds(bpdist(feature), 20)
+    for block_size in (7, 64, 500):
+        knn_inds_blocked = get_knn_inds_blocked(feature, 20, block_size)
+        assert knn_inds_blocked.shape == knn_inds.shape
+        assert torch.equal(knn_inds_blocked.sort(2)[0], knn_inds.sort(2)[0])
+    # remove itself
+    knn_inds_blocked = get_knn_inds_blocked(feature, 20, 64, remove=True)
+    assert not (knn_inds_blocked == torch.arange(500).view(1, -1, 1)).any()
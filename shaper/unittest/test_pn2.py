@@ -1,8 +1,10 @@
 import numpy as np
+import pytest
 import torch
 from torch.autograd import gradcheck
 
-from shaper.models.pointnet2.functions import farthest_point_sample, group_points, ball_query
+from shaper.models.pointnet2.functions import farthest_point_sample, farthest_point_sample_voxel, group_points, ball_query
+from shaper.models.pointnet2.functions import ball_query_multi
 from shaper.models.pointnet2.functions import search_nn_distance, feature_interpolate
 
 
@@ -57,6 +59,30 @@ def test_farthest_point_sample():
     # print(prof)
 
 
+def test_farthest_point_sample_cpu():
+    np.random.seed(0)
+    points = np.random.rand(4, 3, 1024)
+    index = farthest_point_sample_np(points, 128)
+    index_tensor = farthest_point_sample(torch.from_numpy(points), 128)
+    np.testing.assert_equal(index, index_tensor.numpy())
+
+
+def test_farthest_point_sample_voxel():
+    torch.manual_seed(0)
+    points = torch.rand(4, 3, 4096)
+    index = farthest_point_sample_voxel(points, 128, ratio=4.0)
+    assert index.shape == (4, 128)
+    for b in range(4):
+        assert len(set(index[b].tolist())) == 128
+
+    def max_dist(index):
+        centroids = points.gather(2, index.unsqueeze(1).expand(-1, 3, -1))
+        return torch.cdist(points.transpose(1, 2), centroids.transpose(1, 2)).min(2)[0].max().item()
+
+    # approximate coverage
+    assert max_dist(index) < 1.5 * max_dist(farthest_point_sample(points, 128))
+
+
 def test_group_points():
     torch.manual_seed(0)
     batch_size = 16
@@ -95,6 +121,18 @@ def test_group_points():
     # print(prof)
 
 
+def test_group_points_cpu():
+    torch.manual_seed(0)
+    feature = torch.randn(2, 4, 64, dtype=torch.float64, requires_grad=True)
+    index = torch.randint(0, 64, [2, 16, 8]).long()
+
+    feature_expand = feature.unsqueeze(2).expand(2, 4, 16, 64)
+    index_expand = index.unsqueeze(1).expand(2, 4, 16, 8)
+    out_gather = torch.gather(feature_expand, 3, index_expand)
+    assert out_gather.allclose(group_points(feature, index))
+    assert gradcheck(group_points, (feature, index))
+
+
 def ball_query_np(points, centroids, radius, num_neighbours):
     index = []
     count = []
@@ -149,6 +187,51 @@ def test_ball_query():
     # print(prof)
 
 
+def test_ball_query_cpu():
+    num_points = 1024
+    np.random.seed(0)
+    points = np.random.randn(4, 3, num_points)
+    centroids = np.asarray([p[:, np.random.choice(num_points, [512], replace=False)] for p in points])
+    index, count = ball_query_np(points, centroids, 0.1, 64)
+
+    index_tensor, count_tensor = ball_query(torch.from_numpy(points), torch.from_numpy(centroids), 0.1, 64)
+    np.testing.assert_equal(index, index_tensor.numpy())
+    np.testing.assert_equal(count, count_tensor.numpy())
+
+
+@pytest.mark.parametrize('device', ['cpu', pytest.param('cuda', marks=pytest.mark.skipif(
+    not torch.cuda.is_available(), reason='CUDA is not available'))])
+def test_ball_query_multi(device):
+    num_points = 1024
+    radius_list = (0.1, 0.2, 0.4)
+    num_neighbours_list = (16, 32, 64)
+    torch.manual_seed(0)
+    points = torch.randn(2, 3, num_points).to(device)
+    centroids = points[:, :, :256]
+
+    # an incomplete last chunk of centroids
+    index, count = ball_query_multi(points, centroids, radius_list, num_neighbours_list, chunk_size=100)
+    assert index.device == count.device == points.device
+    index_list = index.split(num_neighbours_list, dim=2)
+    for i, (radius, num_neighbours) in enumerate(zip(radius_list, num_neighbours_list)):
+        # the cuda kernel on cuda
+        index_tensor, count_tensor = ball_query(points, centroids, radius, num_neighbours)
+        np.testing.assert_equal(index_list[i].cpu().numpy(), index_tensor.cpu().numpy())
+        np.testing.assert_equal(count[:, :, i].cpu().numpy(), count_tensor.cpu().numpy())
+
+
+def test_ball_query_cpu_boundary():
+    # points on a grid lie exactly on the radius of many centroids
+    np.random.seed(0)
+    points = (np.random.randint(0, 8, [2, 3, 512]) * 0.1 + 0.3).astype(np.float32)
+    centroids = points[:, :, :128]
+    for radius in (0.1, 0.2, 0.3):
+        index, count = ball_query_np(points, centroids, radius, 32)
+        index_tensor, count_tensor = ball_query(torch.from_numpy(points), torch.from_numpy(centroids), radius, 32)
+        np.testing.assert_equal(index, index_tensor.numpy())
+        np.testing.assert_equal(count, count_tensor.numpy())
+
+
 def search_nn_distance_np(query_xyz, key_xyz, num_neighbors):
     """For each point in query set, find its distances to k nearest neighbors in key set
 
@@ -280,3 +363,50 @@ def test_feature_interpolate():
     # with torch.autograd.profiler.profile(use_cuda=torch.cuda.is_available()) as prof:
     #     feature_interpolate(features_tensor, index_tensor, weight_tensor)
     # print(prof)
+
+
+def test_sa_module_cache():
+    from shaper.models.pointnet2.modules import PointNetSAModule
+    torch.manual_seed(0)
+    xyz = torch.rand(2, 3, 256)
+    sa_modules = [PointNetSAModule(0, (16, 32), 32, 0.2, 16, use_xyz=True).eval() for _ in range(2)]
+    cache = {}
+    for sa_module in sa_modules:
+        new_xyz, new_feature = sa_module(xyz, cache=cache)
+        new_xyz_ref, new_feature_ref = sa_module(xyz)
+        np.testing.assert_allclose(new_xyz.numpy(), new_xyz_ref.numpy())
+        np.testing.assert_allclose(new_feature.detach().numpy(), new_feature_ref.detach().numpy(), atol=1e-6)
+    assert set(cache.keys()) == {'new_xyz', 'index'}
+
+
+def test_fp_module_cache():
+    from shaper.models.pointnet2.modules import PointnetFPModule
+    torch.manual_seed(0)
+    dense_xyz = torch.rand(2, 3, 256)
+    sparse_xyz = dense_xyz[:, :, :32]
+    fp_modules = [PointnetFPModule(16 + 8, (16,), num_neighbors=3).eval() for _ in range(2)]
+    cache = {}
+    for fp_module in fp_modules:
+        dense_feature = torch.rand(2, 8, 256)
+        sparse_feature = torch.rand(2, 16, 32)
+        new_feature = fp_module(dense_xyz, sparse_xyz, dense_feature, sparse_feature, cache=cache)
+        new_feature_ref = fp_module(dense_xyz, sparse_xyz, dense_feature, sparse_feature)
+        np.testing.assert_allclose(new_feature.detach().numpy(), new_feature_ref.detach().numpy(), atol=1e-6)
+    assert set(cache.keys()) == {'index', 'weight'}
+
+
+def test_sa_module_fps_ratio():
+    from shaper.models.pointnet2.modules import PointNetSAModule, PointNetSAModuleMSG
+    torch.manual_seed(0)
+    xyz = torch.rand(2, 3, 1024)
+    sa_module = PointNetSAModule(0, (16, 32), 32, 0.2, 16, use_xyz=True, fps_ratio=4.0).eval()
+    assert sa_module.sampler.ratio == 4.0
+    # modules sampling differently do not share caches
+    assert sa_module.group_config != PointNetSAModule(0, (16, 32), 32, 0.2, 16, use_xyz=True).group_config
+    sa_module_msg = PointNetSAModuleMSG(0, ((16,), (32,)), 32, (0.1, 0.2), (8, 16), use_xyz=True, fps_ratio=4.0).eval()
+    assert sa_module_msg.sampler.ratio == 4.0
+    with torch.no_grad():
+        for module in (sa_module, sa_module_msg):
+            new_xyz, new_feature = module(xyz)
+            assert new_xyz.shape == (2, 3, 32)
+            assert new_feature.shape == (2, module.out_channels, 32)
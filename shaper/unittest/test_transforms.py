@@ -85,3 +85,42 @@ def test_transform():
     random_dropout = T.RandomDropout(0.99)
     dropout_points = random_dropout(to_tensor(np.hstack([pc, new_colors]))).numpy()
     visualize_point_cloud(dropout_points[:, 0:3], dropout_points[:, 6:9], dropout_points[:, 3:6])
+
+
+def test_batch_transform():
+    batch_size, num_points = 4, 256
+    points = torch.rand(batch_size, num_points, 3)
+    seg_label = torch.arange(num_points).repeat(batch_size, 1)
+
+    # rotation matrices are the same as the numpy version
+    angle = torch.rand(batch_size, dtype=torch.float64) * (2 * np.pi)
+    axis = np.random.normal(0, 1.0, (3,))
+    R = T.get_rotation_matrix_batch(angle, axis).numpy()
+    for i in range(batch_size):
+        np.testing.assert_allclose(R[i], T.get_rotation_matrix_np(angle[i].item(), axis), atol=1e-8)
+
+    # rigid transforms keep pairwise distances
+    for t in [T.BatchRotate((0., 0., 1.)), T.BatchRotatePerturbation(1.0, 1.0), T.BatchTranslate()]:
+        transformed_points = t(points.clone())
+        np.testing.assert_allclose((transformed_points[:, :, None] - transformed_points[:, None]).norm(dim=-1).numpy(),
+                                   (points[:, :, None] - points[:, None]).norm(dim=-1).numpy(), atol=1e-5)
+
+    # each point cloud is scaled by a single factor
+    scaled_points = T.BatchScale(2.0, 3.0)(points.clone())
+    scale = scaled_points / points
+    assert torch.allclose(scale, scale[:, 0:1], atol=1e-4)
+    assert ((scale >= 2.0 - 1e-4) & (scale <= 3.0 + 1e-4)).all()
+
+    # labels follow points
+    for t in [T.BatchShuffle(), T.BatchSample(128)]:
+        out_points, out_label = t(points.clone(), seg_label.clone())
+        np.testing.assert_allclose(out_points.numpy(),
+                                   points.gather(1, out_label.unsqueeze(-1).expand(-1, -1, 3)).numpy())
+    out_points, out_label = T.BatchRandomDropout(0.5)(points.clone(), seg_label.clone())
+    is_drop = (out_label == -100)
+    assert torch.equal(out_points[is_drop], points[:, 0:1].expand_as(points)[is_drop])
+    assert torch.equal(out_points[~is_drop], points[~is_drop])
+
+    transform = T.BatchComposeSeg([T.BatchRotateY(), T.BatchJitter(), T.BatchShuffle(), T.BatchTranspose()])
+    out_points, out_label = transform(points.clone(), seg_label.clone())
+    assert out_points.shape == (batch_size, 3, num_points) and out_label.shape == (batch_size, num_points)
@@ -0,0 +1,10 @@
+from subprocess import Popen
+
+shapes = ['bed', 'bag', 'clock', 'earphone', 'faucet', 'bottle', 'bowl', 'door', 'dishwasher', 'display',
+          'chair', 'lamp', 'storagefurniture', 'hat', 'key', 'knife', 'laptop', 'micro', 'mug', 'refrig',
+          'scissor', 'trash', 'vase', 'table']
+for shape in shapes:
+    p = Popen('python partnet/test_multi_level.py --cfg test_configs/l3_{0}.yaml --cfg test_configs/l2_{0}.yaml '
+              '--cfg test_configs/l1_{0}.yaml'.format(shape), shell=True)
+    p.wait()
+print('success')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Benchmark approximate farthest point sample on voxel-grid candidates against exact FPS
+
+Point clouds are shapes of a PartNet h5 file (--data), or random points on spheres without data.
+Large scenes can be emulated by jittered copies of each shape (--num-points).
+Coverage is measured by distances from points to the nearest sampled centroid:
+    max: the largest distance of each cloud (one-sided Hausdorff distance), averaged over clouds,
+    mean: the average distance over all the points.
+The smaller they are, the better centroids cover the clouds.
+"""
+
+import argparse
+import os.path as osp
+import sys
+import time
+
+import h5py
+import numpy as np
+import torch
+
+sys.path.insert(0, osp.dirname(__file__) + '/..')
+
+import shaper.models.pointnet2.functions as _F
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark approximate FPS')
+    parser.add_argument('--data', default='', type=str, help='PartNet h5 file, random if empty')
+    parser.add_argument('-b', '--batch-size', default=8, type=int)
+    parser.add_argument('--num-points', default=10000, type=int,
+                        help='the number of points of each cloud, upsampled by jittered copies if larger than shapes')
+    parser.add_argument('--num-centroids', default='128,1024', type=str, help='comma-separated')
+    parser.add_argument('--ratios', default='2,4,8,16', type=str, help='candidates per centroid, comma-separated')
+    parser.add_argument('-n', '--repeat', default=3, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def load_points(data, batch_size, num_points, rng):
+    """Return (batch_size, 3, num_points) of float32"""
+    if data:
+        with h5py.File(data, 'r') as f:
+            shapes = f['pts'][:batch_size]
+    else:
+        shapes = rng.randn(batch_size, num_points, 3)
+        shapes /= np.linalg.norm(shapes, axis=2, keepdims=True)
+    points = []
+    for shape in shapes:
+        copies = [shape]
+        while sum(len(x) for x in copies) < num_points:
+            copies.append(shape + rng.normal(scale=0.005, size=shape.shape))
+        points.append(np.concatenate(copies)[:num_points])
+    return torch.from_numpy(np.stack(points)).float().transpose(1, 2).contiguous()
+
+
+def coverage(points, index, chunk_size=4096):
+    """Return the max and mean distances from points to the nearest centroid"""
+    centroids = _F.gather_points(points, index)
+    min_dist = []
+    for start in range(0, points.size(2), chunk_size):
+        # (batch_size, chunk_size, num_centroids)
+        dist = torch.cdist(points[:, :, start:start + chunk_size].transpose(1, 2), centroids.transpose(1, 2))
+        min_dist.append(dist.min(2)[0])
+    min_dist = torch.cat(min_dist, dim=1)
+    return min_dist.max(1)[0].mean().item(), min_dist.mean().item()
+
+
+def measure(fn, repeat):
+    """Return the output and the median latency in ms"""
+    out = fn()
+    latency = []
+    for _ in range(repeat):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        latency.append(time.perf_counter() - start_time)
+    return out, sorted(latency)[len(latency) // 2] * 1e3
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    points = load_points(args.data, args.batch_size, args.num_points, rng).to(args.device)
+    print('points: {}  device: {}'.format(tuple(points.shape), args.device))
+
+    for num_centroids in map(int, args.num_centroids.split(',')):
+        with torch.no_grad():
+            index, exact_time = measure(lambda: _F.farthest_point_sample(points, num_centroids), args.repeat)
+            exact_max, exact_mean = coverage(points, index)
+            print('{:5d} centroids  exact        {:9.2f} ms  max {:.4f}  mean {:.4f}'.format(
+                num_centroids, exact_time, exact_max, exact_mean))
+            for ratio in map(float, args.ratios.split(',')):
+                index, approx_time = measure(
+                    lambda: _F.farthest_point_sample_voxel(points, num_centroids, ratio), args.repeat)
+                approx_max, approx_mean = coverage(points, index)
+                print('{:5d} centroids  ratio {:6.1f} {:9.2f} ms  max {:.4f} ({:+.1%})  mean {:.4f} ({:+.1%})'
+                      '  speedup {:.1f}x'.format(num_centroids, ratio, approx_time,
+                                                 approx_max, approx_max / exact_max - 1.0,
+                                                 approx_mean, approx_mean / exact_mean - 1.0,
+                                                 exact_time / approx_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Benchmark CPU latency of models before and after exporting for inference
+
+Models are randomly initialized, which does not change latency:
+    the stage-1 RegionClassifier built from the config,
+    the stage-2 PointNetCls (model_merge), for each infer_type.
+
+Each model is measured in eager mode, after folding batch normalization (export_inference),
+and optionally traced by TorchScript (--trace, PointNetCls only).
+SharedMLP runs as conv or matmul at inference according to --matmul.
+"""
+
+import argparse
+import os.path as osp
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, osp.dirname(__file__) + '/..')
+
+from core.config import purge_cfg
+from core.nn import SharedMLP
+from core.nn.fuse import export_inference, trace_inference
+from partnet.config.ins_seg_3d import cfg
+from partnet.models.build import build_model
+from partnet.models.pn2 import PointNetCls
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark CPU latency of exported models')
+    parser.add_argument('--cfg', dest='config_file', default=osp.dirname(__file__) + '/../configs/pn_stage1_fusion.yaml',
+                        type=str, help='config of the stage-1 model')
+    parser.add_argument('-b', '--batch-size', default=32, type=int,
+                        help='batch size of PointNetCls, i.e. the number of pairs')
+    parser.add_argument('--num-centroids', default=128, type=int,
+                        help='the number of regions of RegionClassifier')
+    parser.add_argument('--num-points', default=1024, type=int,
+                        help='the number of points of each sub-part')
+    parser.add_argument('-n', '--repeat', default=10, type=int)
+    parser.add_argument('--num-threads', default=0, type=int, help='0 for the default of torch')
+    parser.add_argument('--trace', action='store_true', help='also benchmark TorchScript traced branches')
+    parser.add_argument('--matmul', default='off', choices=['auto', 'on', 'off'],
+                        help='whether SharedMLP runs as matmul at inference '
+                             '(auto: chosen by a micro-benchmark of each input shape) [default: off]')
+    args = parser.parse_args()
+    return args
+
+
+def measure(fn, inputs, repeat):
+    """Return the median latency in ms"""
+    with torch.no_grad():
+        # warm up
+        fn(*inputs)
+        latency = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            fn(*inputs)
+            latency.append(time.perf_counter() - start_time)
+    return sorted(latency)[len(latency) // 2] * 1e3
+
+
+def get_branch_inputs(batch_size, num_points, out_channels=128):
+    """Inputs of each infer_type of PointNetCls, with the shapes in the grouping loop"""
+    part_xyz = torch.rand(batch_size, 3, num_points)
+    pair_xyz = torch.rand(batch_size, 3, 2 * num_points)
+    return {
+        'backbone': (part_xyz,),
+        'backbone2': (pair_xyz,),
+        'policy': (part_xyz,),
+        'policy_head': (torch.randn(batch_size, out_channels // 2),),
+        'purity': (pair_xyz,),
+        'head': (torch.cat([pair_xyz, torch.randn(batch_size, out_channels, 2 * num_points)], dim=1),),
+        'head2': (torch.cat([pair_xyz, torch.randn(batch_size, 2 * out_channels, 2 * num_points)], dim=1),),
+    }
+
+
+def set_matmul(model, matmul):
+    for m in model.modules():
+        if isinstance(m, SharedMLP):
+            m.matmul = {'auto': None, 'on': True, 'off': False}[matmul]
+
+
+def benchmark_region_classifier(args):
+    cfg.merge_from_file(args.config_file)
+    purge_cfg(cfg)
+    model, _, _, _ = build_model(cfg)
+    model.eval()
+    set_matmul(model, args.matmul)
+    num_neighbours = cfg.DATALOADER.KWARGS.num_neighbours
+    data_batch = {
+        'neighbour_xyz_purity': torch.rand(1, 3, args.num_centroids, num_neighbours),
+        'neighbour_xyz': torch.rand(1, 3, args.num_centroids, num_neighbours),
+        'valid_center_mask': torch.randint(0, 2, (1, args.num_centroids)),
+    }
+    fused_model = export_inference(model)
+    eager_time = measure(model, (data_batch,), args.repeat)
+    fused_time = measure(fused_model, (data_batch,), args.repeat)
+    print('{:<20s} eager {:8.2f} ms  fused {:8.2f} ms'.format('RegionClassifier', eager_time, fused_time))
+
+
+def benchmark_pointnet_cls(args):
+    model = PointNetCls(in_channels=3, out_channels=128)
+    model.eval()
+    set_matmul(model, args.matmul)
+    fused_model = export_inference(model)
+    for infer_type, inputs in get_branch_inputs(args.batch_size, args.num_points).items():
+        eager_time = measure(lambda *x: model(*x, infer_type), inputs, args.repeat)
+        fused_time = measure(lambda *x: fused_model(*x, infer_type), inputs, args.repeat)
+        msg = '{:<20s} eager {:8.2f} ms  fused {:8.2f} ms'.format(infer_type, eager_time, fused_time)
+        if args.trace:
+            traced_model = trace_inference(fused_model, inputs, infer_type)
+            msg += '  traced {:8.2f} ms'.format(measure(traced_model, inputs, args.repeat))
+        print(msg)
+
+
+def main():
+    args = parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    print('CPU threads: {}'.format(torch.get_num_threads()))
+    benchmark_region_classifier(args)
+    benchmark_pointnet_cls(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""Check accuracy and CPU throughput of the dynamically quantized grouping network (model_merge)
+
+Pairs of sub-parts are cut from shapes of a PartNet h5 file (--data), as k nearest neighbours
+of two nearby seeds, or sampled randomly without data. They are normalized as in partnet/test.py.
+Decisions of int8 are compared with fp32 for each branch:
+    purity: whether the purity is above the threshold,
+    policy: the pair with the highest score (purity * policy) in each batch,
+    verification ('head', 'head2'): whether to merge.
+"""
+
+import argparse
+import os.path as osp
+import sys
+import time
+import warnings
+
+import h5py
+import numpy as np
+import torch
+
+sys.path.insert(0, osp.dirname(__file__) + '/..')
+
+from core.nn.fuse import export_inference
+from core.nn.quantize import quantize_dynamic
+from partnet.models.pn2 import PointNetCls
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark dynamic int8 quantization of model_merge')
+    parser.add_argument('--weights', default='', type=str, help='checkpoint of model_merge, random if empty')
+    parser.add_argument('--data', default='', type=str, help='PartNet h5 file to cut part clouds, random if empty')
+    parser.add_argument('-b', '--batch-size', default=64, type=int, help='the number of pairs per batch')
+    parser.add_argument('--num-batches', default=8, type=int)
+    parser.add_argument('--num-points', default=1024, type=int, help='the number of points of each sub-part')
+    parser.add_argument('--purity-thresh', default=0.8, type=float)
+    parser.add_argument('--min-agreement', default=0.95, type=float,
+                        help='the minimum ratio of decisions matching fp32')
+    parser.add_argument('--num-threads', default=0, type=int, help='0 for the default of torch')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def load_model(weights):
+    model = PointNetCls(in_channels=3, out_channels=128)
+    if weights:
+        state_dict = torch.load(weights, map_location='cpu')['model']
+        # saved from nn.DataParallel
+        state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+        model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def cut_pairs(points, batch_size, num_points, rng):
+    """Cut pairs of adjacent sub-parts from shapes
+
+    Args:
+        points (np.ndarray): (num_shapes, num_shape_points, 3)
+
+    Returns:
+        part_xyz1, part_xyz2 (torch.Tensor): (batch_size, 3, num_points)
+
+    """
+    part_xyz1, part_xyz2 = [], []
+    for _ in range(batch_size):
+        shape = points[rng.randint(len(points))]
+        seed = shape[rng.randint(len(shape))]
+        order = np.argsort(np.sum((shape - seed) ** 2, axis=1))
+        # the second seed is next to the first sub-part
+        seed2 = shape[order[rng.randint(num_points, 2 * num_points)]]
+        order2 = np.argsort(np.sum((shape - seed2) ** 2, axis=1))
+        part_xyz1.append(shape[order[:num_points]])
+        part_xyz2.append(shape[order2[:num_points]])
+    part_xyz1 = torch.from_numpy(np.stack(part_xyz1)).float().transpose(1, 2).contiguous()
+    part_xyz2 = torch.from_numpy(np.stack(part_xyz2)).float().transpose(1, 2).contiguous()
+    return part_xyz1, part_xyz2
+
+
+def normalize(xyz, norm=None):
+    xyz = xyz - xyz.mean(-1, keepdim=True)
+    if norm is None:
+        norm = xyz.norm(dim=1).max(dim=-1)[0].view(-1, 1, 1)
+    return xyz / norm, norm
+
+
+def get_branch_inputs(part_xyz1, part_xyz2):
+    part_xyz, part_norm = normalize(torch.cat([part_xyz1, part_xyz2], dim=-1))
+    return {
+        'part_xyz': part_xyz,
+        # policy, normalized by the union
+        'part_xyz11': normalize(part_xyz1, part_norm)[0],
+        'part_xyz22': normalize(part_xyz2, part_norm)[0],
+        # backbone
+        'part_xyz1': normalize(part_xyz1)[0],
+        'part_xyz2': normalize(part_xyz2)[0],
+    }
+
+
+def run_branches(model, inputs, timing):
+    """Run all the branches as in the grouping loop, and accumulate the time of each branch"""
+    def run(name, *args):
+        start_time = time.perf_counter()
+        out = model(*args)
+        timing[name] = timing.get(name, 0.0) + time.perf_counter() - start_time
+        return out
+
+    outputs = dict()
+    outputs['purity'] = run('purity', inputs['part_xyz'], 'purity').view(-1)
+    logits11 = run('policy', inputs['part_xyz11'], 'policy')
+    logits22 = run('policy', inputs['part_xyz22'], 'policy')
+    outputs['policy'] = run('policy', torch.cat([logits11, logits22], dim=-1), 'policy_head').view(-1)
+    logits1 = run('head', inputs['part_xyz1'], 'backbone')
+    logits2 = run('head', inputs['part_xyz2'], 'backbone')
+    outputs['head'] = run('head', inputs['part_xyz'], 'head', ((logits1, logits2),))
+    # the union as the context
+    context_logits = run('head2', inputs['part_xyz'], 'backbone2')
+    outputs['head2'] = run('head2', inputs['part_xyz'], 'head2', ((logits1, logits2), (context_logits,)))
+    return outputs
+
+
+def main():
+    args = parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    warnings.filterwarnings('ignore', category=DeprecationWarning)
+    rng = np.random.RandomState(args.seed)
+    torch.manual_seed(args.seed)
+
+    model = load_model(args.weights)
+    fp32_model = export_inference(model)
+    int8_model = quantize_dynamic(model)
+
+    if args.data:
+        with h5py.File(args.data, 'r') as f:
+            points = f['pts'][:]
+    else:
+        points = rng.randn(16, 10000, 3).astype(np.float32)
+
+    fp32_timing, int8_timing = dict(), dict()
+    agreement = {'purity': [], 'policy': [], 'head': [], 'head2': []}
+    max_diff = {'purity': 0.0, 'policy': 0.0}
+    with torch.no_grad():
+        for batch_ind in range(args.num_batches + 1):
+            inputs = get_branch_inputs(*cut_pairs(points, args.batch_size, args.num_points, rng))
+            if batch_ind == 0:
+                # warm up
+                run_branches(fp32_model, inputs, dict())
+                run_branches(int8_model, inputs, dict())
+                continue
+            fp32_outputs = run_branches(fp32_model, inputs, fp32_timing)
+            int8_outputs = run_branches(int8_model, inputs, int8_timing)
+
+            for name in ('purity', 'policy'):
+                max_diff[name] = max(max_diff[name], (fp32_outputs[name] - int8_outputs[name]).abs().max().item())
+            agreement['purity'].append(((fp32_outputs['purity'] > args.purity_thresh) ==
+                                        (int8_outputs['purity'] > args.purity_thresh)).float().mean().item())
+            fp32_score = fp32_outputs['purity'] * fp32_outputs['policy']
+            int8_score = int8_outputs['purity'] * int8_outputs['policy']
+            agreement['policy'].append(float(fp32_score.argmax().item() == int8_score.argmax().item()))
+            for name in ('head', 'head2'):
+                agreement[name].append((fp32_outputs[name].argmax(1) ==
+                                        int8_outputs[name].argmax(1)).float().mean().item())
+
+    print('CPU threads: {}'.format(torch.get_num_threads()))
+    num_pairs = args.batch_size * args.num_batches
+    passed = True
+    for name in ('purity', 'policy', 'head', 'head2'):
+        ratio = float(np.mean(agreement[name]))
+        passed = passed and ratio >= args.min_agreement
+        msg = '{:<8s} agreement {:.4f}'.format(name, ratio)
+        if name in max_diff:
+            msg += '  max diff {:.4f}'.format(max_diff[name])
+        msg += '  fp32 {:8.1f} pairs/s  int8 {:8.1f} pairs/s'.format(num_pairs / fp32_timing[name],
+                                                                   num_pairs / int8_timing[name])
+        print(msg)
+    print('total    fp32 {:8.1f} pairs/s  int8 {:8.1f} pairs/s'.format(num_pairs / sum(fp32_timing.values()),
+                                                                     num_pairs / sum(int8_timing.values())))
+    print('PASSED' if passed else 'FAILED: agreement below {}'.format(args.min_agreement))
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
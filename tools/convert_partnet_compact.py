@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Convert PartNet instance segmentation h5 files into the compact store
+
+Each h5 file under <root-dir>/<shape>-<level>/ is converted into
+    <output-dir>/<shape>-<level>/<name>.points.npy: float32 [N, 10000, 3]
+    <output-dir>/<shape>-<level>/<name>.ins_id.npy: uint8 [N, 10000]
+    <output-dir>/<shape>-<level>/<name>.gt_valid.npy: uint8 [N, 200]
+    <output-dir>/<shape>-<level>/<name>.json: meta data (copied)
+which can be loaded by PartNetCompactInsSeg.
+
+Convert both "ins_seg_h5_for_detection" and "ins_seg_h5_gt" if the test split is needed,
+and keep "for_detection" and "gt" in the output names, e.g. "ins_seg_compact_for_detection".
+
+With --gt-label, per-point semantic labels of "ins_seg_h5_gt" files are also computed once
+and stored into the h5 files as "gt_label", so that PartNetInsSeg does not rebuild them at test time.
+"""
+
+import argparse
+import os
+import os.path as osp
+import sys
+import shutil
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, osp.dirname(__file__) + '/..')
+
+
+def get_ins_id(gt_mask, gt_other_mask):
+    """Convert instance masks into per-point instance ids
+
+    Args:
+        gt_mask (np.ndarray): (n, num_ins, num_points)
+        gt_other_mask (np.ndarray): (n, num_points)
+
+    Returns:
+        np.ndarray: (n, num_points), 0 for ignore and k + 1 for the k-th instance
+
+    """
+    # same as argmax over the concatenation of gt_other_mask and gt_mask
+    gt_all_mask = np.concatenate([gt_other_mask[:, None, :], gt_mask], axis=1)
+    ins_id = gt_all_mask.argmax(axis=1)
+    assert ins_id.max() < 256
+    return ins_id.astype(np.uint8)
+
+
+def convert_h5(h5_path, output_prefix, chunk_size=64):
+    with h5py.File(h5_path, mode='r') as f:
+        other_key = 'gt_other_mask' if 'gt_other_mask' in f else 'gt_mask_other'
+        valid_key = 'gt_valid' if 'gt_valid' in f else 'gt_mask_valid'
+        num_samples, num_points, _ = f['pts'].shape
+        points = np.lib.format.open_memmap(output_prefix + '.points.npy', mode='w+',
+                                           dtype=np.float32, shape=(num_samples, num_points, 3))
+        ins_id = np.lib.format.open_memmap(output_prefix + '.ins_id.npy', mode='w+',
+                                           dtype=np.uint8, shape=(num_samples, num_points))
+        # kept as is, since a valid instance can have no points in ins_id,
+        # e.g. if it is empty or covered by gt_other_mask
+        np.save(output_prefix + '.gt_valid.npy', np.asarray(f[valid_key], dtype=np.uint8))
+        # convert by chunks to bound memory of gt_mask
+        for start in range(0, num_samples, chunk_size):
+            end = min(start + chunk_size, num_samples)
+            points[start:end] = f['pts'][start:end]
+            ins_id[start:end] = get_ins_id(f['gt_mask'][start:end], f[other_key][start:end])
+        points.flush()
+        ins_id.flush()
+    json_path = h5_path.replace('.h5', '.json')
+    if osp.exists(json_path):
+        shutil.copyfile(json_path, output_prefix + '.json')
+    return num_samples
+
+
+def add_gt_label(h5_path, chunk_size=64):
+    """Store per-point semantic labels into a h5 file of the test split
+
+    Returns:
+        bool: whether labels are added
+
+    """
+    from partnet.data.partnet import get_gt_label
+
+    with h5py.File(h5_path, mode='a') as f:
+        if 'gt_mask_label' not in f or 'gt_label' in f:
+            return False
+        num_samples, num_points, _ = f['pts'].shape
+        gt_label = f.create_dataset('gt_label', shape=(num_samples, num_points), dtype=np.uint8)
+        for start in range(0, num_samples, chunk_size):
+            end = min(start + chunk_size, num_samples)
+            gt_label[start:end] = get_gt_label(f['gt_mask'][start:end], f['gt_mask_valid'][start:end],
+                                               f['gt_mask_label'][start:end])
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert PartNet h5 files into the compact store')
+    parser.add_argument('-i', '--root-dir', required=True, type=str,
+                        help='Root directory of h5 files')
+    parser.add_argument('-o', '--output-dir', required=True, type=str,
+                        help='Root directory of the compact store')
+    parser.add_argument('--chunk-size', default=64, type=int)
+    parser.add_argument('--gt-label', action='store_true',
+                        help='Store per-point semantic labels into h5 files of the test split')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    for folder in sorted(os.listdir(args.root_dir)):
+        folder_path = osp.join(args.root_dir, folder)
+        if not osp.isdir(folder_path):
+            continue
+        output_path = osp.join(args.output_dir, folder)
+        os.makedirs(output_path, exist_ok=True)
+        for fname in sorted(os.listdir(folder_path)):
+            if not fname.endswith('.h5'):
+                continue
+            if args.gt_label and add_gt_label(osp.join(folder_path, fname), chunk_size=args.chunk_size):
+                print('{}/{}: gt_label added'.format(folder, fname))
+            num_samples = convert_h5(osp.join(folder_path, fname),
+                                     osp.join(output_path, fname[:-len('.h5')]),
+                                     chunk_size=args.chunk_size)
+            print('{}/{}: {} shapes'.format(folder, fname, num_samples))
+
+
+if __name__ == '__main__':
+    main()